@@ -16,15 +16,38 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import sys, getopt, os, re, string, stat, subprocess, math, shlex, time
+import glob, gzip, io, bisect, struct, fcntl, heapq, collections, json, copy, tempfile, shutil, resource, tarfile
+import contextlib, tracemalloc, cProfile, signal, zlib, lzma, concurrent.futures
 from multiprocessing import Pool, Process, Lock, Manager, Value, Array
 import multiprocessing
 from argparse import ArgumentParser
 import logging
 
+# numpy is only needed for post-processing and asyncio for trace and collect.  Both are imported by the
+# modes that use them (import_numpy, import_asyncio), so --help starts quickly and trace mode still runs
+# on minimal hosts
+np = None
+asyncio = None
+
 # Global Variables
 logger = None
 log_format = "[%(levelname)s] %(message)s" # "%(asctime)s [%(levelname)s] %(message)s"
 
+### Single-process stand-in for a multiprocessing Value.  share_state() swaps in the real thing
+class local_value:
+    __slots__ = ('value',)
+    def __init__(self, value):
+        self.value = value
+# local_value (DONE)
+
+### Single-process stand-in for a manager Lock
+class local_lock:
+    def acquire(self):
+        return True
+    def release(self):
+        return
+# local_lock (DONE)
+
 class global_variables:
     #VERBOSE   = False
     def __init__(self):
@@ -32,51 +55,47 @@ class global_variables:
         self.verbose           = False                       # Verbose logging (-v flag)
         self.debug             = False                       # Debug log level (-x flag)
         self.single_threaded   = True                        # Single threaded for debug/profiling
-        self.manager           = Manager()                   # Multiprocess sync object
+        self.manager           = None                        # Multiprocess sync object, started by share_state() for worker processes
 
         self.file_list         = []                          # File List
 
-        self.io_total          = Value('L', 0)               # Number of total I/O's
-        self.read_total        = Value('L', 0)               # Number of buckets read (1 I/O can touch many buckets)
-        self.write_total       = Value('L', 0)               # Number of buckets written (1 I/O can touch many buckets)
-        self.reads             = self.manager.dict()         # Array of read hits by bucket ID
-        self.writes            = self.manager.dict()         # Array of write hits by bucket ID
-        self.r_totals          = self.manager.dict()         # Hash of read I/O's with I/O size as key
-        self.w_totals          = self.manager.dict()         # Hash of write I/O's with I/O size as key
-        self.bucket_hits_total = Value('L', 0)               # Total number of bucket hits (not the total buckets)
-        self.total_blocks      = Value('L', 0)               # Total number of LBA's accessed during profiling
-        self.files_to_lbas     = self.manager.dict()         # Files and the lba ranges associated with them
-        self.max_bucket_hits   = Value('L', 0)               # The hottest bucket
-        self.bucket_to_files   = self.manager.dict()         # List of files that reside on each bucket
-        self.term              = Value('L', 0)               # Thread pool done with work
+        self.io_total          = local_value(0)              # Number of total I/O's
+        self.read_total        = local_value(0)              # Number of buckets read (1 I/O can touch many buckets)
+        self.write_total       = local_value(0)              # Number of buckets written (1 I/O can touch many buckets)
+        self.counter_chunk     = 1 << 22                     # Bucket IDs buffered before a sparse counter merge
+        self.reads             = None                        # Read hits by bucket ID (sparse), see sparse_counters()
+        self.writes            = None                        # Write hits by bucket ID (sparse)
+        self.read_crossings    = None                        # Reads continuing into each bucket from the one before
+        self.write_crossings   = None                        # Writes continuing into each bucket from the one before
+        self.r_totals          = {}                          # Hash of read I/O's with I/O size as key
+        self.w_totals          = {}                          # Hash of write I/O's with I/O size as key
+        self.bucket_hits_total = local_value(0)              # Total number of bucket hits (not the total buckets)
+        self.total_blocks      = local_value(0)              # Total number of LBA's accessed during profiling
+        self.files_to_lbas     = {}                          # Files and the lba ranges associated with them
+        self.max_bucket_hits   = local_value(0)              # The hottest bucket
+        self.bucket_to_files   = {}                          # List of files that reside on each bucket
+        self.term              = local_value(0)              # Thread pool done with work
         self.trace_files       = False                       # Map filesystem files to block LBAs
 
-        ### Semaphores: These are the locks for the shared variables
-        self.read_semaphore            = self.manager.Lock() # Lock for the global read hit array
-        self.write_semaphore           = self.manager.Lock() # Lock for the global write hit array
-        self.read_totals_semaphore     = self.manager.Lock() # Lock for the global read totals
-        self.write_totals_semaphore    = self.manager.Lock() # Lock for the global write totals
-        self.total_semaphore           = self.manager.Lock() # Lock for the global I/O totals
-        self.total_blocks_semaphore    = self.manager.Lock() # Lock for the global total LBA's accessed
-        self.files_to_lbas_semaphore   = self.manager.Lock() # Lock for the global file->lba mapping hash
-        self.max_bucket_hits_semaphore = self.manager.Lock() # Lock for the global maximum hits per bucket
-        self.bucket_to_files_semaphore1 = self.manager.Lock() # Lock for the global bucket_to_files
-        self.bucket_to_files_semaphore2 = self.manager.Lock() # Lock for the global bucket_to_files
-        self.term_semaphore            = self.manager.Lock() # Lock for the global TERM
-        self.trace_files_semaphore     = self.manager.Lock() # Lock for the global trace_files
-        self.file_hit_count_semaphore  = self.manager.Lock() # Lock for the global file_hit_count
-
-        # Thread-local variables.  Use these to avoid locking constantly
-        self.thread_io_total   = 0          # Thread-local total I/O count (I/O ops)
-        self.thread_r_totals   = {}         # Thread-local read I/O size counts (ops)
-        self.thread_w_totals   = {}         # Thread-local write I/O size counts (ops)
-        self.thread_bucket_hits_total = 0   # Thread-local total bucket hits (buckets)
-        self.thread_read_total = 0          # Thread-local total read count (I/O ops)
-        self.thread_write_total = 0         # Thread-local total write count (I/O ops)
-        self.thread_reads = {}              # Thread-local read count dict (buckets)
-        self.thread_writes = {}             # Thread-local write count dict (buckets)
-        self.thread_total_blocks = 0        # Thread-local total blocks accessed (lbas)
-        self.thread_max_bucket_hits = 0     # Thread-local maximum bucket hits (bucket hits)
+        ### Semaphores: These are the locks for the shared variables.  No-ops until share_state()
+        self.read_semaphore            = local_lock()        # Lock for the global read hit array
+        self.write_semaphore           = local_lock()        # Lock for the global write hit array
+        self.read_totals_semaphore     = local_lock()        # Lock for the global read totals
+        self.write_totals_semaphore    = local_lock()        # Lock for the global write totals
+        self.total_semaphore           = local_lock()        # Lock for the global I/O totals
+        self.total_blocks_semaphore    = local_lock()        # Lock for the global total LBA's accessed
+        self.files_to_lbas_semaphore   = local_lock()        # Lock for the global file->lba mapping hash
+        self.max_bucket_hits_semaphore = local_lock()        # Lock for the global maximum hits per bucket
+        self.bucket_to_files_semaphore1 = local_lock()       # Lock for the global bucket_to_files
+        self.bucket_to_files_semaphore2 = local_lock()       # Lock for the global bucket_to_files
+        self.term_semaphore            = local_lock()        # Lock for the global TERM
+        self.trace_files_semaphore     = local_lock()        # Lock for the global trace_files
+        self.file_hit_count_semaphore  = local_lock()        # Lock for the global file_hit_count
+
+        # Event analyzers.  Each keeps its own counts and folds them into the globals above when finalized
+        self.analyzer_names    = ['counts', 'timeline']      # Enabled analyzers (--analyzers, --mrc, --hotness)
+        self.analyzers         = []                          # Analyzer instances, started by parse_trace_files()
+        self.parse_workers     = 1                           # Worker processes parsing trace files.  0 is one per CPU (--parse_workers)
 
         # Globals
         self.file_hit_count    = {}         # Count of I/O's to each file
@@ -86,6 +105,15 @@ class global_variables:
         self.fdisk_file        = ""         # File capture of fdisk tool output
 
         self.top_files         = []         # Top files list
+        self.results           = {}         # Structured results for --json, filled in by the print routines
+        self.json_file         = None       # JSON results file (--json)
+        self.array_format      = 'npy'      # Bulk array format next to the JSON file: npy or csv (--array_format)
+        self.array_chunk       = 1 << 20    # Rows per chunk when streaming bulk arrays
+        self.bulk_arrays       = {}         # Extra bulk arrays for --json: name -> (columns, column names, dtype)
+        self.inputs            = []         # Input tarballs/aggregates for 'compare' and 'merge' modes
+        self.merge_output      = "merged.ioprof.npz" # Merged aggregates written by 'merge' mode (--merge_output)
+        self.merge_workers     = 0          # Worker processes for 'merge' mode.  0 is one per CPU
+        self.input             = ''         # Input this profile was loaded from
         self.device            = ''         # Device (e.g. /dev/sdb)
         self.device_str        = ''         # Device string (e.g. sdb for /dev/sdb)
 
@@ -93,24 +121,103 @@ class global_variables:
         self.KiB               = 1024       # 2^10
         self.MiB               = 1048576    # 2^20
         self.GiB               = 1073741824 # 2^30
+        self.TiB               = 1099511627776 # 2^40
 
         # Config settings
-        self.bucket_size        = 1 * self.MiB # Size of the bucket for totaling I/O counts (e.g. 1MB buckets)
+        self.bucket_size        = 1 * self.MiB # Size of the bucket for totaling I/O counts (e.g. 1MB buckets, -b)
         self.num_buckets        = 1            # Number of total buckets for this device
         self.timeout            = 3            # Seconds between each print
         self.runtime            = 0            # Runtime for 'live' and 'trace' modes
         self.live_itterations   = 0            # How many iterations for live mode.  Each iteration is 'timeout' seconds long
         self.sector_size        = 0            # Sector size (usually obtained with fdisk)
-        self.percent            = 0.020        # Histogram threshold for each level (e.g. 0.02% of total drive size)
+        self.percent            = 0.020        # Histogram threshold for each level as a fraction of the drive size (--percent, e.g. 2%)
+        self.save_bucket_size   = 64 * self.KiB # Finest bucket size saved by 'post' mode for 'report' (--save_bucket_size)
+        self.aggregates_version = 1            # Format version of the saved aggregates file
         self.total_capacity_gib = 0            # Total drive capacity
         self.mode               = ''           # Processing mode (live, trace, post)
         self.pdf                = False        # Generate a PDF report instead of a text report
+        self.stats_min_percent  = 0.5          # Only list I/O sizes with more than this % of the IOPS or bandwidth
+        self.stats_percentiles  = [50, 90, 99] # I/O size percentiles to report
         self.top_count_limit    = 10           # How many files to list in Top Files list (e.g. Top 10 files)
+        self.zipf_mle           = False        # Also estimate Zipfian theta by maximum likelihood (--zipf_mle)
+        self.zipf_confidence    = 95           # Confidence level of the Zipfian theta interval (%)
+        self.zipf_z             = 1.959964     # Normal quantile for zipf_confidence
+        self.zipf_theta_max     = 10.0         # Upper bound of the maximum likelihood search
+        self.mrc                = None         # LRU miss-ratio curve analyzer (--mrc)
+        self.mrc_block_size     = 4096         # Cache block size for the miss-ratio curve (--mrc_block_size)
+        self.mrc_rate           = 1.0          # Initial SHARDS sampling rate, lowered as the sample fills
+        self.mrc_samples        = 65536        # Maximum sampled blocks tracked (--mrc_samples)
+        self.batch_events       = 65536        # Parsed events per batch handed to the analyzers
+        self.blkparse_format    = " %d %a %S %n %T.%09t\n" # blkparse output: RWBS, action, sector, sectors, timestamp
+        self.event_regex        = "(\S+)\s+Q\s+(\S+)\s+(\S+)(?:\s+(\S+))?$" # Queued I/O line.  Older traces have no timestamp
+        self.codec              = 'gzip'       # Trace chunk format written by 'trace' and 'generate': gzip (blkparse text), zlib or lzma (--codec)
+        self.codec_block_events = 65536        # I/O's per independently compressed block of a zlib/lzma chunk
+        self.codec_threads      = 0            # Threads decoding the blocks of a chunk.  0 is one per CPU, 1 in parse workers (--codec_threads)
+        self.timeline           = None         # Per-interval I/O timeline (post mode)
+        self.interval           = 1.0          # Timeline resolution in seconds (--interval)
+        self.timeline_rows      = 60           # Maximum timeline rows printed.  The CSV has every interval
+        self.timeline_csv       = None         # Timeline CSV output file (--timeline_csv)
+        self.chunk_starts       = {}           # Start time of each trace chunk (timeline.<dev>)
+        self.hotness            = None         # Time-decayed hotness per bucket (--hotness)
+        self.half_life          = 60.0         # Seconds for a hit to lose half its hotness (--half_life)
+        self.hot_epoch          = 10.0         # Seconds between hot set snapshots (--hot_epoch)
+        self.hot_bucket_size    = None         # Bucket size of the hotness scores.  None is bucket_size
+        self.tiers              = []           # Tiering advisor configurations: (spec, tier list) per --tiers
+        self.tier_gap           = None         # Gaps of up to this many bytes between placed buckets are filled in (--tier_gap)
+        self.tier_gap_share     = 256          # Without --tier_gap, gaps of up to 1/tier_gap_share of each tier's capacity are filled
+        self.tier_rows          = 10           # LBA ranges printed per tier.  The --json output has all of them
+        self.gen_size           = 100 * self.GiB # Synthetic device size for 'generate' mode (--gen_size)
+        self.gen_iops           = 10000        # Synthetic I/O's per second (--gen_iops)
+        self.gen_read_percent   = 70.0         # Synthetic read share of the I/O's (--gen_read_percent)
+        self.gen_sizes          = [(4096, 60.0), (8192, 10.0), (65536, 20.0), (1048576, 10.0)] # Synthetic I/O sizes and their % (--gen_sizes)
+        self.gen_theta          = 1.0          # Zipfian theta of the synthetic region popularity (--gen_theta)
+        self.gen_region         = 1 * self.MiB # Size of the regions the Zipfian popularity is over (--gen_region)
+        self.gen_seq            = 0.0          # Fraction of synthetic I/O's that continue the previous one (--gen_seq)
+        self.gen_files          = 0            # Files in the synthetic file map.  0 is none (--gen_files)
+        self.gen_file_extents   = 4            # Extents per synthetic file
+        self.gen_seed           = 1            # Random seed for 'generate' mode (--gen_seed)
+        self.gen_batch          = 1 << 20      # Synthetic I/O's generated per batch
+        self.gen_zipf_head      = 1 << 16      # Hottest ranks sampled from the exact Zipfian CDF.  The rest use the integral
+        self.gen_workers        = 0            # Worker processes for 'generate' mode.  0 is one per CPU
+        self.bench_traces       = [            # Benchmark traces: generated once into bench_dir and reused
+            {'name': 'small',      'size': 16 * self.GiB, 'events': 1000000,   'theta': 1.0, 'region': self.MiB,       'files': 0},
+            {'name': 'events100m', 'size': self.TiB,      'events': 100000000, 'theta': 1.0, 'region': self.MiB,       'files': 0},
+            {'name': 'sparse15t',  'size': 15 * self.TiB, 'events': 10000000,  'theta': 0.6, 'region': 64 * self.KiB,  'files': 0},
+            {'name': 'filemap',    'size': 64 * self.GiB, 'events': 2000000,   'theta': 1.0, 'region': self.MiB,       'files': 100000}]
+        self.bench_names        = None         # Benchmark traces to run.  None is all of them (--bench_traces)
+        self.bench_dir          = "ioprof-bench" # Where the benchmark traces are generated (--bench_dir)
+        self.bench_scale        = 1.0          # Scale the benchmark trace event counts, e.g. 0.01 for a quick run (--bench_scale)
+        self.bench_seconds      = 60           # Runtime of each benchmark trace
+        self.bench_seq          = 0.2          # Fraction of sequential I/O's in the benchmark traces
+        self.bench_output       = "ioprof-bench.json" # Benchmark results (--bench_output)
+        self.baseline           = None         # Benchmark results to compare with (--baseline)
+        self.bench_tolerance    = 0.10         # Slowdown or peak RSS growth that counts as a regression
+        self.bench_min_wall     = 0.1          # Stages faster than this many seconds are not judged on speed
+        self.profiler           = None         # Pipeline stage profiler (--profile)
+        self.profile_dir        = None         # cProfile output per stage and process (--profile_dir)
+        self.profile_memory     = False        # Trace the peak memory of each stage with tracemalloc (--profile_memory)
+        self.memmap_dir         = None         # Keep the bucket counters in memmap files here (--memmap_dir)
+        self.memory_budget      = 1 << 30      # Heap for the memmap counter buffers and windows (--memory_budget)
+        self.memmap_shares      = 8            # Memmap counters open at once (4 parsed, 4 re-bucketed)
+        self.sim_policies       = ['lru', 'lfu', 'arc', '2q'] # Cache policies to simulate (--policies)
+        self.sim_cache_sizes    = []           # Cache sizes to simulate in bytes (--cache_sizes)
+        self.sim_cache_percents = [0.1, 1, 5, 10] # Default cache sizes as % of the device capacity
+        self.sim_block_size     = 4096         # Cache block size for the simulator (--sim_block_size)
+        self.sims               = []           # Cache simulators after the replay
         self.thread_count       = 0            # Thread Count
         self.cpu_affinity       = 0            # Tie each thread to a CPU for load balancing
         self.thread_max         = 32           # Max thread cout
         self.buffer_size        = 1024         # blktrace buffer size
         self.buffer_count       = 8            # blktrace buffer count
+        self.trace_converters   = 2            # Segments converted (blkparse + --codec) at once while tracing
+        self.trace_queue        = 4            # Recorded segments waiting for a converter before the capture waits
+        self.trace_grace        = 10           # Seconds a blktrace segment may run past its window before it is stopped
+        self.convert_timeout    = 600          # Seconds one segment's blkparse + --codec may take
+        self.collector          = None         # (host, port) 'trace' mode streams to, or 'collect' mode listens on (--collector)
+        self.collect_post       = False        # 'collect' mode runs 'post' on the trace once it is in (--collect_post)
+        self.collect_retries    = 10           # Reconnects to the collector before 'trace' mode gives up
+        self.collect_retry_wait = 3            # Seconds between reconnects
+        self.collect_timeout    = 60           # Seconds to connect to the collector or for it to acknowledge a file
 
         # Gnuplot settings
         self.x_width            = 800          # gnuplot x-width
@@ -136,12 +243,40 @@ class global_variables:
         self.vpc = 1
         self.cap = 0
         self.rate = 0
-
-        self.mount_point        = ""
-        self.extents            = []
-        self.files              = []
+        self.heatmap_width  = 64            # Heatmap cells per row
+        self.heatmap_height = 16            # Heatmap rows
+        self.heatmap_shades = " .:-=+*#%@"  # Cell shading from cold to hot
+
+        ### File Mapping Globals
+        self.mount_point           = ""     # Mountpoint of the traced device
+        self.mount_type            = ""     # Filesystem type (e.g. ext4)
+        self.hot_io_percent        = 90.0   # Map files in the hottest buckets holding this % of bucket hits
+        self.hot_set_percent       = 90.0   # Read/write hot sets: the hottest buckets holding this % of the hits (--hot_percent)
+        self.hot_bucket_limit      = 65536  # Maximum number of hot buckets to map to files
+        self.hot_blocks_per_bucket = 64     # Filesystem blocks sampled per hot bucket (debugfs icheck)
+        self.debugfs_args          = 512    # Block/inode arguments per debugfs icheck/ncheck request
+        self.debugfs_batch         = 256    # Requests per debugfs invocation
+        self.fiemap_extents        = 256    # Extents fetched per FIEMAP ioctl
 # global_variables
 
+### Move the shared totals, hashes and locks into shared memory and a manager process for modes that
+### hand work to worker processes.  Nothing else needs them, so --help, 'trace' and the single process
+### modes never start a manager server
+def share_state(g):
+    if g.manager is not None:
+        return
+    g.manager = Manager()
+    for name in ('io_total', 'read_total', 'write_total', 'bucket_hits_total', 'total_blocks', 'max_bucket_hits', 'term'):
+        setattr(g, name, Value('L', getattr(g, name).value))
+    for name in ('r_totals', 'w_totals', 'files_to_lbas', 'bucket_to_files'):
+        shared = g.manager.dict()
+        shared.update(getattr(g, name))
+        setattr(g, name, shared)
+    for name in [n for n in vars(g) if n.endswith('_semaphore') or n.startswith('bucket_to_files_semaphore')]:
+        setattr(g, name, g.manager.Lock())
+    return
+# share_state (DONE)
+
 ### Print usage
 def usage(g):
     name = os.path.basename(__file__)
@@ -151,17 +286,87 @@ def usage(g):
     print (name, end='')
     logger.info("\n\nUsage:")
     logger.info(name + " -m trace -d <dev> -r <runtime> [-v] [-f] # run trace for post-processing later")
+    logger.info(name + " -m collect --collector [host]:port [-t <dev.tar>] [--collect_post] # receive a trace streamed by 'trace' mode")
     logger.info(name + " -m post  -t <dev.tar file>     [-v] [-p]   # post-process mode")
+    logger.info(name + " -m report -t <dev.ioprof.npz> [-b <size>] [--percent <p>] # re-bucket the results saved by 'post' mode")
+    logger.info(name + " -m compare <before.tar|npz> <after.tar|npz> [-b <size>] # what got hotter or colder between two traces")
+    logger.info(name + " -m merge <dev.tar|npz> ... [-b <size>] [--merge_output <f>] # one report over many traces of the same layout")
+    logger.info(name + " -m generate -d <dev> -r <runtime> [--gen_iops <n>] [--gen_theta <t>] ... # synthetic trace for 'post' mode")
+    logger.info(name + " -m benchmark [--bench_scale <f>] [--baseline <results.json>] # 'post' throughput and memory over generated traces")
     logger.info(name + " -m live  -d <dev> -r <runtime> [-v]        # live mode")
+    logger.info(name + " -m simulate -t <dev.tar file> [--policies lru,arc] [--cache_sizes 1G,4G] # cache policy simulator")
     logger.info("\nCommand Line Arguments:")
     logger.info("-d <dev>            : The device to trace (e.g. /dev/sdb).  You can run traces to multiple devices (e.g. /dev/sda and /dev/sdb)")
     logger.info("                      at the same time, but please only run 1 trace to a single device (e.g. /dev/sdb) at a time")
     logger.info("-r <runtime>        : Runtime (seconds) for tracing")
     logger.info("-t <dev.tar file>   : A .tar file is created during the 'trace' phase.  Please use this file for the 'post' phase")
     logger.info("                      You can offload this file and run the 'post' phase on another system.")
+    logger.info("                      In 'report' mode this is the <dev>.ioprof.npz file saved next to the tarball by 'post' mode")
+    logger.info("-b <size>           : (OPTIONAL) Bucket size for totaling I/O (e.g. 4K, 64K, 1M).  Default is 1M.  The minimum is the sector size.")
+    logger.info("                       Bucket counts are sparse, so memory scales with the buckets touched rather than the device size")
+    logger.info("--percent <p>       : (OPTIONAL) Size of each histogram row as a percent of the device.  Default is 2")
+    logger.info("--save_bucket_size <s>: (OPTIONAL) Finest bucket size 'post' mode saves for 'report' mode.  Default is 64K")
+    logger.info("                       'report' mode can re-bucket to any multiple of it.  Smaller sizes take more memory and disk")
+    logger.info("--interval <sec>    : (OPTIONAL) Resolution of the I/O timeline (IOPS, MB/s, read %, average size).  Default is 1 second")
+    logger.info("                       Traces captured before timestamps were recorded have no timeline")
+    logger.info("--timeline_csv <f>  : (OPTIONAL) Write every timeline interval to a CSV file")
+    logger.info("--hot_percent <p>   : (OPTIONAL) The read and write hot sets are the hottest buckets holding this % of each direction's I/O.  Default is 90")
+    logger.info("--hotness           : (OPTIONAL) Rank the regions that are hot at the end of the trace by exponentially decayed hits")
+    logger.info("                       and show how the hot set moved over the trace.  Needs a trace with timestamps.  8 bytes per bucket")
+    logger.info("--half_life <sec>   : (OPTIONAL) Seconds for a hit to lose half its hotness.  Default is 60")
+    logger.info("--hot_epoch <sec>   : (OPTIONAL) Seconds between hot set snapshots.  Default is 10")
+    logger.info("--tiers <list>      : (OPTIONAL) Tiering advisor: name:capacity:latency for each tier, fastest first (e.g. nvme:100G:1,ssd:5%:4,hdd:rest:20).")
+    logger.info("                       Capacity is a size, a percent of the device or 'rest', latency is relative.  Prints the LBA ranges for each")
+    logger.info("                       tier and the I/O it would serve.  Repeat --tiers to sweep many configurations")
+    logger.info("--tier_gap <s>      : (OPTIONAL) Fill in gaps of up to this size between the ranges of a tier, so it gets fewer, larger")
+    logger.info("                       ranges at the cost of some capacity.  Default is 1/256 of each tier's capacity")
+    logger.info("--json <file>       : (OPTIONAL) Write the results as JSON.  Per-bucket counts and the timeline go to <file>.buckets.npy")
+    logger.info("                       and <file>.timeline.npy next to it")
+    logger.info("--array_format <f>  : (OPTIONAL) Format of the --json bulk arrays: npy or csv.  Default is npy")
+    logger.info("--profile           : (OPTIONAL) Print the wall and CPU time and events of each stage (untar, decompress, parse, merge,")
+    logger.info("                       file mapping, analysis, report; capture (blktrace and blkparse overlap) and tar in 'trace' mode)")
+    logger.info("--profile_memory    : (OPTIONAL) With --profile, also trace the peak memory of each stage.  tracemalloc slows the run, often")
+    logger.info("                       many times over, so the times are no longer representative")
+    logger.info("--profile_dir <dir> : (OPTIONAL) With --profile, also write a cProfile <stage>.<pid>.prof per stage and worker process")
+    logger.info("--memmap_dir <dir>  : (OPTIONAL) Keep the bucket counters in memory-mapped files here, for devices whose buckets do not fit in RAM")
+    logger.info("--memory_budget <s>: (OPTIONAL) Heap used by the --memmap_dir counters.  Default is 1G")
     logger.info("-v                  : (OPTIONAL) Print verbose messages.")
-    logger.info("-f                  : (OPTIONAL) Map all files on the device specified by -d <dev> during 'trace' phase to their LBA ranges.")
-    logger.info("                       This is useful for determining the most fequently accessed files, but may take a while on really large filesystems")
+    logger.info("-f                  : (OPTIONAL) Map the files in the hottest regions of the trace to their LBA ranges at the end of the 'trace' phase.")
+    logger.info("                       This is useful for determining the most fequently accessed files.  Only the hot data is mapped, so it scales with the hot set")
+    logger.info("--zipf_mle          : (OPTIONAL) Also estimate Zipfian theta by maximum likelihood in 'post' mode")
+    logger.info("--mrc               : (OPTIONAL) Compute an LRU hit ratio vs cache size curve in 'post' mode (sampled reuse distance)")
+    logger.info("--mrc_block_size <s>: (OPTIONAL) Cache block size for --mrc (e.g. 4K, 64K or bucket).  Default is 4K")
+    logger.info("--mrc_samples <n>   : (OPTIONAL) Maximum sampled blocks for --mrc.  Bounds memory.  Default is 65536")
+    logger.info("--analyzers <list>  : (OPTIONAL) More analyzers for the same pass over the trace in 'post' mode: mrc,hotness,cachesim")
+    logger.info("                      (cachesim takes the 'simulate' mode options).  Every analyzer shares one decompress and parse")
+    logger.info("--parse_workers <n> : (OPTIONAL) Parse the trace files in this many processes, 0 is one per CPU.  mrc, hotness and")
+    logger.info("                      cachesim need the events in order, so they parse in one.  Default is 1")
+    logger.info("--codec <c>         : (OPTIONAL) Trace chunk format for 'trace' and 'generate' modes: gzip (blkparse text), or zlib or lzma")
+    logger.info("                      (delta coded binary blocks, much smaller and faster to parse).  Default is gzip")
+    logger.info("--codec_threads <n> : (OPTIONAL) Threads decoding each zlib/lzma chunk in 'post' mode.  Default is one per CPU")
+    logger.info("--collector <h:p>   : (OPTIONAL) 'trace' mode streams the segments to a 'collect' mode ioprof at host:port instead of")
+    logger.info("                      writing the tarball locally, reconnecting if the link drops.  'collect' mode listens on [host]:port")
+    logger.info("--collect_post      : (OPTIONAL) 'collect' mode runs the 'post' report on the trace once it is in")
+    logger.info("--policies <list>   : (OPTIONAL) Cache policies for 'simulate' mode: lru,lfu,arc,2q.  Default is all of them")
+    logger.info("--cache_sizes <list>: (OPTIONAL) Cache sizes for 'simulate' mode (e.g. 1G,4G,16G).  Default is 0.1%,1%,5%,10% of the device")
+    logger.info("--sim_block_size <s>: (OPTIONAL) Cache block size for 'simulate' mode.  Default is 4K")
+    logger.info("'generate' mode writes <dev>.tar (or -t <file>) like 'trace' mode would, without root, blktrace or the device:")
+    logger.info("--gen_size <s>      : Device size.  Default is 100G")
+    logger.info("--gen_sector_size <s>: Sector size.  Default is 512")
+    logger.info("--gen_iops <n>      : I/O's per second, Poisson arrivals.  Default is 10000")
+    logger.info("--gen_read_percent <p>: Percent of the I/O's that are reads.  Default is 70")
+    logger.info("--gen_sizes <list>  : I/O sizes and their percent of the I/O's.  Default is 4K:60,8K:10,64K:20,1M:10")
+    logger.info("--gen_theta <t>     : Zipfian theta of the region popularity (0 is uniform).  Default is 1.0")
+    logger.info("--gen_region <s>    : Size of the regions the popularity is over.  Default is 1M, so -b 1M recovers --gen_theta")
+    logger.info("--gen_seq <p>       : Percent of the I/O's that continue the previous one (sequential streams).  Default is 0")
+    logger.info("--gen_files <n>     : Add a file map of this many files for the top files report.  Default is 0")
+    logger.info("--gen_seed <n>      : Random seed.  Default is 1")
+    logger.info("'benchmark' mode runs 'post' stage by stage (ingest, parse, file_to_buckets, print_results, stats) over generated traces:")
+    logger.info("--bench_traces <list>: Traces to run: small,events100m,sparse15t,filemap.  Default is all of them")
+    logger.info("--bench_scale <f>   : Scale the trace event counts, e.g. 0.01 for a quick run.  Default is 1")
+    logger.info("--bench_dir <dir>   : Where the traces are generated and kept for the next run.  Default is ioprof-bench")
+    logger.info("--bench_output <f>  : Results file (wall and CPU seconds, events/sec and peak RSS per stage).  Default is ioprof-bench.json")
+    logger.info("--baseline <f>      : Results of an earlier run.  Exits 1 if a stage got 10% slower or its peak RSS 10% bigger")
     logger.info("-p                  : (OPTIONAL) Generate a .pdf output file in addition to STDOUT.  This requires 'pdflatex', 'gnuplot' and 'terminal png'")
     logger.info("                       to be installed.")
     sys.exit(-1)
@@ -190,6 +395,130 @@ def set_globals(g, command_args):
     g.verbose = command_args.verbose
     g.pdf = command_args.pdf
     g.debug = command_args.debug
+    g.zipf_mle = command_args.zipf_mle
+    if command_args.bucket_size is not None:
+        g.bucket_size = parse_size(g, command_args.bucket_size)
+        if g.bucket_size is None or g.bucket_size < 512:
+            logger.info("ERROR: invalid bucket size " + command_args.bucket_size + ".  The minimum is the sector size")
+            usage(g)
+    if command_args.percent is not None:
+        g.percent = float(command_args.percent) / 100.0
+        if g.percent <= 0 or g.percent > 1:
+            logger.info("ERROR: invalid --percent " + command_args.percent)
+            usage(g)
+    if command_args.save_bucket_size is not None:
+        g.save_bucket_size = parse_size(g, command_args.save_bucket_size)
+        if g.save_bucket_size is None or g.save_bucket_size < 512:
+            logger.info("ERROR: invalid --save_bucket_size " + command_args.save_bucket_size)
+            usage(g)
+    if command_args.interval is not None:
+        g.interval = float(command_args.interval)
+        if g.interval <= 0:
+            logger.info("ERROR: invalid --interval " + command_args.interval)
+            usage(g)
+    g.timeline_csv = command_args.timeline_csv
+    g.json_file = command_args.json
+    if command_args.hot_percent is not None:
+        g.hot_set_percent = float(command_args.hot_percent)
+        if g.hot_set_percent <= 0 or g.hot_set_percent > 100:
+            logger.info("ERROR: invalid --hot_percent " + command_args.hot_percent)
+            usage(g)
+    for spec in command_args.tiers or []:
+        tiers = parse_tiers(g, spec)
+        if tiers is None:
+            logger.info("ERROR: invalid --tiers " + spec + ".  Use name:capacity:latency for each tier, fastest first (e.g. nvme:100G:1,hdd:rest:20)")
+            usage(g)
+        g.tiers.append((spec, tiers))
+    if command_args.tier_gap is not None:
+        g.tier_gap = parse_size(g, command_args.tier_gap)
+        if g.tier_gap is None:
+            logger.info("ERROR: invalid --tier_gap " + command_args.tier_gap)
+            usage(g)
+    if command_args.array_format is not None:
+        g.array_format = command_args.array_format.lower()
+        if g.array_format not in ('npy', 'csv'):
+            logger.info("ERROR: invalid --array_format " + command_args.array_format + ".  Choose npy or csv")
+            usage(g)
+    g.report_bucket_size = g.bucket_size if command_args.bucket_size is not None else None
+    g.report_interval = g.interval if command_args.interval is not None else None
+    if command_args.hotness:
+        g.analyzer_names.append('hotness')
+    if command_args.half_life is not None:
+        g.half_life = float(command_args.half_life)
+    if command_args.hot_epoch is not None:
+        g.hot_epoch = float(command_args.hot_epoch)
+    if g.half_life <= 0 or g.hot_epoch <= 0:
+        logger.info("ERROR: --half_life and --hot_epoch must be positive")
+        usage(g)
+    if command_args.mrc:
+        g.analyzer_names.append('mrc')
+    if command_args.mrc_block_size is not None:
+        if command_args.mrc_block_size == "bucket":
+            g.mrc_block_size = g.bucket_size
+        else:
+            g.mrc_block_size = parse_size(g, command_args.mrc_block_size)
+            if g.mrc_block_size is None or g.mrc_block_size == 0:
+                logger.info("ERROR: invalid --mrc_block_size " + command_args.mrc_block_size)
+                usage(g)
+    if command_args.mrc_samples is not None:
+        g.mrc_samples = int(command_args.mrc_samples)
+    # Cache simulator settings, for 'simulate' mode and --analyzers cachesim
+    if command_args.policies is not None:
+        g.sim_policies = [p.strip().lower() for p in command_args.policies.split(",") if p.strip() != '']
+        for policy in g.sim_policies:
+            if policy not in cache_policies:
+                logger.info("ERROR: unknown cache policy " + policy + ".  Choose from " + ",".join(sorted(cache_policies)))
+                usage(g)
+    if command_args.cache_sizes is not None:
+        for size in command_args.cache_sizes.split(","):
+            g.sim_cache_sizes.append(parse_size(g, size))
+            if g.sim_cache_sizes[-1] is None or g.sim_cache_sizes[-1] == 0:
+                logger.info("ERROR: invalid cache size " + size)
+                usage(g)
+    if command_args.sim_block_size is not None:
+        g.sim_block_size = parse_size(g, command_args.sim_block_size)
+        if g.sim_block_size is None or g.sim_block_size == 0:
+            logger.info("ERROR: invalid --sim_block_size " + command_args.sim_block_size)
+            usage(g)
+    if command_args.analyzers is not None:
+        for name in command_args.analyzers.split(","):
+            if name not in event_analyzers:
+                logger.info("ERROR: unknown analyzer " + name + ".  Choose from " + ",".join(sorted(event_analyzers)))
+                usage(g)
+            if name not in g.analyzer_names:
+                g.analyzer_names.append(name)
+    if command_args.parse_workers is not None:
+        g.parse_workers = command_args.parse_workers
+        if g.parse_workers < 0:
+            logger.info("ERROR: --parse_workers must be 0 or more")
+            usage(g)
+    if command_args.codec is not None:
+        g.codec = command_args.codec.lower()
+        if g.codec != 'gzip' and g.codec not in codec_methods:
+            logger.info("ERROR: invalid --codec " + command_args.codec + ".  Choose gzip, zlib or lzma")
+            usage(g)
+    if command_args.collector is not None:
+        g.collector = parse_collector(command_args.collector)
+        if g.collector is None or (g.mode == 'trace' and g.collector[0] == ''):
+            logger.info("ERROR: invalid --collector " + command_args.collector + ".  Use host:port ('collect' mode can listen on :port)")
+            usage(g)
+    g.collect_post = command_args.collect_post
+    if command_args.codec_threads is not None:
+        g.codec_threads = command_args.codec_threads
+        if g.codec_threads < 0:
+            logger.info("ERROR: --codec_threads must be 0 or more")
+            usage(g)
+    if command_args.memmap_dir is not None:
+        g.memmap_dir = command_args.memmap_dir
+    if command_args.memory_budget is not None:
+        g.memory_budget = parse_size(g, command_args.memory_budget)
+        if g.memory_budget is None or g.memory_budget <= 0:
+            logger.info("ERROR: --memory_budget must be a size, e.g. 256M or 2G")
+            usage(g)
+    if command_args.profile or command_args.profile_dir is not None or command_args.profile_memory:
+        g.profile_dir = command_args.profile_dir
+        g.profile_memory = command_args.profile_memory
+        g.profiler = stage_profiler(g.profile_dir, g.profile_memory)
     if g.debug is True:
         logger.setLevel(logging.DEBUG)
 
@@ -215,9 +544,10 @@ def set_globals(g, command_args):
             usage(g)
     elif g.mode == 'post':
         logger.warning( "POST")
+        check_post_prereqs(g)
         if g.tarfile == '':
             usage(g)
-        match = re.search("(\S+).tar", g.tarfile)
+        match = re.search("(\S+).tar", os.path.basename(g.tarfile))
         try:
             logger.debug(match.group(1))
             g.device_str = match.group(1)
@@ -232,6 +562,103 @@ def set_globals(g, command_args):
         g.fdisk_file = "fdisk." + g.device_str
         logger.debug( "fdisk_file: " + g.fdisk_file)
         g.cleanup.append(g.fdisk_file)
+    elif g.mode == 'report':
+        logger.warning( "REPORT")
+        if g.tarfile is None or g.tarfile == '':
+            usage(g)
+        check_post_prereqs(g)
+    elif g.mode == 'compare':
+        logger.warning( "COMPARE")
+        check_post_prereqs(g)
+        g.inputs = ([g.tarfile] if g.tarfile else []) + command_args.inputs
+        if len(g.inputs) != 2:
+            logger.info("ERROR: 'compare' mode needs two inputs (trace tarballs or .ioprof.npz files)")
+            usage(g)
+    elif g.mode == 'merge':
+        logger.warning( "MERGE")
+        check_post_prereqs(g)
+        g.inputs = ([g.tarfile] if g.tarfile else []) + command_args.inputs
+        if len(g.inputs) == 0:
+            logger.info("ERROR: 'merge' mode needs input tarballs or .ioprof.npz files")
+            usage(g)
+        if command_args.merge_output is not None:
+            g.merge_output = command_args.merge_output
+    elif g.mode == 'simulate':
+        logger.warning( "SIMULATE")
+        check_post_prereqs(g)
+        if g.tarfile is None or g.tarfile == '':
+            usage(g)
+        match = re.search("(\S+).tar", os.path.basename(g.tarfile))
+        try:
+            g.device_str = match.group(1)
+        except:
+            logger.info("ERROR: invalid tar file" + g.tarfile)
+            usage(g)
+        g.fdisk_file = "fdisk." + g.device_str
+        g.cleanup.append(g.fdisk_file)
+    elif g.mode == 'generate':
+        logger.warning( "GENERATE")
+        if g.device is None or g.runtime is None:
+            usage(g)
+        match = re.search("^/dev/(\w+)$", g.device)
+        if match is None:
+            logger.info("ERROR: invalid device name " + g.device + " (e.g. /dev/sdb)")
+            usage(g)
+        g.device_str = match.group(1)
+        if not import_numpy():
+            logger.info("ERROR: numpy not installed.  'generate' mode needs numpy.  Please install numpy (e.g. pip install numpy)")
+            sys.exit(1)
+        if g.tarfile and not g.tarfile.endswith(".tar"):
+            logger.info("ERROR: -t must name a .tar file, which 'post' reads the trace back from")
+            usage(g)
+        try:
+            if command_args.gen_size is not None:
+                g.gen_size = parse_size(g, command_args.gen_size)
+            g.sector_size = parse_size(g, command_args.gen_sector_size) if command_args.gen_sector_size is not None else 512
+            if command_args.gen_region is not None:
+                g.gen_region = parse_size(g, command_args.gen_region)
+            if command_args.gen_sizes is not None:
+                g.gen_sizes = [(parse_size(g, size), float(percent)) for (size, percent) in [entry.split(":") for entry in command_args.gen_sizes.split(",")]]
+            for (name, cast) in (('gen_iops', int), ('gen_read_percent', float), ('gen_theta', float), ('gen_files', int), ('gen_seed', int)):
+                if getattr(command_args, name) is not None:
+                    setattr(g, name, cast(getattr(command_args, name)))
+            if command_args.gen_seq is not None:
+                g.gen_seq = float(command_args.gen_seq) / 100.0
+        except (TypeError, ValueError):
+            logger.info("ERROR: invalid 'generate' option")
+            usage(g)
+        if (g.sector_size is None or g.sector_size < 512 or g.gen_size is None or g.gen_size < g.sector_size or g.gen_region is None or g.gen_region < g.sector_size
+            or g.gen_iops <= 0 or not 0 <= g.gen_read_percent <= 100 or g.gen_theta < 0 or not 0 <= g.gen_seq <= 1 or g.gen_files < 0
+            or len(g.gen_sizes) == 0 or any(s is None or s < g.sector_size or s % g.sector_size or p < 0 for (s, p) in g.gen_sizes) or sum(p for (s, p) in g.gen_sizes) <= 0):
+            logger.info("ERROR: invalid 'generate' option.  Sizes must be multiples of the sector size and percents 0-100")
+            usage(g)
+        g.total_lbas = g.gen_size // g.sector_size
+    elif g.mode == 'benchmark':
+        logger.warning( "BENCHMARK")
+        check_post_prereqs(g)
+        if command_args.bench_traces is not None:
+            g.bench_names = [t.strip() for t in command_args.bench_traces.split(",") if t.strip() != '']
+            for name in g.bench_names:
+                if name not in [t['name'] for t in g.bench_traces]:
+                    logger.info("ERROR: unknown benchmark trace " + name + ".  Choose from " + ",".join(t['name'] for t in g.bench_traces))
+                    usage(g)
+        if command_args.bench_scale is not None:
+            g.bench_scale = float(command_args.bench_scale)
+            if g.bench_scale <= 0:
+                logger.info("ERROR: invalid --bench_scale " + command_args.bench_scale)
+                usage(g)
+        if command_args.bench_dir is not None:
+            g.bench_dir = command_args.bench_dir
+        if command_args.bench_output is not None:
+            g.bench_output = command_args.bench_output
+        g.baseline = command_args.baseline
+    elif g.mode == 'collect':
+        logger.warning( "COLLECT")
+        if g.collector is None:
+            logger.info("ERROR: 'collect' mode needs --collector [host]:port to listen on")
+            usage(g)
+        if g.collect_post:
+            check_post_prereqs(g)
     elif g.mode == 'trace':
         logger.warning( "TRACE")
         check_trace_prereqs(g)
@@ -266,25 +693,71 @@ def get_arguments(argv=None):
         Parsed arguments and build request flag or exception otherwise
     """
     if argv is None:
-        argv = sys.argv
-    else:
-        sys.argv.extend(argv)
+        argv = sys.argv[1:]
 
     try:
         parser = ArgumentParser()
 
         # Full path log file name
-        parser.add_argument("-m", "--mode", type=str, help="Mode (trace, post, live)")
+        parser.add_argument("-m", "--mode", type=str, help="Mode (trace, collect, post, report, compare, merge, generate, benchmark, live, simulate)")
         parser.add_argument("-d", "--device", type=str, help="Device to trace, (i.e. -d /dev/nvme0n1)")
         parser.add_argument("-t", "--tarfile", type=str, help="Tarfile, output from -m trace")
         parser.add_argument("-r", "--runtime", type=str, help="Runtime in seconds")
+        parser.add_argument("-b", "--bucket_size", type=str, help="Bucket size, e.g. 4K, 64K or 1M (default 1M)")
+        parser.add_argument("--percent", type=str, help="Histogram row size as a percent of the device (default 2)")
+        parser.add_argument("--save_bucket_size", type=str, help="Finest bucket size saved by post for report, e.g. 4K (default 64K)")
+        parser.add_argument("--interval", type=str, help="I/O timeline resolution in seconds (default 1)")
+        parser.add_argument("--timeline_csv", type=str, help="Write the I/O timeline to this CSV file")
+        parser.add_argument("--hot_percent", type=str, help="Read/write hot sets hold this percent of each direction's hits (default 90)")
+        parser.add_argument("--hotness", action='store_true', default=False, help='Time-decayed hotness per bucket and hot set migration (post)')
+        parser.add_argument("--half_life", type=str, help="Hotness half-life in seconds (default 60)")
+        parser.add_argument("--hot_epoch", type=str, help="Seconds between hot set snapshots (default 10)")
+        parser.add_argument("--tiers", type=str, action='append', help="Tiering advisor tiers, fastest first, e.g. nvme:100G:1,hdd:rest:20.  Repeat for a sweep")
+        parser.add_argument("--tier_gap", type=str, help="Gaps filled in between the ranges of a tier, e.g. 16M (default 1/256 of the tier)")
+        parser.add_argument("--json", type=str, help="Write the results to this JSON file")
+        parser.add_argument("--array_format", type=str, help="Format of the bulk arrays written with --json: npy or csv (default npy)")
+        parser.add_argument("inputs", nargs='*', help="More input tarballs or .ioprof.npz files (compare, merge)")
+        parser.add_argument("--merge_output", type=str, help="Merged aggregates file written by merge (default merged.ioprof.npz)")
+        parser.add_argument("--profile", action='store_true', default=False, help='Profile each pipeline stage (wall/CPU time, events)')
+        parser.add_argument("--profile_memory", action='store_true', default=False, help='Also trace the peak memory of each stage (slow)')
+        parser.add_argument("--profile_dir", type=str, help="Write a cProfile .prof per stage and worker process to this directory")
+        parser.add_argument("--memmap_dir", type=str, help="Keep the bucket counters in memory-mapped files in this directory")
+        parser.add_argument("--memory_budget", type=str, help="Heap for the memory-mapped counters, e.g. 512M")
         parser.add_argument("--trace_files", "--f",  action='store_true', default=False, help='Trace Files')
         parser.add_argument("--verbose", "--v", action='store_true',default=False, help='Print verbose')
         parser.add_argument( "--pdf", "--p", action='store_true',default=False, help='Output PDF')
         parser.add_argument("--debug", "--x", action='store_true',default=False, help='Debug mode')
+        parser.add_argument("--zipf_mle", action='store_true', default=False, help='Also estimate Zipfian theta by maximum likelihood (post)')
+        parser.add_argument("--mrc", action='store_true', default=False, help='Compute an LRU miss-ratio curve (post)')
+        parser.add_argument("--mrc_block_size", type=str, help='Miss-ratio curve block size, e.g. 4K or bucket (default 4K)')
+        parser.add_argument("--mrc_samples", type=str, help='Maximum sampled blocks for the miss-ratio curve (default 65536)')
+        parser.add_argument("--analyzers", type=str, help='More analyzers for the same pass over the trace, e.g. mrc,cachesim (post)')
+        parser.add_argument("--parse_workers", type=int, help='Processes parsing the trace files, 0 is one per CPU (default 1)')
+        parser.add_argument("--codec", type=str, help='Trace chunk format: gzip, zlib or lzma (trace, generate; default gzip)')
+        parser.add_argument("--codec_threads", type=int, help='Threads decoding each zlib/lzma trace chunk (default one per CPU)')
+        parser.add_argument("--collector", type=str, help="host:port to stream the trace to (trace), or [host]:port to listen on (collect)")
+        parser.add_argument("--collect_post", action='store_true', default=False, help="Run 'post' on the trace once it is in (collect)")
+        parser.add_argument("--gen_size", type=str, help="Synthetic device size, e.g. 100G (generate)")
+        parser.add_argument("--gen_sector_size", type=str, help="Synthetic sector size (default 512, generate)")
+        parser.add_argument("--gen_iops", type=str, help="Synthetic I/O's per second (default 10000, generate)")
+        parser.add_argument("--gen_read_percent", type=str, help="Synthetic read percent (default 70, generate)")
+        parser.add_argument("--gen_sizes", type=str, help="Synthetic I/O sizes and percents, e.g. 4K:70,64K:30 (generate)")
+        parser.add_argument("--gen_theta", type=str, help="Zipfian theta of the synthetic regions (default 1.0, generate)")
+        parser.add_argument("--gen_region", type=str, help="Size of the synthetic Zipfian regions (default 1M, generate)")
+        parser.add_argument("--gen_seq", type=str, help="Percent of synthetic I/O's that are sequential (default 0, generate)")
+        parser.add_argument("--gen_files", type=str, help="Files in the synthetic file map (default 0, generate)")
+        parser.add_argument("--gen_seed", type=str, help="Random seed (default 1, generate)")
+        parser.add_argument("--bench_traces", type=str, help="Benchmark traces to run, e.g. small,filemap (benchmark)")
+        parser.add_argument("--bench_scale", type=str, help="Scale the benchmark event counts (default 1, benchmark)")
+        parser.add_argument("--bench_dir", type=str, help="Directory for the generated benchmark traces (benchmark)")
+        parser.add_argument("--bench_output", type=str, help="Benchmark results file (default ioprof-bench.json, benchmark)")
+        parser.add_argument("--baseline", type=str, help="Earlier benchmark results to compare with (benchmark)")
+        parser.add_argument("--policies", type=str, help='Cache policies to simulate, e.g. lru,lfu,arc,2q (simulate)')
+        parser.add_argument("--cache_sizes", type=str, help='Cache sizes to simulate, e.g. 1G,4G,16G (simulate)')
+        parser.add_argument("--sim_block_size", type=str, help='Cache block size for the simulator, e.g. 4K (simulate)')
         
         # Process arguments
-        return parser.parse_args()
+        return parser.parse_args(argv)
 
     except BaseException as base_ex:
         if str(base_ex) != "0":
@@ -321,6 +794,34 @@ def check_pdf_prereqs(g):
     return
 # check_pdf_prereqs (DONE)
 
+### Import numpy into the module.  Returns False when it is not installed
+def import_numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+        np = numpy
+    return True
+# import_numpy (DONE)
+
+### Import asyncio into the module, for the trace controller and the collector
+def import_asyncio():
+    global asyncio
+    if asyncio is None:
+        import asyncio as module
+        asyncio = module
+# import_asyncio (DONE)
+
+### Check prereqs for post-processing
+def check_post_prereqs(g):
+    logger.debug( "check_post_prereqs")
+    if not import_numpy():
+        logger.info("ERROR: numpy not installed.  Please install numpy (e.g. pip install numpy) or offload the trace file for processing.")
+        sys.exit(1)
+# check_post_prereqs (DONE)
+
 ### Check prereqs for blktrace
 def check_trace_prereqs(g):
     logger.debug( "check_trace_prereqs")
@@ -336,6 +837,9 @@ def check_trace_prereqs(g):
         sys.exit(1)
     else:
         logger.debug( "which blkparse: rc=" + str(rc))
+    if g.codec != 'gzip' and not import_numpy():
+        logger.info("ERROR: numpy not installed.  --codec " + g.codec + " needs numpy.  Please install numpy or use --codec gzip")
+        sys.exit(1)
 # check_trace_prereqs (DONE)
 
 ### Check if debugfs is mounted
@@ -354,7 +858,7 @@ def mount_debugfs(g):
 
 ### Translate LBA to Bucket
 def lba_to_bucket(g, lba):
-    bucket = (int(lba) * int(g.sector_size)) / int(g.bucket_size)
+    bucket = (int(lba) * int(g.sector_size)) // int(g.bucket_size)
     if bucket > g.num_buckets:
         #printf("ERROR: lba=%d bucket=%d greater than num_buckets=%d\n", int(lba), bucket, g.num_buckets)
         bucket = g.num_buckets - 1
@@ -363,140 +867,273 @@ def lba_to_bucket(g, lba):
 
 ### Translate Bucket to LBA
 def bucket_to_lba(g, bucket):
-    lba = (bucket * g.bucket_size) / g.sector_size
+    lba = (bucket * g.bucket_size) // g.sector_size
     return lba
 # bucket_to_lba (DONE)
 
+### Find the mountpoint and filesystem type of a device
+def device_mount(g):
+    device = os.path.realpath(g.device)
+    try:
+        with open("/proc/mounts", "r") as fo:
+            for line in fo:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                if fields[0] == g.device or os.path.realpath(fields[0]) == device:
+                    return (fields[1].replace("\\040", " "), fields[2])
+    except IOError:
+        pass
+    return ("", "")
+# device_mount (DONE)
+
+### (sector, sectors) of each queued I/O in a local trace chunk.  blkparse text is read without numpy, which
+### 'trace' mode does not need unless the chunks are binary
+def event_extents(g, filename):
+    if filename.endswith(".ioev"):
+        for (writes, sectors, nsectors, times) in codec_batches(g, filename):
+            yield from zip(sectors.tolist(), nsectors.tolist())
+        return
+    pattern = re.compile(g.event_regex)
+    with gzip.open(filename, "rt") as fo:
+        for line in fo:
+            match = pattern.search(line)
+            if match is None or match.group(1) not in ('R', 'RW', 'W', 'WS'):
+                continue
+            try:
+                yield (int(match.group(2)), int(match.group(3)))
+            except ValueError:
+                continue
+# event_extents (DONE)
+
+### Find the hottest buckets in the local blkparse output
+### Only the buckets that hold hot_io_percent of the bucket hits are worth mapping to files
+def find_hot_buckets(g):
+    hits = {}
+    hit_total = 0
+    for filename in sorted(glob.glob("blk.out." + g.device_str + ".*.blkparse.*")):
+        if not is_event_file(filename):
+            continue
+        for (lba, size) in event_extents(g, filename):
+            first = (lba * g.sector_size) // g.bucket_size
+            last  = ((lba + max(size, 1) - 1) * g.sector_size) // g.bucket_size
+            for bucket in range(first, min(last, g.num_buckets - 1) + 1):
+                hits[bucket] = hits.get(bucket, 0) + 1
+                hit_total += 1
+
+    threshold = hit_total * g.hot_io_percent / 100.0
+    hot = []
+    running = 0
+    for bucket in sorted(hits, key=hits.get, reverse=True):
+        if running >= threshold or len(hot) >= g.hot_bucket_limit:
+            break
+        hot.append(bucket)
+        running += hits[bucket]
+    logger.info("Hot buckets: %d of %d touched buckets hold %0.1f%% of %d bucket hits" % (len(hot), len(hits), (running * 100.0 / hit_total) if hit_total else 0, hit_total))
+    return sorted(hot)
+# find_hot_buckets (DONE)
+
+### Run batched debugfs requests.  Returns a list of (request, output lines)
+def debugfs_batch(g, requests):
+    results = []
+    cmd_file = "debugfs_cmds." + g.device_str + ".txt"
+    i = 0
+    while i < len(requests):
+        with open(cmd_file, "w") as fo:
+            for request in requests[i:i + g.debugfs_batch]:
+                fo.write(request + "\n")
+        (rc, out) = run_cmd(g, "debugfs -f " + cmd_file + " " + g.device)
+        if rc != 0:
+            logger.info("ERROR: debugfs failed on " + g.device + " rc=" + str(rc))
+            os.remove(cmd_file)
+            sys.exit(4)
+        for line in out.decode("utf-8", "replace").split("\n"):
+            if line.startswith("debugfs: "):
+                results.append((line[len("debugfs: "):], []))
+            elif results and line.strip() != "":
+                results[-1][1].append(line)
+        i += g.debugfs_batch
+    os.remove(cmd_file)
+    return results
+# debugfs_batch (DONE)
+
 ### debugfs method
-### # This method can only be used on ext2/ext3/ext4 filesystems
-### I don't plan on using this method, long term
-### In testing the debugfs method, I found it to be approximately 30% slower than the ioctl method in perl
-def debugfs_method(g, file):
-    extents = []
-    file = string.replace(file, g.mountpoint, "")
-    logger.debug( "file: " + file)
-    cmd = 'debugfs -R "dump_extents ' + file + '" ' + g.device + '  2>/dev/null'
-    logger.debug( cmd)
-    (rc, extent_out) = run_cmd(g, cmd)
-    for line in extent_out:
-        logger.debug( line)
-        match = re.search("\s+\d+\/\s+\d+\s+\d+\/\s+\d+\s+\d+\s+-\s+\d+\s+(\d+)\s+-\s+(\d+)", line)
-        try:
-            g.extents.append(match.group(1) + ":" + match.group(1))
-        except:
-            logger.debug( "no match")
-    return
+### This method can only be used on ext2/ext3/ext4 filesystems
+### Reverse maps sampled blocks of each hot bucket to inodes (icheck), inodes to paths (ncheck)
+### and then dumps the extents of only those inodes
+def debugfs_method(g, hot_buckets):
+    files = {}
+    (rc, out) = run_cmd(g, "debugfs -R stats " + g.device)
+    result = regex_find(g, "Block size:\s+(\d+)", out.decode("utf-8", "replace"))
+    if rc != 0 or result == False:
+        logger.info("ERROR: debugfs could not read the superblock of " + g.device)
+        sys.exit(4)
+    fs_block_size = int(result[0])
+    blocks_per_bucket = max(1, g.bucket_size // fs_block_size)
+    stride = max(1, blocks_per_bucket // g.hot_blocks_per_bucket)
+    logger.debug("fs_block_size=" + str(fs_block_size) + " stride=" + str(stride))
+
+    # Sampled blocks -> inodes
+    blocks = []
+    for bucket in hot_buckets:
+        first = (bucket * g.bucket_size) // fs_block_size
+        blocks.extend(range(first, first + blocks_per_bucket, stride))
+    requests = []
+    for i in range(0, len(blocks), g.debugfs_args):
+        requests.append("icheck " + " ".join(str(b) for b in blocks[i:i + g.debugfs_args]))
+    inodes = set()
+    for (request, lines) in debugfs_batch(g, requests):
+        for line in lines:
+            match = re.match("(\d+)\s+(\d+)$", line)
+            if match:
+                inodes.add(int(match.group(2)))
+    logger.info("Hot buckets map to " + str(len(inodes)) + " inodes")
+
+    # Inodes -> paths.  Reserved inodes (journal, resize, ...) have no path
+    requests = []
+    inode_list = sorted(inodes)
+    for i in range(0, len(inode_list), g.debugfs_args):
+        requests.append("ncheck " + " ".join(str(n) for n in inode_list[i:i + g.debugfs_args]))
+    paths = {}
+    for (request, lines) in debugfs_batch(g, requests):
+        for line in lines:
+            match = re.match("(\d+)\s+(/.*)$", line)
+            if match and int(match.group(1)) not in paths:
+                path = os.path.normpath(g.mount_point + "/" + match.group(2))
+                if os.path.isfile(path) and not os.path.islink(path):
+                    paths[int(match.group(1))] = path
+
+    # Extents of the candidate inodes only
+    requests = ["dump_extents <" + str(inode) + ">" for inode in sorted(paths)]
+    for (request, lines) in debugfs_batch(g, requests):
+        match = re.search("<(\d+)>", request)
+        if match is None or int(match.group(1)) not in paths:
+            continue
+        inode = int(match.group(1))
+        extents = []
+        for line in lines:
+            match = re.search("\s+\d+\/\s+\d+\s+\d+\/\s+\d+\s+\d+\s+-\s+\d+\s+(\d+)\s+-\s+(\d+)", line)
+            if match:
+                start = fs_cluster_to_lba(g, fs_block_size, g.sector_size, int(match.group(1)))
+                finish = fs_cluster_to_lba(g, fs_block_size, g.sector_size, int(match.group(2)) + 1) - 1
+                extents.append((start, finish))
+        if len(extents) > 0:
+            files[paths[inode]] = extents
+    return files
 # debugfs_method (DONE)
 
 ### Translate FS cluster to LBA
 def fs_cluster_to_lba(g, fs_cluster_size, sector_size, io_cluster):
-    lba = io_cluster * (fs_cluster_size / sector_size)
+    lba = io_cluster * (fs_cluster_size // sector_size)
     return lba
 # fs_cluster_to_lba (DONE)
 
-### ioctl method (COMING SOON...)
-### # This method "should" be usable regardless of filesystem
-### There is some risk that FIBMAP!=1.  Need to address this later
-### I plan to use the ioctl method because it is 30% faster than the debugfs method
+### ioctl method
+### FS_IOC_FIEMAP is usable on any filesystem that implements it (ext3, ext4, xfs, btrfs, ...)
+### Returns a list of (start_lba, finish_lba) extents
 def ioctl_method(g, file):
-    logger.info("ext3 will be supported once ioctl_method() is supported")
-    sys.exit(-1)
-    return
-# ioctl_method (COMING SOON...)
+    extents = []
+    try:
+        fd = os.open(file, os.O_RDONLY)
+    except OSError:
+        logger.debug("Failed to open " + file)
+        return extents
+    try:
+        start = 0
+        last = False
+        while not last:
+            buf = bytearray(struct.pack("=QQLLLL", start, 0xFFFFFFFFFFFFFFFF - start, 0, 0, g.fiemap_extents, 0) + b"\0" * (56 * g.fiemap_extents))
+            fcntl.ioctl(fd, 0xC020660B, buf, True) # FS_IOC_FIEMAP
+            mapped = struct.unpack_from("=L", buf, 20)[0]
+            if mapped == 0:
+                break
+            for i in range(mapped):
+                (logical, physical, length, r1, r2, flags) = struct.unpack_from("=QQQQQL", buf, 32 + (i * 56))
+                if physical != 0 and length != 0:
+                    extents.append((physical // g.sector_size, ((physical + length) // g.sector_size) - 1))
+                start = logical + length
+                if flags & 0x1: # FIEMAP_EXTENT_LAST
+                    last = True
+    except (IOError, OSError) as e:
+        logger.debug("FIEMAP failed on " + file + ": " + str(e))
+    finally:
+        os.close(fd)
+    return extents
+# ioctl_method (DONE)
+
+### FIEMAP scan: walk the filesystem and keep the files with at least one extent in a hot bucket
+def fiemap_method(g, hot_buckets):
+    files = {}
+    root_dev = os.stat(g.mount_point).st_dev
+    k=0
+    for (dirpath, dirnames, filenames) in os.walk(g.mount_point):
+        # Don't cross into other filesystems (-xdev)
+        dirnames[:] = [d for d in dirnames if os.lstat(os.path.join(dirpath, d)).st_dev == root_dev]
+        for name in filenames:
+            file = os.path.join(dirpath, name)
+            try:
+                statinfo = os.lstat(file)
+            except OSError:
+                continue
+            if not stat.S_ISREG(statinfo.st_mode) or statinfo.st_size == 0:
+                continue
+            k+=1
+            if k % 1000 == 0:
+                printf("\rFIEMAP scan: %d files, %d hot", k, len(files))
+                sys.stdout.flush()
+            extents = ioctl_method(g, file)
+            for (start, finish) in extents:
+                first = lba_to_bucket(g, start)
+                i = bisect.bisect_left(hot_buckets, first)
+                if i < len(hot_buckets) and hot_buckets[i] <= lba_to_bucket(g, finish):
+                    files[file] = extents
+                    break
+    return files
+# fiemap_method (DONE)
 
 ### Print filetrace files
-def printout(g, file):
-    logger.debug( "printout: " + file)
+def printout(g, files):
     cpu_affinity = 0
     filetrace = "filetrace." + g.device_str + "." + str(cpu_affinity) + ".txt"
-    fo = open(filetrace, "a")
     try:
-        fo.write(file + " :: " + g.extents)
-        fo.close()
-    except:
+        with open(filetrace, "w") as fo:
+            for file in sorted(files):
+                fo.write(file + " :: " + " ".join("%d:%d" % (s, f) for (s, f) in files[file]) + "\n")
+    except IOError:
         logger.info("ERROR: Failed to open " + filetrace)
         sys.exit(3)
 # printout (DONE)
 
-def block_ranges(g, file):
-    logger.debug( "block_ranges: " + file)
-    # TODO: exclude /proc and /sys mountpoints
-    statinfo = os.stat(file)
-    mode = statinfo.st_mode
-    if stat.S_ISLNK(mode) or stat.ST_SIZE == 0 or not stat.ST_ISREG(mode):
-        logger.debug( "Disqualified file: " + file)
-        return
-    mounttype = os.system("mount | grep " + g.device + " | awk '{ print \$5 }'")
-    if mounttype == "ext4":
-        debugfs_method(g, file)
-    elif mounttype == "ext3":
-        ioctl_method(g, file)
-    else:
-        logger.info("ERROR: " + mounttype + " is not supported yet")
-        sys.exit(4)
-    printout(file)
-    return
-# block_ranges (DONE)
-
-def find_all_files(g):
-    files = []
-    logger.info("FIND ALL FILES")
-    os.system("rm -f filetrace.* &>/dev/null")
-    cpu_affinity = 0
-    filetrace = "filetrace." + g.device_str + "." + str(cpu_affinity) + ".txt"
-    os.system("touch " + filetrace)
-    cmd = "cat /proc/cpuinfo | grep processor | wc -l"
-    (rc, cpu_count) = run_cmd(g, cmd)
+### Map the files in the hot regions of the trace to their LBA ranges
+### Runs after tracing, so the cost is sized by the hot data rather than the whole filesystem
+def find_hot_files(g):
+    logger.info("FIND HOT FILES")
+    os.system("rm -f filetrace." + g.device_str + ".* &>/dev/null")
+    parse_fdisk(g, "fdisk." + g.device_str)
 
-    cmd = "mount | grep " +  g.device + "| awk '{ print \$3 }'"
-    (rc, mountpoint) = run_cmd(g, cmd)
-    if rc != 0:
+    (g.mount_point, g.mount_type) = device_mount(g)
+    if g.mount_point == "":
         logger.info(g.device + " not mounted")
-        os.system("gzip --fast filetrace.* &>/dev/null")
         return
-    logger.warning( "mountpoint: " + mountpoint)
+    logger.warning( "mountpoint: " + g.mount_point)
+    logger.warning( "mounttype: " + g.mount_type)
 
-    cmd = 'mount | grep ' + g.device + " | awk '{ print \$5 }'"
-    (rc, mounttype)  = run_cmd(g, cmd)
-    logger.warning( "mounttype: " + mounttype)
-
-    ioprof_file = 'ioprof_files.' + g.device_str + '.txt'
-    cmd = 'find ' + mountpoint + ' -xdev -name "*" > ' + ioprof_file
-    rc = os.system(cmd)
-    with open(ioprof_file, "r") as fo:
-        for line in fo:
-            g.files.append(line)
-            logger.debug( line)
-    fo.close()
+    hot_buckets = find_hot_buckets(g)
+    if len(hot_buckets) == 0:
+        logger.info("No I/O traced.  Nothing to map")
+        return
 
-    file_count = len(g.files)
-    logger.debug( "filecount: " + file_count)
+    rc = os.system("which debugfs 1>/dev/null 2>/dev/null")
+    if g.mount_type in ("ext2", "ext3", "ext4") and rc == 0:
+        files = debugfs_method(g, hot_buckets)
+    else:
+        files = fiemap_method(g, hot_buckets)
+    logger.info("\rMapped " + str(len(files)) + " files in hot regions          ")
 
-    # Single Threaded Method (TODO: Make Multi-threaded)
-    k=0
-    for i in range(0..file_count):
-        if (k > 100):
-            progress = (i / file_count) * 100
-            printf("\r%05.2f%% COMPLETE", progress)
-            k=0
-        k = k + 1
-        file = g.files[i]
-        logger.debug("file: " + file)
-        block_ranges(file)
-        
-    os.system("gzip --fast filetrace.* &>/dev/null")
+    printout(g, files)
+    os.system("gzip --fast filetrace." + g.device_str + ".* &>/dev/null")
     return
-# find_all_files (DONE)
-
-### Translate a bucket ID to a list of files
-def bucket_to_file_list(g, bucket_id):
-    list=""
-    try:
-         list = g.bucket_to_files[bucket_id]
-    except:
-        pass
-    return list
-# bucket_to_file_list (DONE)
+# find_hot_files (DONE)
 
 def file_to_bucket_helper(g, f):
     for file, r in f.items():
@@ -660,16 +1297,13 @@ def file_to_buckets(g):
 # file_to_buckets (DONE)
 
 ### Add up I/O hits to each file touched by a bucket
-def add_file_hits(g, bucket_id, io_count):
-    list = bucket_to_file_list(g, bucket_id)
-    size = len(list)
-    #print list
-    if size == 0 and io_count != 0:
+def add_file_hits(g, bucket_to_files, bucket_id, io_count):
+    list = bucket_to_files.get(bucket_id, "")
+    if len(list) == 0 and io_count != 0:
         logger.debug( "No file hit.  bucket=" + str(bucket_id) + ", io_cnt=" + str(io_count))
 
     for file in list.split(' '):
-        if file != '': 
-            logger.debug( "file=" + file)
+        if file != '':
             try:
                 g.file_hit_count[file] += io_count
             except:
@@ -677,226 +1311,580 @@ def add_file_hits(g, bucket_id, io_count):
     return
 # add_file_hits (DONE)
 
-### Get logrithmic theta for Zipfian distribution
-def theta_log(g, base, value):
-    logger.debug( "base=" + str(base) + ", value=" + str(value))
-    if value == 0 or base == 0:
-        return 0
+### Sparse bucket hit counter: sorted bucket IDs and their hit counts
+### Incoming IDs are buffered and merged into the sorted arrays a chunk at a time, so memory
+### scales with the buckets actually touched rather than the device capacity
+class bucket_counter:
+    __slots__ = ('ids', 'counts', 'pending', 'pending_len', 'chunk')
+
+    def __init__(self, chunk=1 << 22):
+        self.ids         = np.zeros(0, dtype=np.int64) # Touched bucket IDs, ascending
+        self.counts      = np.zeros(0, dtype=np.int64) # Hits for each ID
+        self.pending     = []                          # Unmerged (ids, counts) arrays
+        self.pending_len = 0
+        self.chunk       = chunk                       # Pending IDs that trigger a merge
+
+    ### Count one hit per ID, or counts[i] hits for ids[i]
+    def add(self, ids, counts=None):
+        if len(ids) == 0:
+            return
+        if counts is None:
+            counts = np.ones(len(ids), dtype=np.int64)
+        self.pending.append((np.asarray(ids, dtype=np.int64), np.asarray(counts, dtype=np.int64)))
+        self.pending_len += len(ids)
+        if self.pending_len >= self.chunk:
+            self.compact()
+
+    def compact(self):
+        if len(self.pending) == 0:
+            return
+        ids = np.concatenate([self.ids] + [p[0] for p in self.pending])
+        counts = np.concatenate([self.counts] + [p[1] for p in self.pending])
+        self.pending = []
+        self.pending_len = 0
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        self.ids = ids[starts]
+        self.counts = np.add.reduceat(counts[order], starts)
+
+    def merge(self, other):
+        (ids, counts) = other.arrays()
+        self.add(ids, counts)
+
+    ### (IDs ascending, counts) of every touched bucket
+    def arrays(self):
+        self.compact()
+        return (self.ids, self.counts)
+
+    ### The same, a chunk of IDs at a time
+    def chunks(self):
+        self.compact()
+        for start in range(0, len(self.ids), self.chunk):
+            yield (self.ids[start:start + self.chunk], self.counts[start:start + self.chunk])
+
+    def total(self):
+        return int(self.arrays()[1].sum())
+
+    def max(self):
+        counts = self.arrays()[1]
+        return int(counts.max()) if len(counts) else 0
+# bucket_counter (DONE)
+
+### Dense bucket hit counter in a numpy.memmap file, for devices whose touched buckets do not fit in RAM
+### (--memmap_dir).  It has the bucket_counter interface.  Incoming IDs are buffered up to chunk and applied
+### sorted, so each flush walks the file front to back.  chunks() streams the touched buckets window buckets
+### at a time, and arrays() collects them into memmap files next to the counter, so the heap only ever
+### holds one buffer or window
+class memmap_counter:
+    __slots__ = ('path', 'counts', 'pending', 'pending_len', 'chunk', 'window')
+
+    def __init__(self, path, size, chunk, window):
+        self.path        = path
+        self.counts      = np.memmap(path, dtype=np.int64, mode='w+', shape=(max(1, size),)) # Hits per bucket ID.  Sparse on disk
+        self.pending     = []                          # Unapplied (ids, counts) arrays
+        self.pending_len = 0
+        self.chunk       = chunk                       # Pending IDs that trigger a flush
+        self.window      = window                      # Buckets read per step when streaming
+
+    def add(self, ids, counts=None):
+        if len(ids) == 0:
+            return
+        if counts is None:
+            counts = np.ones(len(ids), dtype=np.int64)
+        self.pending.append((np.asarray(ids, dtype=np.int64), np.asarray(counts, dtype=np.int64)))
+        self.pending_len += len(ids)
+        if self.pending_len >= self.chunk:
+            self.compact()
+
+    def compact(self):
+        if len(self.pending) == 0:
+            return
+        ids = np.concatenate([p[0] for p in self.pending])
+        counts = np.concatenate([p[1] for p in self.pending])
+        self.pending = []
+        self.pending_len = 0
+        order = np.argsort(ids, kind='stable')
+        ids = ids[order]
+        starts = np.flatnonzero(np.concatenate(([True], ids[1:] != ids[:-1])))
+        self.counts[ids[starts]] += np.add.reduceat(counts[order], starts)
+
+    def merge(self, other):
+        for (ids, counts) in other.chunks():
+            self.add(ids, counts)
+
+    ### (IDs ascending, counts) of the touched buckets, a window at a time
+    def chunks(self):
+        self.compact()
+        for start in range(0, len(self.counts), self.window):
+            block = np.asarray(self.counts[start:start + self.window])
+            touched = np.flatnonzero(block)
+            if len(touched) > 0:
+                yield (touched + start, block[touched])
+
+    ### (IDs ascending, counts) of every touched bucket, as memmap arrays in <path>.ids and <path>.counts
+    def arrays(self):
+        touched = sum(len(ids) for (ids, counts) in self.chunks())
+        ids = np.memmap(self.path + ".ids", dtype=np.int64, mode='w+', shape=(max(1, touched),))[:touched]
+        counts = np.memmap(self.path + ".counts", dtype=np.int64, mode='w+', shape=(max(1, touched),))[:touched]
+        done = 0
+        for (chunk_ids, chunk_counts) in self.chunks():
+            ids[done:done + len(chunk_ids)] = chunk_ids
+            counts[done:done + len(chunk_ids)] = chunk_counts
+            done += len(chunk_ids)
+        return (ids, counts)
+
+    def total(self):
+        return int(sum(int(counts.sum()) for (ids, counts) in self.chunks()))
+
+    def max(self):
+        return max([int(counts.max()) for (ids, counts) in self.chunks()] + [0])
+# memmap_counter (DONE)
+
+### Path of a memmap file for name at the current bucket size under memmap_dir.  The files are deleted
+### with the rest of g.cleanup
+def memmap_path(g, name, suffixes):
+    if not os.path.isdir(g.memmap_dir):
+        os.makedirs(g.memmap_dir, exist_ok=True)
+    path = os.path.join(g.memmap_dir, "%s.%s.%d" % (g.device_str or "ioprof", name, g.bucket_size))
+    g.cleanup += [path + suffix for suffix in suffixes]
+    return path
+# memmap_path (DONE)
+
+### A new, empty bucket counter for name at the current bucket size: sparse in memory, or a memmap file
+### under memmap_dir whose flush buffer and streaming window come out of memory_budget
+def new_counter(g, name):
+    if g.memmap_dir is None:
+        return bucket_counter(g.counter_chunk)
+    path = memmap_path(g, name, (".bin", ".bin.ids", ".bin.counts")) + ".bin"
+    # A share of the budget per counter: 40 bytes per buffered ID to sort it, 24 per bucket of a window
+    share = g.memory_budget // g.memmap_shares
+    return memmap_counter(path, g.num_buckets, max(1024, share // 40), max(1024, share // 24))
+# new_counter (DONE)
+
+### Empty sparse bucket counters for a profile.  They are made when the profile starts counting rather
+### than in global_variables, so the modes that never count (trace, --help) run without numpy
+def sparse_counters(g):
+    for name in ('reads', 'writes', 'read_crossings', 'write_crossings'):
+        setattr(g, name, bucket_counter(g.counter_chunk))
+# sparse_counters (DONE)
+
+### Put the parse counters in memmap files under memmap_dir.  Parsing runs in this process, so the
+### count analyzer adds to them directly and has nothing to fold in
+def memmap_counters(g):
+    for name in ('reads', 'writes', 'read_crossings', 'write_crossings'):
+        setattr(g, name, new_counter(g, name))
+    logger.debug("memmap counters: %s, %d buckets, budget %s" % (g.memmap_dir, g.num_buckets, size_str(g, g.memory_budget)))
+# memmap_counters (DONE)
+
+### Touched buckets as arrays: bucket IDs (ascending), read hits and write hits
+def bucket_arrays(g):
+    (r_ids, r_counts) = g.reads.arrays()
+    (w_ids, w_counts) = g.writes.arrays()
+    ids = np.union1d(r_ids, w_ids)
+    r = np.zeros(len(ids), dtype=np.int64)
+    w = np.zeros(len(ids), dtype=np.int64)
+    r[np.searchsorted(ids, r_ids)] = r_counts
+    w[np.searchsorted(ids, w_ids)] = w_counts
+    return (ids, r, w)
+# bucket_arrays (DONE)
+
+### Distinct bucket totals in descending order and the number of buckets with each total
+### This is the old %counts hash as two arrays.  Buckets with zero I/O are left out
+def count_totals(totals):
+    (values, counts) = np.unique(totals[totals > 0], return_counts=True)
+    return (values[::-1].astype(np.int64), counts[::-1].astype(np.int64))
+# count_totals (DONE)
+
+### Number of buckets per histogram row: the first count that exceeds g.percent of the capacity
+def histogram_row_buckets(g):
+    limit = g.percent * g.total_capacity_gib
+    n = max(1, int(limit * g.GiB // g.bucket_size))
+    while (n * g.bucket_size) / g.GiB <= limit:
+        n += 1
+    while n > 1 and ((n - 1) * g.bucket_size) / g.GiB > limit:
+        n -= 1
+    return n
+# histogram_row_buckets (DONE)
+
+### Histogram rows over the buckets sorted hottest first
+### Returns the bucket count at each row boundary and the cumulative hits up to that boundary
+def histogram_rows(g, values, counts):
+    if len(values) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    n = histogram_row_buckets(g)
+    touched = int(counts.sum())
+    positions = np.arange(n, touched + 1, n, dtype=np.int64)
+    if len(positions) == 0 or positions[-1] != touched:
+        positions = np.append(positions, touched)
+    return (positions, hottest_hits(values, counts, positions))
+# histogram_rows (DONE)
+
+### The histogram as rows: buckets, capacity and hits of each row, cumulative hits, and the row's share of the
+### bucket hits, cumulative share and bandwidth share (percent, rounded as printed.  None without bucket hits)
+def histogram_table(g, values, counts):
+    (positions, cum_hits) = histogram_rows(g, values, counts)
+    sections = np.diff(cum_hits, prepend=0)
+    hits_total = g.bucket_hits_total.value
+    bw_total = int((values * counts).sum()) * g.bucket_size
+    rows = []
+    for (position, io_sum, section_count) in zip(positions.tolist(), cum_hits.tolist(), sections.tolist()):
+        row = {'buckets': position, 'capacity_bytes': position * g.bucket_size, 'hits': section_count, 'cumulative_hits': io_sum,
+            'io_percent': None, 'cumulative_percent': None, 'bw_percent': None}
+        if hits_total != 0:
+            row['io_percent'] = float("%.1f" % ((float(section_count) / float(hits_total)) * 100.0))
+            row['cumulative_percent'] = float("%.1f" % ((float(io_sum) / float(hits_total)) * 100.0))
+            row['bw_percent'] = 0.0 if bw_total == 0 else float("%.1f" % (((section_count * g.bucket_size) / bw_total) * 100))
+        rows.append(row)
+    return rows
+# histogram_table (DONE)
+
+### Hits held by the hottest n buckets for each n in positions, from count_totals output
+def hottest_hits(values, counts, positions):
+    if len(values) == 0:
+        return np.zeros(len(positions), dtype=np.int64)
+    bucket_cum = np.cumsum(counts)
+    hit_cum = np.cumsum(values * counts)
+    positions = np.minimum(positions, bucket_cum[-1])
+    # A boundary can fall inside a run of equal totals, so back out the part of the run past it
+    j = np.searchsorted(bucket_cum, positions)
+    return hit_cum[j] - ((bucket_cum[j] - positions) * values[j])
+# hottest_hits (DONE)
+
+### Rank-frequency curve of the hit buckets: log(rank) and frequency, hottest bucket is rank 1
+def rank_frequency(values, counts):
+    freq = np.repeat(values, counts).astype(np.float64)
+    log_rank = np.log(np.arange(1, len(freq) + 1, dtype=np.float64))
+    return (log_rank, freq)
+# rank_frequency (DONE)
+
+### Zipfian theta by weighted least squares over the full rank-frequency curve
+### Fits log(frequency) = c - theta * log(rank) over every hit bucket.  Each point is weighted
+### by its frequency since the variance of log(count) goes as 1/count
+### Returns (theta, ci_low, ci_high) or None if there are too few hit buckets
+def zipf_theta_lsq(g, values, counts):
+    (x, w) = rank_frequency(values, counts)
+    n = len(x)
+    if n < 3:
+        return None
+    y = np.log(w)
+    sw = w.sum()
+    dx = x - ((w * x).sum() / sw)
+    dy = y - ((w * y).sum() / sw)
+    sxx = (w * dx * dx).sum()
+    slope = (w * dx * dy).sum() / sxx
+    resid = dy - (slope * dx)
+    se = math.sqrt(((w * resid * resid).sum() / (n - 2)) / sxx)
+    theta = float(-slope)
+    return (float(theta), float(theta - (g.zipf_z * se)), float(theta + (g.zipf_z * se)))
+# zipf_theta_lsq (DONE)
+
+### Zipfian theta by maximum likelihood, treating every bucket hit as a draw from P(r) = r^-theta / H(n, theta)
+### Newton's method on the score E_theta[log r] - mean(log r), kept inside a bisection bracket
+### Returns (theta, ci_low, ci_high) or None if there are too few hit buckets
+def zipf_theta_mle(g, values, counts):
+    (log_rank, freq) = rank_frequency(values, counts)
+    if len(log_rank) < 2:
+        return None
+    hits = freq.sum()
+    mean_log_rank = (freq * log_rank).sum() / hits
+    lo = 0.0
+    hi = g.zipf_theta_max
+    theta = 1.0
+    var = 0.0
+    for i in range(100):
+        p = np.exp(-theta * log_rank)
+        h = p.sum()
+        expect = (p * log_rank).sum() / h
+        var = ((p * log_rank * log_rank).sum() / h) - (expect * expect)
+        score = expect - mean_log_rank
+        if abs(score) < 1e-12:
+            break
+        if score > 0:
+            lo = theta
+        else:
+            hi = theta
+        step = (theta + (score / var)) if var > 0 else -1
+        theta = step if lo < step < hi else (lo + hi) / 2
+        if hi - lo < 1e-9:
+            break
+    if var <= 0:
+        return (theta, theta, theta)
+    se = 1.0 / math.sqrt(hits * var)
+    return (float(theta), float(theta - (g.zipf_z * se)), float(theta + (g.zipf_z * se)))
+# zipf_theta_mle (DONE)
+
+### Hottest-first ranking of the total, read and write bucket hits in one pass
+### A single argsort over the stacked (3, n) array ranks every direction.  For each direction this gives
+### the (values, counts) runs that count_totals would, the number of touched buckets and the hot set:
+### the indices of the hottest buckets holding hot_set_percent of that direction's hits
+def direction_ranks(g, totals, reads, writes):
+    stacked = np.vstack((totals, reads, writes))
+    order = np.argsort(-stacked, axis=1, kind='stable')
+    ranked = np.take_along_axis(stacked, order, axis=1)
+    cum = np.cumsum(ranked, axis=1)
+    ranks = []
+    for d in range(3):
+        touched = int(np.count_nonzero(ranked[d]))
+        row = ranked[d, :touched]
+        starts = np.flatnonzero(np.concatenate(([True], row[1:] != row[:-1]))) if touched else np.zeros(0, dtype=np.int64)
+        hot = 0
+        if touched:
+            hot = min(touched, int(np.searchsorted(cum[d], cum[d, -1] * g.hot_set_percent / 100.0)) + 1)
+        ranks.append({'values': row[starts], 'counts': np.diff(np.append(starts, touched)).astype(np.int64),
+            'touched': touched, 'hot': order[d, :hot]})
+    return ranks
+# direction_ranks (DONE)
+
+### Print the read and write hot sets side by side, with their overlap
+def print_hot_sets(g, ranks, n):
+    (read, write) = (ranks[1], ranks[2])
+    if read['touched'] == 0 and write['touched'] == 0:
+        return
+    hot_r = np.zeros(n, dtype=bool)
+    hot_w = np.zeros(n, dtype=bool)
+    hot_r[read['hot']] = True
+    hot_w[write['hot']] = True
+    both = int(np.count_nonzero(hot_r & hot_w))
+    either = int(np.count_nonzero(hot_r | hot_w))
+    overlap = {'read_in_write': both / float(len(read['hot'])) if len(read['hot']) else None,
+        'write_in_read': both / float(len(write['hot'])) if len(write['hot']) else None,
+        'jaccard': both / float(either) if either else None}
+    g.results['hot_sets'] = {'hot_percent': g.hot_set_percent, 'overlap': overlap}
+
+    logger.info("--------------------------------------------")
+    logger.info("Read/Write Hot Sets (hottest buckets holding %g%% of each direction's hits):" % g.hot_set_percent)
+    logger.info("%-6s %10s %10s %12s %s" % ("", "Touched", "Hot", "Hot Size", "Zipfian Theta (least squares)"))
+    for (label, rank) in (("Read", read), ("Write", write)):
+        theta = zipf_theta_lsq(g, rank['values'], rank['counts'])
+        logger.info("%-6s %10d %10d %12s %s" % (label, rank['touched'], len(rank['hot']), size_str(g, len(rank['hot']) * g.bucket_size),
+            "NA" if theta is None else "%0.4f (%d%% CI %0.4f-%0.4f)" % (theta[0], g.zipf_confidence, theta[1], theta[2])))
+        g.results['hot_sets'][label.lower()] = {'touched': rank['touched'], 'hot_buckets': len(rank['hot']),
+            'hot_bytes': len(rank['hot']) * g.bucket_size, 'zipf': None if theta is None else dict(zip(('theta', 'ci_low', 'ci_high'), theta))}
+    logger.info("Overlap: %s of hot read buckets are hot write buckets, %s of hot write buckets are hot read buckets (Jaccard %s)" % (
+        percent_str(overlap['read_in_write'] if overlap['read_in_write'] is not None else float('nan')),
+        percent_str(overlap['write_in_read'] if overlap['write_in_read'] is not None else float('nan')),
+        "NA" if overlap['jaccard'] is None else "%0.3f" % overlap['jaccard']))
+
+    # Cumulative capacity curves: share of each direction's hits in its hottest N GB
+    positions = np.union1d(histogram_rows(g, read['values'], read['counts'])[0], histogram_rows(g, write['values'], write['counts'])[0])
+    curves = []
+    for rank in (read, write):
+        hits = int((rank['values'] * rank['counts']).sum())
+        curves.append(hottest_hits(rank['values'], rank['counts'], positions) * 100.0 / max(hits, 1))
+    logger.info("%-10s %18s %18s" % ("Capacity", "Read (cumulative)", "Write (cumulative)"))
+    g.results['hot_sets']['histogram'] = []
+    for (position, r, w) in zip(positions.tolist(), curves[0].tolist(), curves[1].tolist()):
+        logger.info("%-10s %17.1f%% %17.1f%%" % ("%.1f GB" % ((position * g.bucket_size) / g.GiB), r, w))
+        g.results['hot_sets']['histogram'].append({'capacity_bytes': position * g.bucket_size, 'read_cumulative_percent': r, 'write_cumulative_percent': w})
+    logger.info("--------------------------------------------")
+    return
+# print_hot_sets (DONE)
+
+### Parse a tier list for the tiering advisor, e.g. nvme:100G:1,ssd:10%:4,hdd:rest:20
+### Each tier is name:capacity:relative latency, fastest first.  Capacity is a size, a percent of the
+### device or 'rest'.  The last tier takes whatever does not fit in the tiers before it.  Returns None if invalid
+def parse_tiers(g, text):
+    tiers = []
+    for spec in [t.strip() for t in text.split(",") if t.strip() != '']:
+        fields = spec.split(":")
+        if len(fields) != 3:
+            return None
+        (name, capacity, latency) = fields
+        tier = {'name': name, 'bytes': None, 'percent': None}
+        if capacity.endswith("%"):
+            try:
+                tier['percent'] = float(capacity[:-1])
+            except ValueError:
+                return None
+            if tier['percent'] <= 0 or tier['percent'] > 100:
+                return None
+        elif capacity != "rest":
+            tier['bytes'] = parse_size(g, capacity)
+            if tier['bytes'] is None:
+                return None
+        try:
+            tier['latency'] = float(latency)
+        except ValueError:
+            return None
+        if tier['latency'] <= 0:
+            return None
+        tiers.append(tier)
+    if len(tiers) < 2 or any(t['bytes'] is None and t['percent'] is None for t in tiers[:-1]):
+        return None
+    return tiers
+# parse_tiers (DONE)
+
+### Largest gap, in buckets, filled in between the ranges of a tier of capacity buckets.  --tier_gap sets it,
+### otherwise it is a share of the tier's capacity so each tier comes out as extents rather than scattered buckets
+def tier_gap(g, capacity):
+    if g.tier_gap is not None:
+        return g.tier_gap // g.bucket_size
+    return capacity // g.tier_gap_share
+# tier_gap (DONE)
+
+### Place the touched buckets on the tiers, fastest first.  order ranks the buckets hottest first and is shared by
+### every configuration of a sweep.  Each tier takes the hottest buckets still unplaced, and a run-merging pass
+### turns them into contiguous ranges: buckets no more than tier_gap apart are joined, filling the gap, unless
+### a faster tier holds part of it.  Filled gaps use capacity, so with a gap the number of buckets taken is the
+### most whose merged ranges still fit (a binary search, the merged size only grows with the number taken).
+### The last tier takes the rest.  Returns the tier of each touched bucket and each tier's ranges as
+### (first bucket, last bucket + 1) arrays
+def tier_placement(g, ids, order, capacities):
+    last = len(capacities)
+    tier_of = np.full(len(ids), last, dtype=np.int64)
+    ranges = []
+    rest = order
+    for (tier, capacity) in enumerate(capacities):
+        gap = tier_gap(g, capacity)
+        placed = np.concatenate(([0], np.cumsum(tier_of != last)))
+        def merged(k):
+            sel = np.sort(rest[:k])
+            gaps = ids[sel[1:]] - ids[sel[:-1]] - 1
+            # A gap can only be filled if no faster tier holds a bucket inside it
+            join = (gaps <= gap) & (placed[sel[1:]] == placed[sel[:-1] + 1])
+            return (sel, join, k + int(gaps[join].sum()))
+        k = min(capacity, len(rest))
+        if gap > 0:
+            (low, high) = (0, k)
+            while low < high:
+                mid = (low + high + 1) // 2
+                if merged(mid)[2] <= capacity:
+                    low = mid
+                else:
+                    high = mid - 1
+            k = low
+        (sel, join, size) = merged(k)
+        # Touched buckets inside the filled gaps go with the tier too
+        inside = np.zeros(len(ids) + 1, dtype=np.int64)
+        np.add.at(inside, sel[:-1][join] + 1, 1)
+        np.add.at(inside, sel[1:][join], -1)
+        tier_of[np.cumsum(inside[:-1]) > 0] = tier
+        tier_of[sel] = tier
+        starts = np.flatnonzero(np.concatenate(([True], ~join)))[:len(sel)]
+        ranges.append((ids[sel[starts]], ids[sel[np.append(starts[1:], len(sel))[:len(starts)] - 1]] + 1))
+        rest = rest[tier_of[rest] == last]
+    return (tier_of, ranges)
+# tier_placement (DONE)
+
+### Tiering advisor: for each --tiers configuration, the LBA ranges to put on each tier and the share of
+### the I/O each tier would serve.  Many configurations are a sweep: the bucket ranking is shared and only
+### the placement is redone per configuration
+def print_tiering(g, ids, totals):
+    if len(g.tiers) == 0:
+        return
+    order = np.argsort(-totals, kind='stable')
+    hits_total = max(int(totals.sum()), 1)
+    device_bytes = g.total_lbas * g.sector_size
+    g.results['tiering'] = []
+    sweep = []
+    listed = []
+
+    logger.info("--------------------------------------------")
+    logger.info("Tiering Advisor (gaps of up to %s filled in):" % ("1/%d of each tier" % g.tier_gap_share if g.tier_gap is None else size_str(g, g.tier_gap)))
+    for (config, (spec, tiers)) in enumerate(g.tiers):
+        capacities = [int(t['bytes'] if t['bytes'] is not None else device_bytes * t['percent'] / 100.0) // g.bucket_size for t in tiers[:-1]]
+        (tier_of, ranges) = tier_placement(g, ids, order, capacities)
+        tier_hits = np.bincount(tier_of, weights=totals, minlength=len(tiers))
+        fractions = tier_hits / float(hits_total)
+        latency = float(np.dot(fractions, [t['latency'] for t in tiers])) if len(ids) else float('nan')
+        sweep.append((spec, fractions, latency))
+        entry = {'tiers': spec, 'expected_latency': none_if_nan(latency), 'placement': []}
+
+        logger.info("Tiers " + spec)
+        logger.info("%-10s %12s %12s %8s %10s %8s" % ("Tier", "Capacity", "Placed", "Ranges", "I/O Share", "Latency"))
+        for (t, tier) in enumerate(tiers):
+            if t < len(capacities):
+                (first, end) = ranges[t]
+                capacity = capacities[t] * g.bucket_size
+                used = int((end - first).sum()) * g.bucket_size
+                # Hits per range: the tier's touched buckets from each range start up to the next one
+                mine = tier_of == t
+                range_hits = np.add.reduceat(totals[mine], np.searchsorted(ids[mine], first)) if len(first) else np.zeros(0, dtype=np.int64)
+                listed.append((config, t, first * g.bucket_size // g.sector_size, np.minimum(end * g.bucket_size // g.sector_size, g.total_lbas) - 1, range_hits))
+            else:
+                (capacity, used, first) = (None, (g.num_buckets - int(sum((r[1] - r[0]).sum() for r in ranges))) * g.bucket_size, None)
+            logger.info("%-10s %12s %12s %8s %9.1f%% %8g" % (tier['name'], "rest" if capacity is None else size_str(g, capacity),
+                size_str(g, used), "-" if first is None else len(first), fractions[t] * 100.0, tier['latency']))
+            entry['placement'].append({'name': tier['name'], 'capacity_bytes': capacity, 'latency': tier['latency'], 'placed_bytes': used,
+                'ranges': None if first is None else len(first), 'hits': int(tier_hits[t]), 'hit_fraction': float(fractions[t])})
+        logger.info("Expected relative latency: %s (%g on %s alone)" % ("NA" if latency != latency else "%0.3f" % latency, tiers[-1]['latency'], tiers[-1]['name']))
+        g.results['tiering'].append(entry)
+
+    if len(g.tiers) == 1:
+        for (config, t, start_lba, end_lba, range_hits) in listed:
+            top = np.sort(top_indices(range_hits, g.tier_rows))
+            logger.info("%s LBA ranges (hottest %d of %d, --json has all of them):" % (g.tiers[0][1][t]['name'], len(top), len(range_hits)))
+            for i in top.tolist():
+                logger.info("  %12d-%-12d %10s %6.2f%%" % (start_lba[i], end_lba[i], size_str(g, int(end_lba[i] - start_lba[i] + 1) * g.sector_size),
+                    range_hits[i] * 100.0 / hits_total))
     else:
-        result = math.log(value) / math.log(base)
-        return result
-# theta_log (DONE)
+        logger.info("Tier sweep (I/O share of each tier):")
+        for (spec, fractions, latency) in sweep:
+            logger.info("  %-40s %s  latency %s" % (spec, " ".join("%5.1f%%" % (f * 100.0) for f in fractions.tolist()), "NA" if latency != latency else "%0.3f" % latency))
+    if len(listed):
+        g.bulk_arrays['tiering'] = ([np.concatenate([np.full(len(r[2]), r[i]) for r in listed]) for i in (0, 1)] + [np.concatenate([r[i] for r in listed]) for i in (2, 3, 4)],
+            ['config', 'tier', 'start_lba', 'end_lba', 'hits'], np.int64)
+    logger.info("--------------------------------------------")
+    return
+# print_tiering (DONE)
 
 ### Print Results
 def print_results(g):
-    num=0
-    sum=0
-    k=0
-    buffer=''
-    row=0
-    column=0
-    bw_total=0
-    counts={}
-    read_sum=0
-    write_sum=0
-    row=column=0
-    bw_total=0
     histogram_iops=[]
     histogram_bw=[]
-    
-    g.verbose=True
-    logger.warning( "num_buckets=" + str(g.num_buckets) + " bucket_size=" + str(g.bucket_size))
-    
-    g.verbose=False
-    if g.pdf == True:
-        # TODO
-        pass
-    x=0
-    threshold = g.num_buckets / 100
-    i=0
-    while i<g.num_buckets:
-        x+=1
-        if x > threshold:
-            printf("\rBucket Percent: %d %% (%d of %d)", ((i * 100)/ g.num_buckets), i, g.num_buckets)
-            sys.stdout.flush()
-            x=0
-        if i != 0 and (i % g.x_width) == 0:
-            if g.pdf == True:
-                # TODO
-                pass
-            buffer=''
-            row += 1
-            column=0
-        
 
-        r=0
-        if i in g.reads:
-            r=g.reads[i]
-        w=0
-        if i in g.writes:
-            w=g.writes[i]
+    logger.warning( "num_buckets=" + str(g.num_buckets) + " bucket_size=" + str(g.bucket_size))
 
-        bucket_total = r + w
-        bw_total += bucket_total * g.bucket_size
-        if g.trace_files:
-            add_file_hits(g, i, bucket_total)
-        if bucket_total in counts:
-            counts[bucket_total] += 1
-        else:
-            counts[bucket_total] = 1
-        #logger.debug( "bucket_total=" + str(bucket_total) + " counts[b_bucket_total]=" + str(counts[bucket_total]))
-        read_sum += r
-        write_sum += w
-        buffer = buffer + ("%d " %  bucket_total)
-        column += 1
-        i+=1
-
-    logger.info("\r                             ")
-    while (i % g.x_width) != 0:
-        i+=1
-        buffer = buffer + "0 "
-
-    if g.pdf:
-        # TODO
-        pass
+    (ids, reads, writes) = bucket_arrays(g)
+    totals = reads + writes
+    read_sum = int(reads.sum())
+    write_sum = int(writes.sum())
+    if g.trace_files:
+        bucket_to_files = dict(g.bucket_to_files)
+        for (bucket, total) in zip(ids.tolist(), totals.tolist()):
+            add_file_hits(g, bucket_to_files, bucket, total)
 
     logger.warning( "num_buckets=%s pfgp iot=%s bht=%s r_sum=%s w_sum=%s yheight=%s" % (g.num_buckets, g.io_total.value, g.bucket_hits_total.value, read_sum, write_sum, g.y_height))
 
-    t=0
-    j=0
-    section_count=0
-    b_count=0
-    gb_tot = 0
-    bw_tot = 0
-    bw_count = 0
-    io_sum = 0
-    tot = 0
-    if g.pdf:
-        # TODO
-        pass
-
-    max_set = 0
-    max = 0
-    theta_count = 1
-    theta_total = 0
-    min = 1
-    max_theta = 0
-    min_theta = 999
-
-
-    # %counts is a hash
-    # each key "bucket_total" represents a particular I/O count for a bucket
-    # each value represents the number of buckets that had this I/O count
-    # This allows me to quickly tally up a histogram and is pretty
-    # space efficient since most buckets tend to have zero I/O that
-    # key tends to have the largest number of buckets
-    #
-    # Iterate through each key in decending order
-    for total in sorted(counts, reverse=True):
-        logger.debug( "total=" + str(total) + " counts=" + str(counts[total]))
-        if total > 0:
-            tot += total * counts[total]
-            if max_set == 0:
-                max_set=1
-                max = total
-            else:
-                theta_count += 1
-                min = total
-                cur_theta = theta_log(g, theta_count, max) - theta_log(g, theta_count, total)
-                if cur_theta > max_theta:
-                    max_theta = cur_theta
-                if cur_theta < min_theta:
-                    min_theta = cur_theta
-                logger.debug( "cur_theta=" + str(cur_theta))
-                theta_total += cur_theta
-            i=0
-            while i<counts[total]:
-                section_count += total
-                b_count += 1
-                bw_count += total * g.bucket_size
-                if ((b_count * g.bucket_size )/ g.GiB) > (g.percent * g.total_capacity_gib):
-                    logger.debug( "b_count:" + str(b_count))
-                    bw_tot += bw_count
-                    gb_tot += (b_count * g.bucket_size)
-                    io_sum += section_count
-    
-                    gb = "%.1f" % (gb_tot / g.GiB)
-                    if g.bucket_hits_total.value == 0:
-                        io_perc = "NA"
-                        io_sum_perc = "NA"
-                        bw_perc = "NA"
-                    else:
-                        logger.debug( "b_count=" + str(b_count) + " s=" + str(section_count) + " ios=" + str(io_sum) + " bwc=" + str(bw_count))
-                        io_perc = "%.1f" % ((float(section_count) / float(g.bucket_hits_total.value)) * 100.0)
-                        io_sum_perc = "%.1f" % ((float(io_sum) / float(g.bucket_hits_total.value)) * 100.0)
-                        if bw_total == 0:
-                            bw_perc = "%.1f" % (0)
-                        else:
-                            bw_perc = "%.1f" % ((bw_count / bw_total) * 100)
-    
-                    if g.pdf:
-                        # TODO
-                        pass
-                    
-                    histogram_iops.append(str(gb) + " GB " + str(io_perc) + "% (" + io_sum_perc + "% cumulative)")
-                    histogram_bw.append(str(gb) + " GB " + str(bw_perc) + "% ")
-
-                    b_count=0
-                    section_count=0
-                    bw_count=0
-                    
-                i += 1
-    if b_count:
-        logger.debug( "b_count: " + str(b_count))
-        bw_tot += bw_count
-        gb_tot += b_count * g.bucket_size
-        io_sum += section_count
-
-        gb = "%.1f" % (gb_tot / g.GiB)
-        if g.bucket_hits_total.value == 0:
-            io_perc = "NA"
-            io_sum_perc = "NA"
-            bw_perc = "NA"
-        else:
-            io_perc = "%.1f" % ((section_count / g.bucket_hits_total.value) * 100)
-            io_sum_perc = "%.1f" % ((io_sum / g.bucket_hits_total.value) * 100)
-            if bw_total == 0:
-                bw_perc = "%.1f" % (0)
-            else:
-                bw_perc = "%.1f" % ((bw_count / bw_total) * 100)
+    # counts[i] buckets had values[i] hits.  Walking the runs hottest first with
+    # cumulative sums gives every histogram row without touching each bucket.
+    # The read and write rankings for the hot sets come out of the same sort
+    ranks = direction_ranks(g, totals, reads, writes)
+    (values, counts) = (ranks[0]['values'], ranks[0]['counts'])
+    g.results['histogram'] = histogram_table(g, values, counts)
+    for row in g.results['histogram']:
+        gb = "%.1f" % (row['capacity_bytes'] / g.GiB)
+        (io_perc, io_sum_perc, bw_perc) = ["NA" if x is None else "%.1f" % x for x in (row['io_percent'], row['cumulative_percent'], row['bw_percent'])]
 
         if g.pdf:
             # TODO
             pass
 
-        histogram_iops.append(str(gb) + " GB " + str(io_perc) + "% (" + str(io_sum_perc) + "% cumulative)")
+        histogram_iops.append(str(gb) + " GB " + str(io_perc) + "% (" + io_sum_perc + "% cumulative)")
         histogram_bw.append(str(gb) + " GB " + str(bw_perc) + "% ")
 
-        b_count = 0
-        section_count = 0
-        bw_count = 0
-
-    if g.pdf:
-        # TODO
-        pass
-
-    logger.debug( "t=" + str(t))
-
     logger.info("--------------------------------------------")
     logger.info("Histogram IOPS:")
     for entry in histogram_iops:
         logger.info(entry)
     logger.info("--------------------------------------------")
 
-    # TODO: Check that this is consistent with Perl version
-    if (theta_count):
-        avg_theta = theta_total / theta_count
-        med_theta = ((max_theta - min_theta) / 2 ) + min_theta
-        approx_theta = (avg_theta + med_theta) / 2
-        #string = "avg_t=%s med_t=%s approx_t=%s min_t=%s max_t=%s\n" % (avg_theta, med_theta, approx_theta, min_theta, max_theta)
-        logger.warning( "avg_t=%s med_t=%s approx_t=%s min_t=%s max_t=%s\n" % (avg_theta, med_theta, approx_theta, min_theta, max_theta))
-        analysis_histogram_iops = "Approximate Zipfian Theta Range: %0.4f-%0.4f (est. %0.4f).\n" % (min_theta, max_theta, approx_theta)
-        logger.info(analysis_histogram_iops)
+    theta = zipf_theta_lsq(g, values, counts)
+    g.results['zipf'] = {'confidence': g.zipf_confidence, 'buckets': int(counts.sum()),
+        'least_squares': None if theta is None else dict(zip(('theta', 'ci_low', 'ci_high'), theta))}
+    if theta is None:
+        analysis_histogram_iops = "Zipfian Theta: NA (fewer than 3 buckets with I/O)\n"
+    else:
+        analysis_histogram_iops = "Zipfian Theta (least squares): %0.4f (%d%% CI %0.4f-%0.4f, %d buckets)\n" % (theta[0], g.zipf_confidence, theta[1], theta[2], int(counts.sum()))
+    logger.info(analysis_histogram_iops)
+    if g.zipf_mle:
+        theta = zipf_theta_mle(g, values, counts)
+        g.results['zipf']['max_likelihood'] = None if theta is None else dict(zip(('theta', 'ci_low', 'ci_high'), theta))
+        if theta is not None:
+            logger.info("Zipfian Theta (max likelihood): %0.4f (%d%% CI %0.4f-%0.4f)\n" % (theta[0], g.zipf_confidence, theta[1], theta[2]))
+    print_hot_sets(g, ranks, len(ids))
+    print_tiering(g, ids, totals)
 
     logger.debug( "Trace_files: " + str(g.trace_files))
     if g.trace_files:
@@ -912,6 +1900,7 @@ def print_results(g):
                 if hits > 0:
                     hit_rate = (float(hits) / float(g.bucket_hits_total.value)) * 100.0
                     logger.info("%0.2f%% (%d) %s" % (hit_rate, hits, filename))
+                    g.results.setdefault('top_files', []).append({'file': filename, 'hits': hits, 'percent': hit_rate})
                     if g.pdf:
                         g.top_files.append("%0.2f%%: (%d) %s\n" % (hit_rate, hits, filename))
                 top_count += 1
@@ -942,196 +1931,1450 @@ def create_report(g):
     return
 # create_report (TODO)
 
+### I/O size histogram as arrays: sizes in sectors (ascending) and the I/O count of each size
+def size_histogram(totals):
+    items = dict(totals)
+    sizes = np.fromiter(items.keys(), dtype=np.int64, count=len(items))
+    counts = np.fromiter(items.values(), dtype=np.int64, count=len(items))
+    order = np.argsort(sizes)
+    return (sizes[order], counts[order])
+# size_histogram (DONE)
+
+### Size at each percentile of a size histogram (nearest rank).  None if there were no I/O's
+def size_percentiles(sizes, counts, percentiles):
+    if counts.sum() == 0:
+        return None
+    cum = np.cumsum(counts)
+    ranks = np.maximum(1, np.ceil(np.asarray(percentiles, dtype=np.float64) / 100.0 * cum[-1]))
+    return sizes[np.searchsorted(cum, ranks)]
+# size_percentiles (DONE)
+
 ### Print I/O statistics
+### Per-size IOPS and bandwidth shares, read/write mix, log2 size bins and size percentiles
 def print_stats(g):
+    (r_sizes, r_counts) = size_histogram(g.r_totals)
+    (w_sizes, w_counts) = size_histogram(g.w_totals)
+    io_total = int(r_counts.sum() + w_counts.sum())
+    if io_total == 0:
+        return
+    r_bytes = r_sizes * r_counts * g.sector_size
+    w_bytes = w_sizes * w_counts * g.sector_size
+    bw_total = int(r_bytes.sum() + w_bytes.sum())
+
+    logger.info("--------------------------------------------")
+    for (title, shares, amounts, fmt) in (
+            ("Stats IOPS:", (r_counts * 100.0 / io_total, w_counts * 100.0 / io_total), (r_counts, w_counts), "%s %s %0.2f%% (%d IO's)"),
+            ("Stats BW:", (r_bytes * 100.0 / max(bw_total, 1), w_bytes * 100.0 / max(bw_total, 1)), (r_bytes / g.GiB, w_bytes / g.GiB), "%s %s %0.2f%% (%0.2f GiB)")):
+        logger.info(title)
+        for (label, sizes, share, amount) in (("READ", r_sizes, shares[0], amounts[0]), ("WRITE", w_sizes, shares[1], amounts[1])):
+            shown = np.flatnonzero(share > g.stats_min_percent)
+            for i in shown.tolist():
+                logger.info(fmt % ('"' + size_str(g, int(sizes[i]) * g.sector_size) + '"', label, share[i], amount[i]))
+
+    read_percent = r_counts.sum() * 100.0 / io_total
+    if read_percent > 95:
+        intensity = "very read intensive"
+    elif read_percent > 70:
+        intensity = "moderately read intensive"
+    elif read_percent > 50:
+        intensity = "evenly split between reads and writes"
+    else:
+        intensity = "write intensive"
+    g.results['stats'] = {'read_percent': float(read_percent), 'write_percent': float(100.0 - read_percent),
+        'sizes': [{'size_bytes': int(size) * g.sector_size, 'op': op, 'ios': int(count), 'bytes': int(size) * g.sector_size * int(count)}
+            for (op, sizes, counts) in (('read', r_sizes, r_counts), ('write', w_sizes, w_counts)) for (size, count) in zip(sizes.tolist(), counts.tolist())]}
+    logger.info("Your workload was approximately %0.2f%% reads and %0.2f%% writes.  Your workload was %s." % (read_percent, 100.0 - read_percent, intensity))
+
+    # log2 bins: bin b holds sizes in [2^b, 2^(b+1)) bytes
+    sizes = np.concatenate((r_sizes, w_sizes)) * g.sector_size
+    bins = np.log2(np.maximum(sizes, 1)).astype(np.int64)
+    nbins = int(bins.max()) + 1
+    r_bins = np.bincount(bins[:len(r_sizes)], weights=r_counts, minlength=nbins)
+    w_bins = np.bincount(bins[len(r_sizes):], weights=w_counts, minlength=nbins)
+    bw_bins = np.bincount(bins, weights=np.concatenate((r_bytes, w_bytes)), minlength=nbins)
+    logger.info("I/O Size Distribution:")
+    logger.info("%-24s %9s %9s %9s %9s" % ("Size", "Reads", "Writes", "IOPS", "BW"))
+    g.results['stats']['log2_bins'] = [{'min_bytes': 1 << b, 'max_bytes': 1 << (b + 1), 'reads': int(r_bins[b]), 'writes': int(w_bins[b]), 'bytes': int(bw_bins[b])}
+        for b in np.flatnonzero(r_bins + w_bins).tolist()]
+    for b in np.flatnonzero(r_bins + w_bins).tolist():
+        label = "%s - %s" % (size_str(g, 1 << b), size_str(g, 1 << (b + 1)))
+        logger.info("%-24s %8.2f%% %8.2f%% %8.2f%% %8.2f%%" % (label, r_bins[b] * 100.0 / io_total, w_bins[b] * 100.0 / io_total,
+            (r_bins[b] + w_bins[b]) * 100.0 / io_total, bw_bins[b] * 100.0 / max(bw_total, 1)))
+
+    logger.info("I/O Size Percentiles:")
+    logger.info("%-8s %12s %12s %12s" % ("", "p50", "p90", "p99"))
+    all_sizes = np.concatenate((r_sizes, w_sizes))
+    order = np.argsort(all_sizes, kind='stable')
+    for (label, sizes, counts) in (("Read", r_sizes, r_counts), ("Write", w_sizes, w_counts), ("All", all_sizes[order], np.concatenate((r_counts, w_counts))[order])):
+        p = size_percentiles(sizes, counts, g.stats_percentiles)
+        g.results['stats'].setdefault('percentiles', {})[label.lower()] = None if p is None else dict(
+            zip(["p%g" % q for q in g.stats_percentiles], [int(x) * g.sector_size for x in p.tolist()]))
+        if p is not None:
+            logger.info("%-8s %12s %12s %12s" % tuple([label] + [size_str(g, int(s) * g.sector_size) for s in p.tolist()]))
+    logger.info("--------------------------------------------")
     return
-# print_stats (TODO)
-
-
-### Combine thread-local counts into global counts
-def total_thread_counts (g, num):
-    logger.debug("total_thread_counts total_thread_counts total_thread_counts total_thread_counts")
-
-    g.max_bucket_hits_semaphore.acquire()
-    logger.debug( "Thread " + str(num) + " has max_bucket_hits lock t=" + str(g.thread_max_bucket_hits) + " g=" + str(g.max_bucket_hits.value))
-    if(g.thread_max_bucket_hits > g.max_bucket_hits.value):
-        g.max_bucket_hits.value = g.thread_max_bucket_hits
-    logger.debug( "Thread " + str(num) + " releasing max_bucket_hits lock t=" + str(g.thread_max_bucket_hits) + " g=" + str(g.max_bucket_hits.value))
-    g.max_bucket_hits_semaphore.release()
-
-    g.total_blocks_semaphore.acquire()
-    logger.debug( "Thread " + str(num) + " has total_blocks lock t=" + str(g.thread_total_blocks) + " g=" + str(g.total_blocks.value))
-    g.total_blocks.value += g.thread_total_blocks
-    logger.debug( "Thread " + str(num) + " releasing total_blocks lock t=" + str(g.thread_total_blocks) + " g=" + str(g.total_blocks.value))
-    g.total_blocks_semaphore.release()
-
-    g.total_semaphore.acquire()
-    logger.debug( "Thread " + str(num) + " has total lock t=" + str(g.thread_io_total) + " g=" + str(g.io_total.value))
-    g.io_total.value += g.thread_io_total
-    logger.debug( "Thread " + str(num) + " releasing total lock t=" + str(g.thread_io_total) + " g=" + str(g.io_total.value))
-    g.total_semaphore.release()
-
-    g.read_totals_semaphore.acquire()
-    logger.debug( "Thread " + str(num) + " has read_totals lock t=" + str(g.thread_read_total) + " g=" + str(g.read_total.value))
-    g.read_total.value += g.thread_read_total
-    for io_size, hits in g.thread_r_totals.items():
-        if io_size in g.r_totals:
-            g.r_totals[io_size] += hits
+# print_stats (DONE)
+
+### LRU miss-ratio curve from sampled reuse distances (SHARDS)
+### Blocks are sampled by a spatial hash, so every reference to a sampled block is seen and its
+### reuse distance is exact within the sample.  Distances are counted with a Fenwick tree over
+### reference times, which is compacted whenever it fills.  When more than max_samples blocks are
+### tracked the hash threshold is lowered and the blocks above it are dropped, so memory is bounded
+### no matter how long the trace is.  Each reference is weighted by 1/rate at the time it was seen
+class shards_mrc:
+    __slots__ = ('block_size', 'sector_size', 'threshold', 'max_samples', 'clock', 'live', 'tree',
+                 'capacity', 'last', 'heap', 'hist', 'cold', 'references', 'totals')
+
+    MODULUS  = 1 << 24 # Hash space for spatial sampling
+    SUB_BINS = 8       # Histogram bins per power of two of reuse distance
+    OCTAVES  = 64      # Powers of two of reuse distance covered by the histogram
+
+    def __init__(self, block_size, sector_size, rate, max_samples):
+        self.block_size  = block_size
+        self.sector_size = sector_size
+        self.threshold   = max(1, int(rate * self.MODULUS))
+        self.max_samples = max_samples
+        self.clock       = 0                     # Sampled reference count, used as the Fenwick index
+        self.live        = 0                     # Entries currently set in the Fenwick tree
+        self.capacity    = 1 << 16               # Fenwick tree size (reference times)
+        self.tree        = [0] * (self.capacity + 1)
+        self.last        = {}                    # Sampled block -> time of its last reference
+        self.heap        = []                    # (-hash, block) of tracked blocks, largest hash first
+        self.hist        = [[0.0] * (1 + (self.OCTAVES * self.SUB_BINS)) for i in range(2)] # [read, write] weights by distance bin
+        self.cold        = [0.0, 0.0]            # [read, write] weight of first references
+        self.references  = 0                     # Sampled references processed
+        self.totals      = [0, 0]                # [read, write] references seen, sampled or not
+
+    def rate(self):
+        return self.threshold / float(self.MODULUS)
+
+    ### Spatial hash of block numbers into [0, MODULUS)
+    def hash(self, blocks):
+        x = blocks.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        x ^= x >> np.uint64(29)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(32)
+        return x & np.uint64(self.MODULUS - 1)
+
+    ### Feed a batch of I/Os.  writes is a bool array, sectors/nsectors are in sectors
+    def add_events(self, writes, sectors, nsectors, split=None):
+        (blocks, index) = io_blocks(sectors, nsectors, self.sector_size, self.block_size) if split is None else split
+        writes = writes[index]
+        self.totals[1] += int(np.count_nonzero(writes))
+        self.totals[0] += len(writes) - int(np.count_nonzero(writes))
+        hashes = self.hash(blocks)
+        keep = hashes < np.uint64(self.threshold)
+        for (block, write, h) in zip(blocks[keep].tolist(), writes[keep].tolist(), hashes[keep].tolist()):
+            if h < self.threshold: # The threshold can drop part way through a batch
+                self.reference(block, 1 if write else 0, h)
+
+    ### Process one sampled reference
+    def reference(self, block, rw, h):
+        if self.clock >= self.capacity:
+            self.compact()
+        t = self.clock
+        tree = self.tree
+        n = self.capacity
+        weight = self.MODULUS / float(self.threshold)
+        prev = self.last.get(block)
+        if prev is None:
+            self.cold[rw] += weight
+            heapq.heappush(self.heap, (-h, block))
         else:
-            g.r_totals[io_size] = hits
-    logger.debug( "Thread " + str(num) + " releasing read_totals lock t=" + str(g.thread_read_total) + " g=" + str(g.read_total.value))
-    g.read_totals_semaphore.release()
-
-    g.write_totals_semaphore.acquire()
-    logger.debug( "Thread " + str(num) + " has write_totals lock t=" + str(g.thread_write_total) + " g=" + str(g.write_total.value))
-    g.write_total.value += g.thread_write_total
-    for io_size, hits in g.thread_w_totals.items():
-        if io_size in g.w_totals:
-            g.w_totals[io_size] += hits
+            # Distinct blocks referenced since prev = live entries after prev
+            i = prev + 1
+            s = 0
+            while i > 0:
+                s += tree[i]
+                i -= i & -i
+            distance = (self.live - s) * weight
+            i = prev + 1
+            while i <= n:
+                tree[i] -= 1
+                i += i & -i
+            self.live -= 1
+            if distance < 1:
+                b = 0
+            else:
+                (m, e) = math.frexp(distance)
+                b = min(1 + ((e - 1) * self.SUB_BINS) + int(((m * 2) - 1) * self.SUB_BINS), len(self.hist[rw]) - 1)
+            self.hist[rw][b] += weight
+        i = t + 1
+        while i <= n:
+            tree[i] += 1
+            i += i & -i
+        self.live += 1
+        self.last[block] = t
+        self.clock += 1
+        self.references += 1
+        if prev is None and len(self.last) > self.max_samples:
+            self.shrink()
+
+    ### Renumber the live reference times 0..live-1 and rebuild the Fenwick tree
+    def compact(self):
+        order = sorted(self.last, key=self.last.get)
+        for (t, block) in enumerate(order):
+            self.last[block] = t
+        self.clock = len(order)
+        self.capacity = max(1 << 16, 2 * self.clock)
+        tree = [0] * (self.capacity + 1)
+        for i in range(1, self.capacity + 1):
+            if i <= self.clock:
+                tree[i] += 1
+            j = i + (i & -i)
+            if j <= self.capacity:
+                tree[j] += tree[i]
+        self.tree = tree
+
+    ### Lower the sampling threshold until at most max_samples blocks are tracked
+    def shrink(self):
+        while len(self.last) > self.max_samples:
+            (h, block) = heapq.heappop(self.heap)
+            self.threshold = -h
+            evict = [block]
+            while self.heap and self.heap[0][0] == h:
+                evict.append(heapq.heappop(self.heap)[1])
+            for block in evict:
+                i = self.last.pop(block) + 1
+                while i <= self.capacity:
+                    self.tree[i] -= 1
+                    i += i & -i
+                self.live -= 1
+
+    ### Hit ratios at each histogram bin edge: (cache sizes in bytes, read, write, combined)
+    ### A reference hits in a cache of C blocks when fewer than C distinct blocks were touched since its last use
+    def curve(self):
+        hist = np.array(self.hist)
+        # SHARDS_adj: the sample rarely holds exactly rate * references.  The difference is
+        # mostly references to hot blocks that were (or were not) sampled, so it goes to distance 0
+        hist[:, 0] += np.array(self.totals, dtype=np.float64) - (hist.sum(axis=1) + np.array(self.cold))
+        hist[:, 0] = np.maximum(hist[:, 0], 0)
+        refs = hist.sum(axis=1) + np.array(self.cold)
+        hits = np.concatenate((np.zeros((2, 1)), np.cumsum(hist, axis=1)[:, :-1]), axis=1)
+        bins = np.arange(hist.shape[1])
+        octave = (bins - 1) // self.SUB_BINS
+        sizes = np.where(bins == 0, 0.0, (2.0 ** octave) * (1 + (((bins - 1) % self.SUB_BINS) / float(self.SUB_BINS)))) * self.block_size
+        with np.errstate(invalid='ignore', divide='ignore'):
+            hit_r = np.where(refs[0] > 0, hits[0] / refs[0], np.nan)
+            hit_w = np.where(refs[1] > 0, hits[1] / refs[1], np.nan)
+            hit_all = np.where(refs.sum() > 0, hits.sum(axis=0) / refs.sum(), np.nan)
+        return (sizes, hit_r, hit_w, hit_all)
+
+    ### Estimated number of distinct blocks referenced (working set), in blocks
+    def footprint(self):
+        return (self.cold[0] + self.cold[1])
+# shards_mrc (DONE)
+
+### Print the LRU hit ratio vs cache size table
+def print_mrc(g):
+    if g.mrc is None:
+        return
+    (sizes, hit_r, hit_w, hit_all) = g.mrc.curve()
+    footprint = g.mrc.footprint() * g.mrc.block_size
+    logger.info("--------------------------------------------")
+    logger.info("LRU Hit Ratio vs Cache Size (%s blocks, sample rate %0.4f, %d sampled references, ~%s touched):" % (size_str(g, g.mrc.block_size), g.mrc.rate(), g.mrc.references, size_str(g, footprint)))
+    logger.info("%12s %9s %9s %9s" % ("Cache Size", "Read", "Write", "Combined"))
+    g.results['mrc'] = {'block_size': g.mrc.block_size, 'sample_rate': g.mrc.rate(), 'references': g.mrc.references, 'footprint_bytes': int(footprint), 'curve': []}
+    for i in range(1, len(sizes), shards_mrc.SUB_BINS):
+        if i > 1 and sizes[i] > 2 * footprint:
+            break
+        g.results['mrc']['curve'].append({'cache_bytes': int(sizes[i]), 'read_hit': none_if_nan(hit_r[i]), 'write_hit': none_if_nan(hit_w[i]), 'hit': none_if_nan(hit_all[i])})
+        logger.info("%12s %9s %9s %9s" % (size_str(g, sizes[i]), percent_str(hit_r[i]), percent_str(hit_w[i]), percent_str(hit_all[i])))
+    logger.info("--------------------------------------------")
+    return
+# print_mrc (DONE)
+
+### Per-interval I/O timeline from the blkparse event timestamps
+### Each batch is binned with np.histogram over fixed interval edges, so the cost is per batch and
+### the memory is per interval.  counts rows are read ops, write ops, read bytes and write bytes
+class io_timeline:
+    __slots__ = ('interval', 'counts')
+
+    def __init__(self, interval, counts=None):
+        self.interval = interval                       # Seconds per interval
+        self.counts = np.zeros((4, 0), dtype=np.int64) if counts is None else counts
+
+    def add(self, times, writes, nsectors, sector_size):
+        known = ~np.isnan(times)
+        if not known.any():
+            return
+        (times, writes, nbytes) = (times[known], writes[known], nsectors[known] * sector_size)
+        n = int(times.max() // self.interval) + 1
+        if n > self.counts.shape[1]:
+            self.counts = np.concatenate((self.counts, np.zeros((4, n - self.counts.shape[1]), dtype=np.int64)), axis=1)
+        edges = np.arange(n + 1) * self.interval
+        for (row, mask, weights) in ((0, ~writes, None), (1, writes, None), (2, ~writes, nbytes), (3, writes, nbytes)):
+            w = None if weights is None else weights[mask]
+            self.counts[row, :n] += np.histogram(times[mask], bins=edges, weights=w)[0].astype(np.int64)
+
+    ### Add another timeline, lined up by time since the start of each trace.  If the intervals differ
+    ### both go to the coarser one, which must be a multiple of the finer.  Raises ValueError otherwise
+    def merge(self, other):
+        if other.counts.shape[1] == 0:
+            return
+        if self.counts.shape[1] == 0:
+            (self.interval, self.counts) = (other.interval, other.counts.copy())
+            return
+        interval = max(self.interval, other.interval)
+        (mine, theirs) = (self.coarsen(interval), other.coarsen(interval))
+        n = max(mine.counts.shape[1], theirs.counts.shape[1])
+        counts = np.zeros((4, n), dtype=np.int64)
+        counts[:, :mine.counts.shape[1]] += mine.counts
+        counts[:, :theirs.counts.shape[1]] += theirs.counts
+        (self.interval, self.counts) = (interval, counts)
+
+    ### This timeline at a coarser interval that is a multiple of its own
+    def coarsen(self, interval):
+        factor = int(round(interval / self.interval))
+        if factor < 1 or abs(factor * self.interval - interval) > 1e-9:
+            raise ValueError("cannot merge a %g second timeline with a %g second one: neither interval is a multiple of the other" % (self.interval, interval))
+        return self if factor == 1 else self.rebin(factor)
+
+    ### Coarser timeline summing factor intervals each
+    def rebin(self, factor):
+        n = -(-self.counts.shape[1] // factor) * factor
+        counts = np.zeros((4, n), dtype=np.int64)
+        counts[:, :self.counts.shape[1]] = self.counts
+        return io_timeline(self.interval * factor, counts.reshape(4, -1, factor).sum(axis=2))
+
+    ### Columns: start (s), IOPS, read IOPS, write IOPS, MB/s, read MB/s, write MB/s, read %, average I/O size (KiB)
+    def series(self):
+        (r, w, rb, wb) = self.counts.astype(np.float64)
+        ops = r + w
+        with np.errstate(divide='ignore', invalid='ignore'):
+            read_pct = np.where(ops > 0, r * 100.0 / ops, 0.0)
+            avg_kib = np.where(ops > 0, (rb + wb) / ops / 1024.0, 0.0)
+        mb = 1048576.0 * self.interval
+        return np.column_stack((np.arange(len(r)) * self.interval, ops / self.interval, r / self.interval, w / self.interval,
+            (rb + wb) / mb, rb / mb, wb / mb, read_pct, avg_kib))
+# io_timeline (DONE)
+
+### Print the I/O timeline, coarsened to at most timeline_rows rows, and write it to CSV if asked
+def print_timeline(g):
+    if g.timeline is None or g.timeline.counts.shape[1] == 0:
+        return
+    if g.timeline_csv is not None:
+        np.savetxt(g.timeline_csv, g.timeline.series(), delimiter=",", fmt="%.6g",
+            header="start_s,iops,read_iops,write_iops,mbps,read_mbps,write_mbps,read_pct,avg_kib", comments="")
+        logger.info("Wrote the %g second timeline to %s" % (g.timeline.interval, g.timeline_csv))
+    g.results['timeline'] = {'interval': g.timeline.interval, 'intervals': int(g.timeline.counts.shape[1])}
+    timeline = g.timeline
+    if timeline.counts.shape[1] > g.timeline_rows:
+        timeline = timeline.rebin(-(-timeline.counts.shape[1] // g.timeline_rows))
+    logger.info("--------------------------------------------")
+    logger.info("I/O Timeline (%g second intervals):" % timeline.interval)
+    logger.info("%10s %10s %10s %8s %10s" % ("Time (s)", "IOPS", "MB/s", "Read %", "Avg KiB"))
+    for row in timeline.series().tolist():
+        logger.info("%10.1f %10.1f %10.2f %8.1f %10.1f" % (row[0], row[1], row[4], row[7], row[8]))
+    logger.info("--------------------------------------------")
+# print_timeline (DONE)
+
+### Start time of each trace chunk from the timeline.<dev> capture, relative to the first chunk
+### Chunks without a recorded start are assumed to be timeout seconds apart
+def chunk_offset(g, filename):
+    result = regex_find(g, "blk\.out\.\S+\.(\d+)\.blkparse", filename)
+    if result == False:
+        return 0.0
+    chunk = int(result[0])
+    if chunk in g.chunk_starts:
+        return g.chunk_starts[chunk] - min(g.chunk_starts.values())
+    return float(chunk * g.timeout)
+# chunk_offset (DONE)
+
+### Read the chunk start times recorded by 'trace' mode
+def parse_chunk_starts(g, filename):
+    g.chunk_starts = {}
+    if not os.path.isfile(filename):
+        return
+    with open(filename, "r") as fo:
+        for line in fo:
+            fields = line.split()
+            if len(fields) == 2:
+                g.chunk_starts[int(fields[0])] = float(fields[1])
+# parse_chunk_starts (DONE)
+
+### Time-decayed hotness per bucket
+### score[b] is the sum of exp(-(last[b] - t) * ln2 / half_life) over the hits of bucket b at times t, kept
+### relative to the bucket's last access time last[b] (milliseconds since the start of the trace).
+### Folding a hit in at its own time is exact whatever order the trace files are read in.  Scores are
+### float32 and access times uint32, 8 bytes per bucket.  Hits are also counted per epoch, sparse, to
+### show how the hot set moved over the trace
+class bucket_hotness:
+    __slots__ = ('bucket_size', 'sector_size', 'half_life', 'epoch', 'num_buckets', 'score', 'last', 'epochs', 'end')
+
+    def __init__(self, bucket_size, sector_size, num_buckets, half_life, epoch, chunk=1 << 22, path=None):
+        self.bucket_size = bucket_size
+        self.sector_size = sector_size
+        self.half_life   = half_life                               # Seconds for a hit to lose half its weight
+        self.epoch       = epoch                                   # Seconds per hot set snapshot
+        self.num_buckets = num_buckets
+        self.score       = np.zeros(num_buckets, dtype=np.float32) if path is None else np.memmap(path + ".score", dtype=np.float32, mode='w+', shape=(num_buckets,)) # Decayed hits as of last[b]
+        self.last        = np.zeros(num_buckets, dtype=np.uint32) if path is None else np.memmap(path + ".last", dtype=np.uint32, mode='w+', shape=(num_buckets,)) # Last access (ms since the trace start)
+        self.epochs      = bucket_counter(chunk)                   # Hits keyed by epoch * num_buckets + bucket
+        self.end         = 0.0                                     # Latest event time (s)
+
+    def add_events(self, times, sectors, nsectors):
+        known = ~np.isnan(times)
+        if not known.any():
+            return
+        (buckets, index) = io_blocks(sectors[known], nsectors[known], self.sector_size, self.bucket_size)
+        buckets = np.minimum(buckets, self.num_buckets - 1)
+        t = np.round(times[known][index] * 1000.0)
+        self.end = max(self.end, float(t.max()) / 1000.0)
+        self.epochs.add((t // (self.epoch * 1000.0)).astype(np.int64) * self.num_buckets + buckets)
+        (ub, inv) = np.unique(buckets, return_inverse=True)
+        tmax = np.full(len(ub), -1.0)
+        np.maximum.at(tmax, inv, t)
+        old = self.last[ub].astype(np.float64)
+        touched = self.score[ub] > 0
+        new = np.where(touched, np.maximum(old, tmax), tmax)
+        rate = math.log(2) / (self.half_life * 1000.0)
+        added = np.bincount(inv, weights=np.exp(-(new[inv] - t) * rate), minlength=len(ub))
+        self.score[ub] = (self.score[ub] * np.exp(-(new - old) * rate) + added).astype(np.float32)
+        self.last[ub] = new.astype(np.uint32)
+
+    ### Scores decayed to the end of the trace and seconds since each bucket's last access
+    def current(self):
+        age = np.maximum(self.end - self.last / 1000.0, 0.0)
+        return ((self.score * np.exp(-age * math.log(2) / self.half_life)).astype(np.float32), age.astype(np.float32))
+
+    ### Hot set at the end of each epoch, from scores decayed epoch by epoch
+    ### Only the touched buckets carry a score, each decayed lazily by the epochs since its last hit.  Buckets
+    ### drop out once their score underflows float32, and the hot set is found with top_indices, widening
+    ### the partition until it holds hot_percent of the total.  Returns a list of (epoch end time, hot
+    ### bucket IDs ascending).  The last epoch ends with the trace
+    def migration(self, hot_percent):
+        (keys, counts) = self.epochs.arrays()
+        if len(keys) == 0:
+            return []
+        epochs = keys // self.num_buckets
+        (ids, where) = np.unique(keys % self.num_buckets, return_inverse=True)
+        where = where.reshape(-1)
+        starts = np.searchsorted(epochs, np.arange(int(epochs[-1]) + 2))
+        decay = 0.5 ** (self.epoch / self.half_life)
+        score = np.zeros(len(ids))                                 # Decayed hits as of epoch seen[i]
+        seen = np.zeros(len(ids), dtype=np.int64)                  # Epoch of the last hit
+        active = np.zeros(len(ids), dtype=bool)
+        live = np.zeros(0, dtype=np.int64)                         # Positions in ids with a score left
+        width = 64                                                 # Partition size, grown as hot sets need
+        snapshots = []
+        for e in range(int(epochs[-1]) + 1):
+            hits = where[starts[e]:starts[e + 1]]
+            score[hits] = score[hits] * decay ** (e - seen[hits]) + counts[starts[e]:starts[e + 1]]
+            seen[hits] = e
+            live = np.concatenate((live, hits[~active[hits]]))
+            active[hits] = True
+            now = (score[live] * decay ** (e - seen[live])).astype(np.float32)
+            gone = now == 0
+            if gone.any():
+                active[live[gone]] = False
+                (live, now) = (live[~gone], now[~gone])
+            target = now.sum(dtype=np.float64) * hot_percent / 100.0
+            while True:
+                order = top_indices(now, width)
+                cum = np.cumsum(now[order], dtype=np.float64)
+                if len(order) == len(now) or cum[-1] >= target:
+                    break
+                width *= 4
+            hot = min(len(order), int(np.searchsorted(cum, target)) + 1) if len(order) else 0
+            if hot:
+                # Ties at the edge of the hot set go to the lowest bucket IDs
+                edge = now[order[hot - 1]]
+                above = np.flatnonzero(now > edge)
+                tied = np.flatnonzero(now == edge)
+                tied = tied[np.argsort(ids[live[tied]], kind='stable')][:hot - len(above)]
+                order = np.concatenate((above, tied))
+            snapshots.append((min((e + 1) * self.epoch, self.end), np.sort(ids[live[order[:hot]]])))
+        return snapshots
+# bucket_hotness (DONE)
+
+### Print the regions that are hot at the end of the trace and how the hot set moved over it
+def print_hotness(g):
+    if g.hotness is None or g.hotness.end == 0:
+        return
+    h = g.hotness
+    (score, age) = h.current()
+    top = top_indices(score, g.top_count_limit)
+    top = top[score[top] > 0]
+    logger.info("--------------------------------------------")
+    logger.info("Hottest regions now (decayed hits, %g second half-life, at %0.1f seconds):" % (h.half_life, h.end))
+    logger.info("%-24s %12s %12s" % ("Region", "Score", "Idle (s)"))
+    g.results['hotness'] = {'half_life': h.half_life, 'epoch': h.epoch, 'bucket_size': h.bucket_size, 'end': h.end, 'top': [], 'migration': []}
+    for b in top.tolist():
+        logger.info("%-24s %12.2f %12.1f" % ("%0.3f-%0.3f GB" % (b * h.bucket_size / g.GiB, (b + 1) * h.bucket_size / g.GiB), score[b], age[b]))
+        g.results['hotness']['top'].append({'bucket': b, 'offset_bytes': b * h.bucket_size, 'score': float(score[b]), 'idle_s': float(age[b])})
+
+    snapshots = h.migration(g.hot_set_percent)
+    logger.info("Hot set migration (hottest buckets holding %g%% of the decayed hits, every %g seconds):" % (g.hot_set_percent, h.epoch))
+    logger.info("%10s %10s %10s %10s %10s" % ("Time (s)", "Hot", "Entered", "Left", "Jaccard"))
+    previous = None
+    for (when, hot) in snapshots:
+        if previous is None:
+            (entered, left, jaccard) = (len(hot), 0, None)
         else:
-            g.w_totals[io_size] = hits
-    logger.debug( "Thread " + str(num) + " releasing write_totals lock t=" + str(g.thread_write_total) + " g=" + str(g.write_total.value))
-    g.write_totals_semaphore.release()
-
-    g.read_semaphore.acquire()
-    logger.debug( "Thread " + str(num) + " has read lock.")
-    for bucket,value in g.thread_reads.items():
-        print(f"bucket={bucket}")
-        try:
-            g.reads[bucket] += value
-        except:
-            g.reads[bucket] = value
-        logger.debug( "Thread " + str(num) + " has read lock.  Bucket=" + str(bucket) + " Value=" + str(value) + " g.reads[bucket]=" + str(g.reads[bucket]))
-    g.read_semaphore.release()
+            kept = len(np.intersect1d(previous, hot, assume_unique=True))
+            (entered, left) = (len(hot) - kept, len(previous) - kept)
+            union = len(hot) + len(previous) - kept
+            jaccard = kept / float(union) if union else None
+        logger.info("%10.1f %10d %10d %10d %10s" % (when, len(hot), entered, left, "NA" if jaccard is None else "%0.3f" % jaccard))
+        g.results['hotness']['migration'].append({'time': when, 'hot_buckets': len(hot), 'entered': entered, 'left': left, 'jaccard': jaccard})
+        previous = hot
+    logger.info("--------------------------------------------")
+    return
+# print_hotness (DONE)
+
+### Pipeline stage profiler for --profile
+### Stages nest, and time is charged to the innermost stage only, so the stage times add up to the run.
+### Each stage gets wall and CPU seconds (including child processes such as blktrace, blkparse and tar),
+### its call and event counts, with --profile_memory the peak tracemalloc memory while it ran and, with
+### --profile_dir, a cProfile of its own code.  tracemalloc hooks every allocation, so it is only started
+### when asked for.  Forked workers inherit the profiler and dump their own cProfile files
+class stage_profiler:
+    def __init__(self, profile_dir, memory=False):
+        self.profile_dir = profile_dir
+        self.memory = memory
+        self.stages = collections.OrderedDict()
+        self.stack = []
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.start = self.mark = self.clocks()
+
+    def clocks(self):
+        t = os.times()
+        return (time.perf_counter(), t.user + t.system + t.children_user + t.children_system)
+
+    def stage(self, name):
+        return self.stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'events': 0, 'peak_bytes': 0, 'profile': None})
+
+    ### Charge the time since the last switch to the stage on top of the stack
+    def pause(self):
+        if len(self.stack) == 0:
+            return
+        (wall, cpu) = self.clocks()
+        s = self.stage(self.stack[-1])
+        s['wall_s'] += wall - self.mark[0]
+        s['cpu_s'] += cpu - self.mark[1]
+        if self.memory:
+            s['peak_bytes'] = max(s['peak_bytes'], tracemalloc.get_traced_memory()[1])
+        if s['profile'] is not None:
+            s['profile'].disable()
+
+    def resume(self):
+        if len(self.stack) > 0:
+            s = self.stage(self.stack[-1])
+            if self.memory:
+                tracemalloc.reset_peak()
+            if self.profile_dir is not None:
+                if s['profile'] is None:
+                    s['profile'] = cProfile.Profile()
+                s['profile'].enable()
+        self.mark = self.clocks()
+
+    def begin(self, name):
+        self.pause()
+        self.stack.append(name)
+        self.stage(name)['calls'] += 1
+        self.resume()
+
+    def end(self):
+        self.pause()
+        self.stack.pop()
+        self.resume()
+
+    ### Time each step of a generator as a stage, counting the events in each batch
+    def batches(self, name, batches):
+        while True:
+            self.begin(name)
+            try:
+                batch = next(batches)
+            except StopIteration:
+                self.end()
+                return
+            self.stage(name)['events'] += len(batch[0])
+            self.end()
+            yield batch
+
+    ### Write the cProfile of every stage this process ran to <profile_dir>/<stage>.<pid>.prof
+    ### dump_stats() disables the profiler it writes, so the running stage's is enabled again.  Workers
+    ### dump after every task and each dump holds all of the tasks so far
+    def dump(self):
+        if self.profile_dir is None:
+            return []
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir, exist_ok=True)
+        files = []
+        for (name, s) in self.stages.items():
+            if s['profile'] is not None:
+                files.append(os.path.join(self.profile_dir, "%s.%d.prof" % (name.replace(" ", "_"), os.getpid())))
+                s['profile'].dump_stats(files[-1])
+        if len(self.stack) > 0 and self.stage(self.stack[-1])['profile'] is not None:
+            self.stage(self.stack[-1])['profile'].enable()
+        return files
+# stage_profiler (DONE)
+
+### Run the enclosed code as a --profile stage.  Does nothing without --profile
+@contextlib.contextmanager
+def profile_stage(g, name):
+    if g.profiler is None:
+        yield
+        return
+    g.profiler.begin(name)
+    try:
+        yield
+    finally:
+        g.profiler.end()
+# profile_stage (DONE)
+
+### Count events against a --profile stage
+def profile_events(g, name, count):
+    if g.profiler is not None:
+        g.profiler.stage(name)['events'] += count
+# profile_events (DONE)
+
+### Time a generator's batches as a --profile stage of their own
+def profile_batches(g, name, batches):
+    if g.profiler is None:
+        return batches
+    return g.profiler.batches(name, batches)
+# profile_batches (DONE)
+
+### End of a task in a worker process: dump its cProfile files.  The main process dumps in print_profile
+def profile_worker(g):
+    if g.profiler is not None and multiprocessing.current_process().name != 'MainProcess':
+        g.profiler.dump()
+# profile_worker (DONE)
+
+### Print where the time went, stage by stage, and dump the cProfile files
+def print_profile(g):
+    if g.profiler is None:
+        return
+    profiler = g.profiler
+    (wall, cpu) = profiler.clocks()
+    (wall, cpu) = (wall - profiler.start[0], cpu - profiler.start[1])
+    staged = sum(s['wall_s'] for s in profiler.stages.values())
+    logger.info("--------------------------------------------")
+    logger.info("Profile (%0.3f seconds wall, %0.3f seconds CPU):" % (wall, cpu))
+    logger.info(("%-14s %6s %10s %7s %10s %12s %12s %12s" % ("Stage", "Calls", "Wall (s)", "Wall %", "CPU (s)", "Events", "Events/sec", "Peak Memory" if profiler.memory else "")).rstrip())
+    for (name, s) in list(profiler.stages.items()) + [("other", {'calls': 0, 'wall_s': max(0.0, wall - staged), 'cpu_s': max(0.0, cpu - sum(s['cpu_s'] for s in profiler.stages.values())), 'events': 0, 'peak_bytes': 0})]:
+        logger.info(("%-14s %6s %10.3f %6.1f%% %10.3f %12s %12s %12s" % (name, s['calls'] or "", s['wall_s'], s['wall_s'] * 100.0 / wall if wall > 0 else 0.0, s['cpu_s'],
+            s['events'] or "", "%d" % (s['events'] / s['wall_s']) if s['events'] and s['wall_s'] > 0 else "", size_str(g, s['peak_bytes']) if s['peak_bytes'] else "")).rstrip())
+    if profiler.memory:
+        logger.info("Peak memory is the most traced by tracemalloc while the stage ran (Python and numpy allocations).  Times include its overhead")
+    files = profiler.dump()
+    if len(files) > 0:
+        logger.info("cProfile output for each stage and process: %s/<stage>.<pid>.prof (e.g. %s)" % (profiler.profile_dir, os.path.basename(files[0])))
+    logger.info("--------------------------------------------")
+# print_profile (DONE)
+
+### Cache policy simulators for 'simulate' mode
+### Every policy allocates on read and write misses.  Dirty blocks are tracked, so one replay gives
+### the write-through traffic (every write) and the write-back traffic (dirty evictions).
+### The lists are OrderedDicts, a hash map over a C doubly linked list, so every step is O(1) but
+### still a few interpreted bytecodes per block reference: the replay is not vectorized, and its cost
+### grows with block references times caches.  feed() takes a whole batch, keeps its counters in
+### locals and only counts misses and writebacks in the loop; account() derives the hits from the
+### batch totals
+class cache_policy:
+    __slots__ = ('name', 'size', 'hits', 'misses', 'promotions', 'writebacks', 'dirty')
+
+    def __init__(self, name, size):
+        self.name       = name
+        self.size       = size      # Cache size in blocks
+        self.hits       = [0, 0]    # [read, write] hits
+        self.misses     = [0, 0]    # [read, write] misses
+        self.promotions = 0         # Blocks brought into the cache
+        self.writebacks = 0         # Dirty blocks written back on eviction
+        self.dirty      = set()     # Dirty blocks currently cached
+
+    ### Fold in the counts from one feed() of refs references, writes of them writes
+    def account(self, refs, writes, misses, writebacks):
+        self.hits[0]    += refs - writes - misses[0]
+        self.hits[1]    += writes - misses[1]
+        self.misses[0]  += misses[0]
+        self.misses[1]  += misses[1]
+        self.promotions += misses[0] + misses[1]
+        self.writebacks += writebacks
+# cache_policy (DONE)
+
+### LRU
+class lru_cache(cache_policy):
+    __slots__ = ('cache',)
+
+    def __init__(self, name, size):
+        cache_policy.__init__(self, name, size)
+        self.cache = collections.OrderedDict()
+
+    def feed(self, blocks, writes):
+        cache = self.cache
+        size = self.size
+        dirty = self.dirty
+        move = cache.move_to_end
+        pop = cache.popitem
+        misses = [0, 0]
+        writebacks = 0
+        for (block, w) in zip(blocks, writes):
+            if block in cache:
+                move(block)
+            else:
+                misses[w] += 1
+                cache[block] = None
+                if len(cache) > size:
+                    victim = pop(False)[0]
+                    if victim in dirty:
+                        dirty.remove(victim)
+                        writebacks += 1
+            if w:
+                dirty.add(block)
+        self.account(len(blocks), sum(writes), misses, writebacks)
+# lru_cache (DONE)
+
+### LFU with O(1) frequency lists.  Ties are broken by LRU order
+class lfu_cache(cache_policy):
+    __slots__ = ('freq', 'lists', 'min_freq')
+
+    def __init__(self, name, size):
+        cache_policy.__init__(self, name, size)
+        self.freq     = {}  # Block -> reference count
+        self.lists    = {}  # Reference count -> OrderedDict of blocks
+        self.min_freq = 0
+
+    def feed(self, blocks, writes):
+        freq = self.freq
+        lists = self.lists
+        dirty = self.dirty
+        size = self.size
+        min_freq = self.min_freq
+        ordered = collections.OrderedDict
+        misses = [0, 0]
+        writebacks = 0
+        for (block, w) in zip(blocks, writes):
+            f = freq.get(block)
+            if f is not None:
+                l = lists[f]
+                del l[block]
+                if not l:
+                    del lists[f]
+                    if min_freq == f:
+                        min_freq = f + 1
+                f += 1
+                freq[block] = f
+            else:
+                misses[w] += 1
+                if len(freq) >= size:
+                    l = lists[min_freq]
+                    victim = l.popitem(False)[0]
+                    if not l:
+                        del lists[min_freq]
+                    del freq[victim]
+                    if victim in dirty:
+                        dirty.remove(victim)
+                        writebacks += 1
+                f = freq[block] = min_freq = 1
+            l = lists.get(f)
+            if l is None:
+                l = lists[f] = ordered()
+            l[block] = None
+            if w:
+                dirty.add(block)
+        self.min_freq = min_freq
+        self.account(len(blocks), sum(writes), misses, writebacks)
+# lfu_cache (DONE)
+
+### ARC (Megiddo and Modha).  T1/T2 hold cached blocks, B1/B2 are the ghost lists
+class arc_cache(cache_policy):
+    __slots__ = ('t1', 't2', 'b1', 'b2', 'p')
+
+    def __init__(self, name, size):
+        cache_policy.__init__(self, name, size)
+        self.t1 = collections.OrderedDict()
+        self.t2 = collections.OrderedDict()
+        self.b1 = collections.OrderedDict()
+        self.b2 = collections.OrderedDict()
+        self.p  = 0.0 # Target size of T1
+
+    ### Move the LRU block of T1 or T2 to its ghost list.  Returns the evicted block
+    def replace(self, p, in_b2):
+        if len(self.t1) > 0 and (len(self.t1) > p or (in_b2 and len(self.t1) == p)):
+            victim = self.t1.popitem(False)[0]
+            self.b1[victim] = None
+        else:
+            victim = self.t2.popitem(False)[0]
+            self.b2[victim] = None
+        return victim
+
+    def feed(self, blocks, writes):
+        t1 = self.t1
+        t2 = self.t2
+        b1 = self.b1
+        b2 = self.b2
+        c = self.size
+        p = self.p
+        dirty = self.dirty
+        replace = self.replace
+        move = t2.move_to_end
+        misses = [0, 0]
+        writebacks = 0
+        for (block, w) in zip(blocks, writes):
+            if block in t1:
+                del t1[block]
+                t2[block] = None
+            elif block in t2:
+                move(block)
+            else:
+                misses[w] += 1
+                victim = None
+                if block in b1:
+                    p = min(c, p + max(len(b2) / len(b1), 1))
+                    victim = replace(p, False)
+                    del b1[block]
+                    t2[block] = None
+                elif block in b2:
+                    p = max(0, p - max(len(b1) / len(b2), 1))
+                    victim = replace(p, True)
+                    del b2[block]
+                    t2[block] = None
+                else:
+                    l1 = len(t1) + len(b1)
+                    if l1 >= c:
+                        if len(t1) < c:
+                            b1.popitem(False)
+                            victim = replace(p, False)
+                        else:
+                            victim = t1.popitem(False)[0]
+                    else:
+                        total = l1 + len(t2) + len(b2)
+                        if total >= c:
+                            if total >= 2 * c:
+                                b2.popitem(False)
+                            victim = replace(p, False)
+                    t1[block] = None
+                if victim in dirty:
+                    dirty.remove(victim)
+                    writebacks += 1
+            if w:
+                dirty.add(block)
+        self.p = p
+        self.account(len(blocks), sum(writes), misses, writebacks)
+# arc_cache (DONE)
+
+### 2Q (Johnson and Shasha, full version).  A1in is a FIFO for first references, A1out a ghost FIFO
+### and Am the LRU for blocks referenced again after leaving A1in
+class twoq_cache(cache_policy):
+    __slots__ = ('a1in', 'a1out', 'am', 'kin', 'kout')
+
+    def __init__(self, name, size):
+        cache_policy.__init__(self, name, size)
+        self.a1in  = collections.OrderedDict()
+        self.a1out = collections.OrderedDict()
+        self.am    = collections.OrderedDict()
+        self.kin   = max(1, size // 4)
+        self.kout  = max(1, size // 2)
+
+    def feed(self, blocks, writes):
+        a1in = self.a1in
+        a1out = self.a1out
+        am = self.am
+        size = self.size
+        kin = self.kin
+        kout = self.kout
+        dirty = self.dirty
+        move = am.move_to_end
+        misses = [0, 0]
+        writebacks = 0
+        for (block, w) in zip(blocks, writes):
+            if block in am:
+                move(block)
+            elif block not in a1in:
+                misses[w] += 1
+                # Reclaim a slot: the A1in tail goes to A1out once A1in is over its share
+                if len(a1in) + len(am) >= size:
+                    if len(a1in) > kin or not am:
+                        victim = a1in.popitem(False)[0]
+                        a1out[victim] = None
+                        if len(a1out) > kout:
+                            a1out.popitem(False)
+                    else:
+                        victim = am.popitem(False)[0]
+                    if victim in dirty:
+                        dirty.remove(victim)
+                        writebacks += 1
+                if block in a1out:
+                    del a1out[block]
+                    am[block] = None
+                else:
+                    a1in[block] = None
+            if w:
+                dirty.add(block)
+        self.account(len(blocks), sum(writes), misses, writebacks)
+# twoq_cache (DONE)
+
+cache_policies = {'lru': lru_cache, 'lfu': lfu_cache, 'arc': arc_cache, '2q': twoq_cache}
+
+### Replay the traced I/O through every cache policy and size at once
+def simulate_caches(g):
+    sim = cachesim_analyzer(g)
+    start = time.time()
+    for filename in g.file_list:
+        if not is_event_file(filename):
+            continue
+        for (writes, sectors, nsectors, times) in event_batches(g, filename):
+            sim.consume(event_batch(writes, sectors, nsectors, times, g.sector_size))
+            printf("\rReplayed %d block references (%d/s)", sim.references, sim.references / max(time.time() - start, 1e-6))
+            sys.stdout.flush()
+    logger.info("\rReplayed %d block references through %d caches in %0.1f seconds          " % (sim.references, len(sim.sims), time.time() - start))
+    return sim.sims
+# simulate_caches (DONE)
 
-    g.write_semaphore.acquire()
-    logger.debug( "Thread " + str(num) + " has write lock.")
-    for bucket,value in g.thread_writes.items():
-        try:
-            g.writes[bucket] += value
-        except:
-            g.writes[bucket] = value
-        logger.debug( "Thread " + str(num) + " has write lock.  Bucket=" + str(bucket) + " Value=" + str(value) + " g.writes[bucket]=" + str(g.writes[bucket]))
-    g.write_semaphore.release()
+### Print the cache simulation results
+def print_simulation(g, sims):
+    logger.info("--------------------------------------------")
+    logger.info("Cache Simulation (%s blocks, write-allocate):" % size_str(g, g.sim_block_size))
+    logger.info("%-6s %12s %8s %8s %8s %12s %12s %12s" % ("Policy", "Cache Size", "Hit%", "Read%", "Write%", "Promotions", "WB Writes", "WT Writes"))
+    g.results['simulation'] = {'block_size': g.sim_block_size, 'caches': []}
+    for sim in sims:
+        refs = sum(sim.hits) + sum(sim.misses)
+        g.results['simulation']['caches'].append({'policy': sim.name, 'cache_bytes': sim.size * g.sim_block_size,
+            'read_hits': sim.hits[0], 'read_misses': sim.misses[0], 'write_hits': sim.hits[1], 'write_misses': sim.misses[1],
+            'promotions': sim.promotions, 'writeback_bytes': sim.writebacks * g.sim_block_size, 'writethrough_bytes': (sim.hits[1] + sim.misses[1]) * g.sim_block_size})
+        logger.info("%-6s %12s %8s %8s %8s %12d %12s %12s" % (sim.name.upper(), size_str(g, sim.size * g.sim_block_size),
+            percent_str(float(sum(sim.hits)) / refs if refs else float('nan')),
+            percent_str(float(sim.hits[0]) / (sim.hits[0] + sim.misses[0]) if sim.hits[0] + sim.misses[0] else float('nan')),
+            percent_str(float(sim.hits[1]) / (sim.hits[1] + sim.misses[1]) if sim.hits[1] + sim.misses[1] else float('nan')),
+            sim.promotions, size_str(g, sim.writebacks * g.sim_block_size), size_str(g, (sim.hits[1] + sim.misses[1]) * g.sim_block_size)))
+    logger.info("WB Writes: dirty blocks written back on eviction (write-back).  WT Writes: every write (write-through)")
+    logger.info("--------------------------------------------")
+    return
+# print_simulation (DONE)
+
+
+### Blocks touched by each I/O.  Returns the block numbers and, for each block, the index of its I/O
+def io_blocks(sectors, nsectors, sector_size, block_size):
+    first = (sectors * sector_size) // block_size
+    last = ((sectors + np.maximum(nsectors, 1) - 1) * sector_size) // block_size
+    span = last - first + 1
+    index = np.repeat(np.arange(len(first)), span)
+    blocks = first[index] + (np.arange(len(index)) - np.repeat(np.cumsum(span) - span, span))
+    return (blocks, index)
+# io_blocks (DONE)
+
+### Binary event codec, the '.blkparse.ioev' trace chunks written with --codec zlib or lzma.  A chunk is a
+### header, independently compressed blocks of up to codec_block_events I/O's, a block index and a trailer
+### pointing at the index, so the blocks can be decoded in parallel and in any order.  Within a block the
+### timestamps (nanoseconds) and sectors are delta coded, zigzag'd, stored at the narrowest integer width
+### that holds them and byte shuffled (all the low bytes, then the next ones up), and each I/O's size and
+### direction is a code into a per-block dictionary
+codec_magic   = b"IOEV"
+codec_version = 1
+codec_methods = {'zlib': 0, 'lzma': 1}
+codec_header  = struct.Struct("<4sBB")                 # magic, version, method
+codec_block   = struct.Struct("<IBBBBIqq")             # events, time mode, time width, sector width, code width, dictionary size, first time, first sector
+codec_entry   = struct.Struct("<QII")                  # block offset, compressed length, events
+codec_trailer = struct.Struct("<QI4s")                 # index offset, blocks, magic
+codec_widths  = {1: "<u1", 2: "<u2", 4: "<u4", 8: "<u8"}
+
+### Narrowest unsigned width in bytes for values up to top
+def codec_width(top):
+    for width in (1, 2, 4):
+        if top < (1 << (8 * width)):
+            return width
+    return 8
+# codec_width (DONE)
+
+### Zigzag'd deltas of an int64 column, first delta 0, at the narrowest width and byte shuffled
+### Returns (width, bytes)
+def codec_deltas(values):
+    deltas = np.diff(values, prepend=values[:1])
+    zigzag = ((deltas << 1) ^ (deltas >> 63)).view(np.uint64)
+    width = codec_width(int(zigzag.max()))
+    return (width, zigzag.astype(codec_widths[width]).view(np.uint8).reshape(-1, width).T.tobytes())
+# codec_deltas (DONE)
+
+### Inverse of codec_deltas
+def codec_undelta(data, offset, width, first, count):
+    shuffled = np.frombuffer(data, dtype=np.uint8, count=width * count, offset=offset).reshape(width, count)
+    zigzag = np.ascontiguousarray(shuffled.T).view(codec_widths[width]).reshape(-1).astype(np.uint64)
+    deltas = ((zigzag >> np.uint64(1)) ^ (np.uint64(0) - (zigzag & np.uint64(1)))).view(np.int64)
+    deltas[0] = first
+    return np.cumsum(deltas)
+# codec_undelta (DONE)
+
+### One block of I/O's, uncompressed.  Time mode 0 is a trace without timestamps, 1 delta coded
+### nanoseconds and 2 raw float64 seconds, for the odd trace that has some timestamps missing
+def encode_block(writes, sectors, nsectors, times):
+    count = len(writes)
+    # Dictionary keys are nsectors * 2 + write
+    (keys, codes) = np.unique(nsectors * 2 + writes, return_inverse=True)
+    code_width = codec_width(len(keys) - 1)
+    nanos = np.rint(times * 1e9).astype(np.int64) if count and np.isfinite(times).all() else None
+    (time_mode, time_width, time_data, first_time) = (0, 0, b"", 0)
+    if nanos is not None:
+        (time_width, time_data) = codec_deltas(nanos)
+        (time_mode, first_time) = (1, int(nanos[0]))
+    elif not np.isnan(times).all():
+        (time_mode, time_data) = (2, times.astype(np.float64).tobytes())
+    (sector_width, sector_data) = codec_deltas(sectors)
+    head = codec_block.pack(count, time_mode, time_width, sector_width, code_width, len(keys), first_time, int(sectors[0]))
+    return b"".join((head, keys.astype(np.int64).tobytes(), codes.reshape(-1).astype(codec_widths[code_width]).tobytes(), sector_data, time_data))
+# encode_block (DONE)
+
+### Inverse of encode_block.  Returns (writes, sectors, nsectors, times) columns
+def decode_block(data):
+    (count, time_mode, time_width, sector_width, code_width, size, first_time, first_sector) = codec_block.unpack_from(data)
+    at = codec_block.size
+    keys = np.frombuffer(data, dtype=np.int64, count=size, offset=at)
+    at += 8 * size
+    keys = keys[np.frombuffer(data, dtype=codec_widths[code_width], count=count, offset=at)]
+    at += code_width * count
+    sectors = codec_undelta(data, at, sector_width, first_sector, count)
+    at += sector_width * count
+    if time_mode == 1:
+        times = codec_undelta(data, at, time_width, first_time, count) / 1e9
+    elif time_mode == 2:
+        times = np.frombuffer(data, dtype=np.float64, count=count, offset=at).copy()
+    else:
+        times = np.full(count, float('nan'))
+    return ((keys & 1).astype(bool), sectors, keys >> 1, times)
+# decode_block (DONE)
+
+### Write batches of (writes, sectors, nsectors, times) to a binary chunk.  Returns the number of I/O's
+def encode_events(g, filename, batches):
+    method = codec_methods[g.codec]
+    compress = (lambda data: zlib.compress(data, 6)) if g.codec == 'zlib' else (lambda data: lzma.compress(data, preset=1))
+    index = []
+    count = 0
+    with open(filename, "wb") as fo:
+        fo.write(codec_header.pack(codec_magic, codec_version, method))
+        for (writes, sectors, nsectors, times) in batches:
+            for start in range(0, len(writes), g.codec_block_events):
+                end = start + g.codec_block_events
+                data = compress(encode_block(writes[start:end], sectors[start:end], nsectors[start:end], times[start:end]))
+                index.append(codec_entry.pack(fo.tell(), len(data), len(writes[start:end])))
+                fo.write(data)
+            count += len(writes)
+        at = fo.tell()
+        fo.write(b"".join(index))
+        fo.write(codec_trailer.pack(at, len(index), codec_magic))
+    return count
+# encode_events (DONE)
+
+### Read the queued I/O's of a binary chunk in batches of one block.  codec_threads threads decompress
+### and decode the blocks ahead of the reader (zlib, lzma and numpy release the GIL), a bounded window
+### of them at a time so memory stays flat
+def codec_batches(g, filename):
+    try:
+        with open(filename, "rb") as fo:
+            data = fo.read()
+    except IOError as e:
+        logger.error("ERROR: Failed to open " + filename + ": " + str(e))
+        sys.exit(3)
+    (magic, version, method) = codec_header.unpack_from(data)
+    (at, blocks, tail) = codec_trailer.unpack_from(data, len(data) - codec_trailer.size)
+    if magic != codec_magic or tail != codec_magic or version != codec_version:
+        logger.error("ERROR: " + filename + " is not an ioprof event chunk (or is truncated)")
+        sys.exit(3)
+    decompress = zlib.decompress if method == codec_methods['zlib'] else lzma.decompress
+    entries = [codec_entry.unpack_from(data, at + i * codec_entry.size) for i in range(blocks)]
+    view = memoryview(data)
+    decode = lambda entry: decode_block(decompress(view[entry[0]:entry[0] + entry[1]]))
+    threads = g.codec_threads if g.codec_threads > 0 else multiprocessing.cpu_count()
+    if threads == 1 or blocks < 2:
+        for entry in entries:
+            yield decode(entry)
+        return
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        pending = collections.deque()
+        for entry in entries:
+            pending.append(pool.submit(decode, entry))
+            if len(pending) > 2 * threads:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+# codec_batches (DONE)
+
+### Whether a tarball member is a chunk of trace events, blkparse text or binary
+def is_event_file(filename):
+    return re.search("blk\.out\.\S+\.\d+\.blkparse\.(gz|ioev)$", filename) is not None
+# is_event_file (DONE)
+
+### Name of a trace chunk in the g.codec format
+def event_file(g, chunk):
+    return "blk.out.%s.%d.blkparse.%s" % (g.device_str, chunk, "gz" if g.codec == 'gzip' else "ioev")
+# event_file (DONE)
+
+### Read the queued I/O's of a trace chunk in batches of (writes, sectors, nsectors, times) arrays
+### times are the event timestamps in seconds, NaN for traces captured without them
+def event_batches(g, filename):
+    if filename.endswith(".ioev"):
+        yield from codec_batches(g, filename)
+        return
+    pattern = re.compile(g.event_regex)
+    writes = []
+    sectors = []
+    nsectors = []
+    times = []
+    try:
+        fo = gzip.open(filename, "rt") if filename.endswith(".gz") else open(filename, "r")
+    except IOError as e:
+        logger.error("ERROR: Failed to open " + filename + ": " + str(e))
+        sys.exit(3)
+    with fo:
+        for line in fo:
+            match = pattern.search(line)
+            if match is None or match.group(1) not in ('R', 'RW', 'W', 'WS'):
+                continue
+            try:
+                sector = int(match.group(2))
+                nsector = int(match.group(3))
+                stamp = float(match.group(4)) if match.group(4) is not None else float('nan')
+            except ValueError:
+                continue
+            writes.append(match.group(1)[0] == 'W')
+            sectors.append(sector)
+            nsectors.append(nsector)
+            times.append(stamp)
+            if len(writes) >= g.batch_events:
+                yield (np.array(writes, dtype=bool), np.array(sectors, dtype=np.int64), np.array(nsectors, dtype=np.int64), np.array(times, dtype=np.float64))
+                writes = []
+                sectors = []
+                nsectors = []
+                times = []
+    if len(writes) > 0:
+        yield (np.array(writes, dtype=bool), np.array(sectors, dtype=np.int64), np.array(nsectors, dtype=np.int64), np.array(times, dtype=np.float64))
+# event_batches (DONE)
+
+### The queued I/O's of a plain blkparse text file in the g.blkparse_format layout as one batch.  The
+### fields are split into columns by numpy instead of a regex per line, fast enough to keep up with
+### 'trace' mode.  Any other layout goes through event_batches()
+def blkparse_batches(g, filename):
+    with open(filename, "rb") as fo:
+        text = fo.read()
+    lines = text.count(b"\n")
+    fields = np.array(text.split())
+    if len(fields) != 5 * lines:
+        yield from event_batches(g, filename)
+        return
+    fields = fields.reshape(lines, 5)
+    fields = fields[(fields[:, 1] == b"Q") & np.isin(fields[:, 0], [b"R", b"RW", b"W", b"WS"])]
+    try:
+        columns = (np.char.startswith(fields[:, 0], b"W"), fields[:, 2].astype(np.int64), fields[:, 3].astype(np.int64), fields[:, 4].astype(np.float64))
+    except ValueError:
+        yield from event_batches(g, filename)
+        return
+    yield columns
+# blkparse_batches (DONE)
+
+### One parsed batch of queued I/O's as columns, shared by every analyzer.  The split of the I/O's into
+### blocks is worked out once per block size, so analyzers at the same granularity share it
+class event_batch:
+    __slots__ = ('writes', 'sectors', 'nsectors', 'times', 'sector_size', 'split')
+
+    def __init__(self, writes, sectors, nsectors, times, sector_size):
+        self.writes      = writes                      # True for writes
+        self.sectors     = sectors                     # First sector of each I/O
+        self.nsectors    = nsectors                    # Sectors per I/O
+        self.times       = times                       # Seconds since the start of the trace (NaN if unknown)
+        self.sector_size = sector_size
+        self.split       = {}                          # Block size -> io_blocks() output
+
+    def __len__(self):
+        return len(self.writes)
+
+    ### Blocks touched by each I/O and the index of each block's I/O, see io_blocks()
+    def blocks(self, block_size):
+        if block_size not in self.split:
+            self.split[block_size] = io_blocks(self.sectors, self.nsectors, self.sector_size, block_size)
+        return self.split[block_size]
+# event_batch (DONE)
+
+### Event analyzers.  parse_events() decodes each batch once and hands it to the consume() of every
+### enabled analyzer.  merge() adds a partial analyzer of the same kind (other trace files, other
+### workers) and finalize(g) folds the results into the profile and starts over.  Ordered analyzers
+### depend on seeing the events in trace order, so they run in the parsing process and cannot be merged
+class event_analyzer:
+    name = None
+    ordered = False
+
+    def consume(self, batch):
+        return
 
-    g.total_semaphore.acquire()
-    logger.debug( "Thread " + str(num) + " has total lock t=" + str(g.thread_bucket_hits_total) + " g=" + str(g.bucket_hits_total.value))
-    g.bucket_hits_total.value += g.thread_bucket_hits_total
-    logger.debug( "Thread " + str(num) + " releasing total lock t=" + str(g.thread_bucket_hits_total) + " g=" + str(g.bucket_hits_total.value))
-    g.total_semaphore.release()
+    def merge(self, other):
+        raise ValueError("the " + self.name + " analyzer needs every event in trace order and cannot be merged")
 
-    return
-# total_thread_counts (DONE)
+    def finalize(self, g):
+        return
+# event_analyzer (DONE)
+
+### Bucket hits, bucket boundary crossings and I/O size counts.  Always enabled
+class count_analyzer(event_analyzer):
+    name = 'counts'
+
+    def __init__(self, g):
+        self.sector_size = g.sector_size
+        self.bucket_size = g.bucket_size
+        self.num_buckets = g.num_buckets
+        self.chunk       = g.counter_chunk
+        # With --memmap_dir the hits go straight into the profile's memmap counters, so there is nothing to fold in
+        self.shared      = g.memmap_dir is not None and isinstance(g.reads, memmap_counter)
+        self.reset(g)
+
+    def reset(self, g):
+        for name in ('reads', 'writes', 'read_crossings', 'write_crossings'):
+            setattr(self, name, getattr(g, name) if self.shared else bucket_counter(self.chunk))
+        self.io_total     = 0                          # I/O's
+        self.read_total   = 0                          # Read I/O's
+        self.write_total  = 0                          # Write I/O's
+        self.bucket_hits  = 0                          # Bucket hits (1 I/O can touch many buckets)
+        self.total_blocks = 0                          # Sectors accessed
+        self.r_totals     = {}                         # Read I/O's by size in sectors
+        self.w_totals     = {}                         # Write I/O's by size in sectors
+
+    def consume(self, batch):
+        (buckets, index) = batch.blocks(self.bucket_size)
+        # Not sure why, but we occassionally get buckets beyond our max LBA range
+        buckets = np.minimum(buckets, self.num_buckets - 1)
+        bucket_writes = batch.writes[index]
+        self.reads.add(buckets[~bucket_writes])
+        self.writes.add(buckets[bucket_writes])
+        # Every bucket of an I/O after its first is a boundary crossing.  Keeping these lets a coarser
+        # re-bucketing count the I/O once per coarse bucket, as if it had been parsed at that size
+        crossing = np.zeros(len(buckets), dtype=bool)
+        crossing[1:] = index[1:] == index[:-1]
+        self.read_crossings.add(buckets[crossing & ~bucket_writes])
+        self.write_crossings.add(buckets[crossing & bucket_writes])
+        self.bucket_hits += len(buckets)
+
+        (writes, nsectors) = (batch.writes, batch.nsectors)
+        write_count = int(np.count_nonzero(writes))
+        self.total_blocks += int(nsectors.sum())
+        self.io_total += len(writes)
+        self.read_total += len(writes) - write_count
+        self.write_total += write_count
+        for (totals, sizes) in ((self.r_totals, nsectors[~writes]), (self.w_totals, nsectors[writes])):
+            (sizes, counts) = np.unique(sizes, return_counts=True)
+            for (size, count) in zip(sizes.tolist(), counts.tolist()):
+                totals[size] = totals.get(size, 0) + count
+
+    def merge(self, other):
+        for name in ('reads', 'writes', 'read_crossings', 'write_crossings'):
+            getattr(self, name).merge(getattr(other, name))
+        for name in ('io_total', 'read_total', 'write_total', 'bucket_hits', 'total_blocks'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for (totals, other_totals) in ((self.r_totals, other.r_totals), (self.w_totals, other.w_totals)):
+            for (size, count) in other_totals.items():
+                totals[size] = totals.get(size, 0) + count
+
+    ### Combine these counts into the global counts
+    def finalize(self, g):
+        g.total_blocks_semaphore.acquire()
+        g.total_blocks.value += self.total_blocks
+        g.total_blocks_semaphore.release()
+
+        g.total_semaphore.acquire()
+        g.io_total.value += self.io_total
+        g.bucket_hits_total.value += self.bucket_hits
+        g.total_semaphore.release()
+
+        for (semaphore, total, totals, count, counts) in ((g.read_totals_semaphore, g.read_total, g.r_totals, self.read_total, self.r_totals),
+                (g.write_totals_semaphore, g.write_total, g.w_totals, self.write_total, self.w_totals)):
+            semaphore.acquire()
+            total.value += count
+            for (io_size, hits) in counts.items():
+                totals[io_size] = totals.get(io_size, 0) + hits
+            semaphore.release()
+
+        if not self.shared:
+            g.read_semaphore.acquire()
+            g.reads.merge(self.reads)
+            g.read_semaphore.release()
+
+            g.write_semaphore.acquire()
+            g.writes.merge(self.writes)
+            g.write_semaphore.release()
+
+            g.read_crossings.merge(self.read_crossings)
+            g.write_crossings.merge(self.write_crossings)
+
+        g.max_bucket_hits_semaphore.acquire()
+        g.max_bucket_hits.value = max(g.reads.max(), g.writes.max())
+        g.max_bucket_hits_semaphore.release()
+        logger.debug("counts: io_total=" + str(g.io_total.value) + " bucket_hits_total=" + str(g.bucket_hits_total.value) + " max_bucket_hits=" + str(g.max_bucket_hits.value))
+        # Folded in now.  Start over so the next file isn't counted twice
+        self.reset(g)
+# count_analyzer (DONE)
+
+### Per-interval IOPS and bandwidth (g.timeline)
+class timeline_analyzer(event_analyzer):
+    name = 'timeline'
+
+    def __init__(self, g):
+        self.sector_size = g.sector_size
+        self.timeline = io_timeline(g.interval)
+
+    def consume(self, batch):
+        self.timeline.add(batch.times, batch.writes, batch.nsectors, self.sector_size)
+
+    def merge(self, other):
+        self.timeline.merge(other.timeline)
+
+    def finalize(self, g):
+        if g.timeline is None:
+            g.timeline = self.timeline
+        else:
+            g.timeline.merge(self.timeline)
+        self.timeline = io_timeline(self.timeline.interval)
+# timeline_analyzer (DONE)
+
+### LRU miss-ratio curve (g.mrc, --mrc)
+class mrc_analyzer(event_analyzer):
+    name = 'mrc'
+    ordered = True
+
+    def __init__(self, g):
+        self.mrc = shards_mrc(g.mrc_block_size, g.sector_size, g.mrc_rate, g.mrc_samples)
+
+    def consume(self, batch):
+        self.mrc.add_events(batch.writes, batch.sectors, batch.nsectors, batch.blocks(self.mrc.block_size))
+
+    def finalize(self, g):
+        g.mrc = self.mrc
+# mrc_analyzer (DONE)
+
+### Time-decayed hotness per report bucket (g.hotness, --hotness)
+class hotness_analyzer(event_analyzer):
+    name = 'hotness'
+    ordered = True
+
+    def __init__(self, g):
+        path = None if g.memmap_dir is None else memmap_path(g, "hotness", (".score", ".last"))
+        bucket_size = g.hot_bucket_size if g.hot_bucket_size is not None else g.bucket_size
+        num_buckets = max(1, g.total_lbas * g.sector_size // bucket_size)
+        self.hotness = bucket_hotness(bucket_size, g.sector_size, num_buckets, g.half_life, g.hot_epoch, g.counter_chunk, path)
+
+    def consume(self, batch):
+        self.hotness.add_events(batch.times, batch.sectors, batch.nsectors)
+
+    def finalize(self, g):
+        g.hotness = self.hotness
+# hotness_analyzer (DONE)
+
+### Cache policy simulation (g.sims, 'simulate' mode or --analyzers cachesim)
+class cachesim_analyzer(event_analyzer):
+    name = 'cachesim'
+    ordered = True
+
+    def __init__(self, g):
+        sizes = g.sim_cache_sizes
+        if len(sizes) == 0:
+            capacity = g.total_lbas * g.sector_size
+            sizes = [int(capacity * percent / 100.0) for percent in g.sim_cache_percents]
+        self.block_size = g.sim_block_size
+        self.sims = [cache_policies[policy](policy, max(1, size // g.sim_block_size)) for policy in g.sim_policies for size in sizes]
+        self.references = 0                            # Block references replayed
+
+    def consume(self, batch):
+        (blocks, index) = batch.blocks(self.block_size)
+        block_list = blocks.tolist()
+        write_list = batch.writes[index].astype(np.int8).tolist()
+        for sim in self.sims:
+            sim.feed(block_list, write_list)
+        self.references += len(block_list)
+
+    def finalize(self, g):
+        g.sims = self.sims
+# cachesim_analyzer (DONE)
+
+### Analyzers by name.  'counts' is always enabled.  --mrc, --hotness and --analyzers add the others
+event_analyzers = {'counts': count_analyzer, 'timeline': timeline_analyzer, 'mrc': mrc_analyzer, 'hotness': hotness_analyzer, 'cachesim': cachesim_analyzer}
+
+### New instances of the enabled analyzers for a profile, in the order they consume each batch
+def start_analyzers(g):
+    return [event_analyzers[name](g) for name in g.analyzer_names]
+# start_analyzers (DONE)
+
+### Fold every analyzer's results into the profile
+def finalize_analyzers(g):
+    for analyzer in g.analyzers:
+        analyzer.finalize(g)
+# finalize_analyzers (DONE)
+
+### Parse one blktrace output file through g.analyzers.  Returns the number of I/O's
+def parse_file(g, file):
+    count = 0
+    offset = chunk_offset(g, file)
+    with profile_stage(g, "parse"):
+        # With --profile the gzip read and line scan behind each batch count as 'decompress'
+        for (writes, sectors, nsectors, times) in profile_batches(g, "decompress", event_batches(g, file)):
+            count += len(writes)
+            parse_events(g, writes, sectors, nsectors, times + offset)
+        profile_events(g, "parse", count)
+    return count
+# parse_file (DONE)
 
 ### Thread parse routine for blktrace output
 def thread_parse(g, file, num):
     logger.debug("thread_parse")
     logger.debug("========================")
-    linecount = 0
-    os.system("gunzip " + file + ".gz")
     logger.debug( "\nSTART: " +  file + " " + str(num) + "\n")
-    try:
-        with open(file, "r") as fo:
-
-            count=0
-            hit_count = 0
-            for line in fo:
-                count += 1
-                result_set = regex_find(g, '(\S+)\s+Q\s+(\S+)\s+(\S+)$', line)
-                if result_set != False:
-                    #(a, b, c) = regex_find('.*Q.*', line)
-                    hit_count += 1
-                    #print len(set)
-                    #print "a=" + a + " b=" + b + " c=" + c + "\n"
-                    #print set
-                    #sys.stdout.flush()
-                    try:
-                        #logger.debug("HIT HIT HIT")
-                        parse_me(g, result_set[0], int(result_set[1]), int(result_set[2]))
-                    except:
-                        pass
-                #sys.stdout.flush()
+    count = parse_file(g, file)
 
-        total_thread_counts(g, num)
-        logger.debug(  "\n FINISH" + file +  " (" + str(count) + " lines) [hit_count=" + str(hit_count) + "]" + str(g.thread_io_total) + "\n")
-        rc = os.system("rm -f " + file)
-    except BaseException as base_e:
-        logger.error(f"ERROR: Failed to open {file}: {base_e}")
-        sys.exit(3)
+    with profile_stage(g, "merge"):
+        finalize_analyzers(g)
+    logger.debug(  "\n FINISH" + file +  " (" + str(count) + " I/O's)\n")
     return g
-
 # thread_parse (DONE)
 
-### Parse blktrace output
-def parse_me(g, rw, lba, size):
-    #logger.debug(  "rw=" + rw + " lba=" + str(lba) + " size=" + str(size))
-    if (rw == 'R') or (rw == 'RW'):
-        # Read
-        #logger.debug("read")
-        g.thread_total_blocks += int(size)
-        g.thread_io_total += 1
-        g.thread_read_total += 1
-        if size in g.thread_r_totals:
-            g.thread_r_totals[size] += 1
-        else:
-            g.thread_r_totals[size] = 1
-        bucket_hits = (size * g.sector_size) / g.bucket_size
-        bucket_hits = 1 # BEN
-        if ((size * g.sector_size) % g.bucket_size) != 0:
-            bucket_hits += 1
-        for i in range(0, bucket_hits):
-            bucket = int((lba * g.sector_size) / g.bucket_size) + i
-            if bucket > g.num_buckets:
-                # Not sure why, but we occassionally get buckets beyond our max LBA range
-                bucket = g.num_buckets - 1
-            if True:
-                if bucket in g.thread_reads:
-                    g.thread_reads[bucket] += 1
-                else:
-                    g.thread_reads[bucket] = 1
-            else:
-                try:
-                    g.thread_reads[bucket] += 1
-                except:
-                    g.thread_reads[bucket] = 1
-            if(g.thread_reads[bucket] > g.thread_max_bucket_hits):
-                g.thread_max_bucket_hits = g.thread_reads[bucket]
-            g.thread_bucket_hits_total += 1
-    elif (rw == 'W') or (rw == 'WS'):
-        # Write
-        #logger.debug("write")
-        g.thread_total_blocks += int(size)
-        g.thread_io_total += 1
-        g.thread_write_total += 1
-        if size in g.thread_w_totals:
-            g.thread_w_totals[size] += 1
-        else:
-            g.thread_w_totals[size] = 1
-        bucket_hits = (size * g.sector_size) / g.bucket_size
-        bucket_hits = 1 # BEN
-        #print(bucket_hits)
-        if ((size * g.sector_size) % g.bucket_size) != 0:
-            bucket_hits += 1
-        for i in range(0, bucket_hits):
-            bucket = int((lba * g.sector_size) / g.bucket_size) + i
-            if bucket > g.num_buckets:
-                # Not sure why, but we occassionally get buckets beyond our max LBA range
-                bucket = g.num_buckets - 1
-            if True:
-                if bucket in g.thread_writes:
-                    g.thread_writes[bucket] += 1
-                else:
-                    g.thread_writes[bucket] = 1
-            else:
-                try:
-                    g.thread_writes[bucket] += 1
-                except:
-                    g.thread_writes[bucket] = 1
-            if(g.thread_writes[bucket] > g.thread_max_bucket_hits):
-                g.thread_max_bucket_hits = g.thread_writes[bucket]
-            g.thread_bucket_hits_total += 1
-    return
-# parse_me (DONE)
+### State inherited by the parse worker processes
+parse_state = {}
+
+### Parse one blktrace output file in a worker with analyzers of its own and return them for merging
+def parse_worker(file):
+    g = parse_state['g']
+    g.analyzers = start_analyzers(g)
+    if g.codec_threads == 0:
+        g.codec_threads = 1                            # The workers already cover the CPUs
+    parse_file(g, file)
+    profile_worker(g)
+    return g.analyzers
+# parse_worker (DONE)
+
+### Parse the blktrace output files in parse_workers processes and merge their analyzers into g.analyzers
+### Returns False, leaving the files to the caller, for one worker or when an analyzer needs the events in order.
+### Inside a 'merge' or 'benchmark' worker the files are parsed serially: pool workers are daemonic and
+### cannot start a pool of their own
+def parse_in_workers(g, files):
+    workers = min(len(files), g.parse_workers if g.parse_workers > 0 else multiprocessing.cpu_count())
+    if workers < 2 or multiprocessing.current_process().daemon:
+        return False
+    ordered = [analyzer.name for analyzer in g.analyzers if analyzer.ordered]
+    if g.memmap_dir is not None:
+        ordered.append("--memmap_dir")
+    if len(ordered) > 0:
+        logger.info("Parsing in one process: " + ",".join(ordered) + " needs the events in trace order")
+        return False
+    parse_state['g'] = g
+    pool = Pool(workers)
+    done = 0
+    for analyzers in pool.imap_unordered(parse_worker, files):
+        done += 1
+        printf("\rInput Percent: %d %% (File %d of %d) workers=%d", (done * 100 / len(files)), done, len(files), workers)
+        sys.stdout.flush()
+        with profile_stage(g, "merge"):
+            for (analyzer, other) in zip(g.analyzers, analyzers):
+                analyzer.merge(other)
+    pool.close()
+    pool.join()
+    with profile_stage(g, "merge"):
+        finalize_analyzers(g)
+    return True
+# parse_in_workers (DONE)
+
+### Hand a batch of I/O's to every enabled analyzer
+### times are seconds since the start of the trace (NaN if unknown)
+def parse_events(g, writes, sectors, nsectors, times):
+    batch = event_batch(writes, sectors, nsectors, times, g.sector_size)
+    for analyzer in g.analyzers:
+        analyzer.consume(batch)
+# parse_events (DONE)
 
 ## File trace routine
 def parse_filetrace(g, filename, num):
@@ -1188,33 +3431,164 @@ def clear_screen(g):
     return
 # clear_screen (DONE)
 
-### Get block value by combining buckets into larger heatmap blocks for term
-def get_value(g, offset, rate):
-    start = offset * rate
-    end = start + rate
-    sum = 0
-
-    g.debug = True
-    logger.debug( "start=" + start + " end=" + end)
-    g.debug = False
-
-    index=start
-    while(index <= end):
-        index+=1
-        r = 0
-        w = 0
-        if index in g.reads:
-            r = g.reads[index]
-        if index in g.writes:
-            w = g.writes[index]
-        sum = sum + r + w
-
-    g.debug = True
-    logger.debug( "s=" + sum)
-    g.debug = False
-
-    return sum
-# get_value (DONE)
+### Hits per heatmap cell, each cell summing rate buckets.  Each counter is streamed once, a chunk at a
+### time, so memory-mapped counters are not rescanned for every cell
+def heatmap_values(g, cells, rate):
+    values = np.zeros(cells, dtype=np.int64)
+    for counter in (g.reads, g.writes):
+        for (ids, counts) in counter.chunks():
+            np.add.at(values, ids // rate, counts)
+    return values
+# heatmap_values (DONE)
+
+### Aggregated results file written by 'post' mode next to the tarball (e.g. sdb.ioprof.npz)
+def aggregates_file(g):
+    return re.sub("\.tar$", "", g.tarfile) + ".ioprof.npz"
+# aggregates_file (DONE)
+
+### Parsed bucket counts and I/O totals as a dict of arrays: the contents of a .ioprof.npz file
+def aggregate_arrays(g):
+    (r_ids, r_counts) = g.reads.arrays()
+    (w_ids, w_counts) = g.writes.arrays()
+    (rc_ids, rc_counts) = g.read_crossings.arrays()
+    (wc_ids, wc_counts) = g.write_crossings.arrays()
+    r_sizes = sorted(g.r_totals.keys())
+    w_sizes = sorted(g.w_totals.keys())
+    files = dict(g.files_to_lbas)
+    return {
+        'version': np.array(g.aggregates_version),
+        'device': np.array(g.device),
+        'inputs': np.array([g.input if g.input else g.tarfile], dtype=str),
+        'geometry': np.array([g.sector_size, g.total_lbas, g.bucket_size], dtype=np.int64),
+        'totals': np.array([g.io_total.value, g.read_total.value, g.write_total.value, g.total_blocks.value], dtype=np.int64),
+        'read_ids': r_ids, 'read_counts': r_counts,
+        'write_ids': w_ids, 'write_counts': w_counts,
+        'read_crossing_ids': rc_ids, 'read_crossing_counts': rc_counts,
+        'write_crossing_ids': wc_ids, 'write_crossing_counts': wc_counts,
+        'read_sizes': np.array(r_sizes, dtype=np.int64), 'read_size_counts': np.array([g.r_totals[s] for s in r_sizes], dtype=np.int64),
+        'write_sizes': np.array(w_sizes, dtype=np.int64), 'write_size_counts': np.array([g.w_totals[s] for s in w_sizes], dtype=np.int64),
+        'file_names': np.array(list(files.keys()), dtype=str),
+        'file_ranges': np.array(list(files.values()), dtype=str),
+        'timeline': g.timeline.counts if g.timeline is not None else np.zeros((4, 0), dtype=np.int64),
+        'timeline_interval': np.array(g.timeline.interval if g.timeline is not None else g.interval)}
+# aggregate_arrays (DONE)
+
+### Save the parsed bucket counts and I/O totals at the granularity they were parsed at
+### 'report' mode re-buckets these to any multiple of that size without touching the trace
+def save_aggregates(g, filename):
+    np.savez_compressed(filename, **aggregate_arrays(g))
+    logger.info("Saved aggregated results to " + filename + " (" + size_str(g, g.bucket_size) + " buckets).  Use -m report -t " + filename + " to re-bucket them")
+# save_aggregates (DONE)
+
+### Load an aggregated results file saved by 'post' mode
+def load_aggregates(g, filename):
+    try:
+        data = dict(np.load(filename))
+        version = int(data['version'])
+    except Exception as e:
+        logger.info("ERROR: Failed to read aggregated results " + filename + " Err: " + str(e))
+        sys.exit(9)
+    if version != g.aggregates_version:
+        logger.info("ERROR: " + filename + " is version " + str(version) + ", expected " + str(g.aggregates_version))
+        sys.exit(9)
+    apply_aggregates(g, data)
+# load_aggregates (DONE)
+
+### Set the counts of an empty profile from a dict of aggregate arrays
+def apply_aggregates(g, data):
+    (g.sector_size, g.total_lbas, g.bucket_size) = [int(x) for x in data['geometry']]
+    (g.io_total.value, g.read_total.value, g.write_total.value, g.total_blocks.value) = [int(x) for x in data['totals']]
+    g.device = str(data['device'])
+    g.total_capacity_gib = g.total_lbas * g.sector_size / g.GiB
+    g.num_buckets = max(1, g.total_lbas * g.sector_size // g.bucket_size)
+    if g.reads is None:
+        sparse_counters(g)
+    g.reads.add(data['read_ids'], data['read_counts'])
+    g.writes.add(data['write_ids'], data['write_counts'])
+    g.read_crossings.add(data['read_crossing_ids'], data['read_crossing_counts'])
+    g.write_crossings.add(data['write_crossing_ids'], data['write_crossing_counts'])
+    for (totals, sizes, counts) in ((g.r_totals, data['read_sizes'], data['read_size_counts']), (g.w_totals, data['write_sizes'], data['write_size_counts'])):
+        for (size, count) in zip(sizes.tolist(), counts.tolist()):
+            totals[size] = count
+    if 'file_names' in data and len(data['file_names']) > 0:
+        g.files_to_lbas = dict(zip(data['file_names'].tolist(), data['file_ranges'].tolist()))
+        g.trace_files = True
+    if 'timeline' in data and data['timeline'].shape[1] > 0:
+        g.timeline = io_timeline(float(data['timeline_interval']), data['timeline'])
+    g.bucket_hits_total.value = g.reads.total() + g.writes.total()
+    g.max_bucket_hits.value = max(g.reads.max(), g.writes.max())
+    logger.info("Loaded " + g.device + ": %0.2f GiB, %s buckets, %d I/O's" % (g.total_capacity_gib, size_str(g, g.bucket_size), g.io_total.value))
+# apply_aggregates (DONE)
+
+### Sum two dicts of aggregate arrays for the same device geometry and bucket size
+def merge_aggregates(g, a, b):
+    if not np.array_equal(a['geometry'], b['geometry']):
+        logger.info("ERROR: %s and %s do not match: %d x %d sectors, %d byte buckets vs %d x %d sectors, %d byte buckets" %
+            tuple([a['inputs'][0], b['inputs'][0]] + [int(x) for x in a['geometry'][[1, 0, 2]]] + [int(x) for x in b['geometry'][[1, 0, 2]]]))
+        sys.exit(1)
+    merged = dict(a)
+    merged['inputs'] = np.concatenate((a['inputs'], b['inputs']))
+    merged['totals'] = a['totals'] + b['totals']
+    for (ids, counts) in (('read_ids', 'read_counts'), ('write_ids', 'write_counts'), ('read_crossing_ids', 'read_crossing_counts'), ('write_crossing_ids', 'write_crossing_counts')):
+        counter = bucket_counter(g.counter_chunk)
+        counter.add(a[ids], a[counts])
+        counter.add(b[ids], b[counts])
+        (merged[ids], merged[counts]) = counter.arrays()
+    for (sizes, counts) in (('read_sizes', 'read_size_counts'), ('write_sizes', 'write_size_counts')):
+        (merged[sizes], index) = np.unique(np.concatenate((a[sizes], b[sizes])), return_inverse=True)
+        merged[counts] = np.bincount(index, weights=np.concatenate((a[counts], b[counts])), minlength=len(merged[sizes])).astype(np.int64)
+    files = dict(zip(a['file_names'].tolist(), a['file_ranges'].tolist()))
+    files.update(zip(b['file_names'].tolist(), b['file_ranges'].tolist()))
+    merged['file_names'] = np.array(list(files.keys()), dtype=str)
+    merged['file_ranges'] = np.array(list(files.values()), dtype=str)
+    # Timelines line up by time since the start of each trace, at the coarser of the two intervals
+    timeline = io_timeline(float(a['timeline_interval']), a['timeline'])
+    try:
+        timeline.merge(io_timeline(float(b['timeline_interval']), b['timeline']))
+    except ValueError as e:
+        logger.info("ERROR: %s and %s: %s.  Re-run 'post' on one of them with a matching --interval" % (a['inputs'][0], b['inputs'][0], str(e)))
+        sys.exit(1)
+    (merged['timeline'], merged['timeline_interval']) = (timeline.counts, np.array(timeline.interval))
+    return merged
+# merge_aggregates (DONE)
+
+### Bucket size to parse at so the saved aggregates can be re-bucketed to bucket_size and to anything
+### coarser that is a multiple of the saved size
+def parse_bucket_size(g, bucket_size):
+    size = math.gcd(bucket_size, g.save_bucket_size)
+    if size < g.sector_size or size % g.sector_size != 0:
+        return bucket_size
+    return size
+# parse_bucket_size (DONE)
+
+### Re-bucket the read/write counts to a coarser bucket_size by summing aligned buckets
+### Crossings inside a coarse bucket are taken back out, so an I/O spanning several saved buckets of
+### one coarse bucket is counted once, the same as parsing the trace at bucket_size
+def rebucket(g, bucket_size):
+    if bucket_size == g.bucket_size:
+        return
+    if bucket_size < g.bucket_size or bucket_size % g.bucket_size != 0:
+        logger.info("ERROR: bucket size " + size_str(g, bucket_size) + " is not a multiple of the saved bucket size " + size_str(g, g.bucket_size))
+        sys.exit(1)
+    factor = bucket_size // g.bucket_size
+    g.num_buckets = max(1, g.total_lbas * g.sector_size // bucket_size)
+    fine_bucket_size = g.bucket_size
+    g.bucket_size = bucket_size
+    for (name, crossings_name) in (('reads', 'read_crossings'), ('writes', 'write_crossings')):
+        counter = new_counter(g, name)
+        crossings = new_counter(g, crossings_name)
+        for (ids, counts) in getattr(g, name).chunks():
+            counter.add(np.minimum(ids // factor, g.num_buckets - 1), counts)
+        for (c_ids, c_counts) in getattr(g, crossings_name).chunks():
+            inner = c_ids % factor != 0
+            counter.add(np.minimum(c_ids[inner] // factor, g.num_buckets - 1), -c_counts[inner])
+            crossings.add(c_ids[~inner] // factor, c_counts[~inner])
+        setattr(g, name, counter)
+        setattr(g, crossings_name, crossings)
+    g.bucket_hits_total.value = g.reads.total() + g.writes.total()
+    g.max_bucket_hits.value = max(g.reads.max(), g.writes.max())
+    logger.debug("rebucket: factor=" + str(factor) + " num_buckets=" + str(g.num_buckets) + " from " + size_str(g, fine_bucket_size))
+# rebucket (DONE)
 
 def input_tar_files(g):
     cmd = 'tar -tf ' + g.tarfile 
@@ -1228,6 +3602,7 @@ def input_tar_files(g):
         logger.debug( "i=" + i)
         if i != "":
             g.file_list.append(i)
+            g.cleanup.append(i)
     if rc != 0:
         logger.info("ERROR: Failed to test input file: " + g.tarfile)
         sys.exit(9)
@@ -1241,10 +3616,14 @@ def input_tar_files(g):
     else:
         logger.debug("Untar completed successfully")
 
-    # Get fdisk info
+    parse_fdisk(g, g.fdisk_file)
+# input_tar_files (DONE)
+
+### Get device geometry from the fdisk capture
+def parse_fdisk(g, fdisk_file):
     rc=0
     out=""
-    (rc, out) = run_cmd(g, 'cat '+ g.fdisk_file )
+    (rc, out) = run_cmd(g, 'cat '+ fdisk_file )
     out = out.decode("utf-8")
     logger.info(out)
     result = regex_find(g, "Units = sectors of \d+ \S \d+ = (\d+) bytes", out)
@@ -1281,12 +3660,82 @@ def input_tar_files(g):
     g.total_capacity_gib = g.total_lbas * g.sector_size / g.GiB
     printf("lbas: %d sec_size: %d total: %0.2f GiB\n", g.total_lbas, g.sector_size, g.total_capacity_gib)
 
-    g.num_buckets = g.total_lbas * g.sector_size // g.bucket_size
+    if g.bucket_size < g.sector_size:
+        logger.info("ERROR: bucket size " + str(g.bucket_size) + " is smaller than the sector size " + str(g.sector_size))
+        sys.exit(1)
+    g.num_buckets = max(1, g.total_lbas * g.sector_size // g.bucket_size)
+# parse_fdisk (DONE)
 
-### Draw heatmap on color terminal
+### Draw heatmap on the terminal
+### Each cell sums g.rate buckets.  Shading is log scaled, since a few buckets usually take most of the I/O
 def draw_heatmap(g):
+    cells = min(g.num_buckets, g.heatmap_width * g.heatmap_height)
+    g.rate = -(-g.num_buckets // cells)
+    cells = -(-g.num_buckets // g.rate)
+    values = heatmap_values(g, cells, g.rate)
+    g.cap = int(values.max())
+    if g.cap == 0:
+        return
+    levels = len(g.heatmap_shades) - 1
+    shade = np.zeros(cells, dtype=np.int64)
+    hit = values > 0
+    if g.cap == 1:
+        shade[hit] = levels
+    else:
+        shade[hit] = np.maximum(1, np.ceil(np.log(values[hit]) / math.log(g.cap) * levels)).astype(np.int64)
+    cell_gib = (g.rate * g.bucket_size) / g.GiB
+    logger.info("--------------------------------------------")
+    logger.info("Heatmap: %s per cell, '%s' = %d hits (log scale)" % (size_str(g, g.rate * g.bucket_size), g.heatmap_shades[-1], g.cap))
+    for row in range(0, cells, g.heatmap_width):
+        line = "".join(g.heatmap_shades[s] for s in shade[row:row + g.heatmap_width].tolist())
+        logger.info("%8.1f GB |%s|" % (row * cell_gib, line.ljust(g.heatmap_width)))
+    logger.info("--------------------------------------------")
     return
-# draw_heatmap (TODO)
+# draw_heatmap (DONE)
+
+### Stream a table of equal length columns to a .npy or .csv file a chunk of rows at a time
+### The whole table is never built at once, and .npy output never goes through strings
+def write_array(g, filename, columns, names, dtype):
+    rows = len(columns[0])
+    with open(filename, "wb") as fo:
+        if g.array_format == 'npy':
+            np.lib.format.write_array_header_1_0(fo, {'descr': np.dtype(dtype).str, 'fortran_order': False, 'shape': (rows, len(columns))})
+        else:
+            fo.write((",".join(names) + "\n").encode("utf-8"))
+        fmt = "%d" if np.dtype(dtype).kind in 'iu' else "%.6g"
+        for start in range(0, rows, g.array_chunk):
+            chunk = np.column_stack([np.asarray(c[start:start + g.array_chunk], dtype=dtype) for c in columns])
+            if g.array_format == 'npy':
+                chunk.tofile(fo)
+            else:
+                np.savetxt(fo, chunk, fmt=fmt, delimiter=",")
+    return {'file': filename, 'columns': names, 'rows': rows}
+# write_array (DONE)
+
+### Write the structured results (--json), with the per-bucket and per-interval arrays alongside it
+def write_results(g):
+    if g.json_file is None:
+        return
+    base = re.sub("\.json$", "", g.json_file)
+    g.results['device'] = {'device': g.device, 'sector_size': g.sector_size, 'total_lbas': g.total_lbas,
+        'capacity_bytes': g.total_lbas * g.sector_size, 'bucket_size': g.bucket_size, 'num_buckets': g.num_buckets}
+    g.results['totals'] = {'io_total': g.io_total.value, 'read_total': g.read_total.value, 'write_total': g.write_total.value,
+        'bucket_hits_total': g.bucket_hits_total.value, 'total_blocks': g.total_blocks.value}
+    arrays = {}
+    if g.mode in ('post', 'report', 'merge'):
+        (ids, reads, writes) = bucket_arrays(g)
+        arrays['buckets'] = write_array(g, base + ".buckets." + g.array_format, (ids, reads, writes), ['bucket', 'reads', 'writes'], np.int64)
+    for (name, (columns, names, dtype)) in g.bulk_arrays.items():
+        arrays[name] = write_array(g, base + "." + name + "." + g.array_format, columns, names, dtype)
+    if g.timeline is not None and g.timeline.counts.shape[1] > 0:
+        series = g.timeline.series()
+        arrays['timeline'] = write_array(g, base + ".timeline." + g.array_format, [series[:, i] for i in range(series.shape[1])],
+            ['start_s', 'iops', 'read_iops', 'write_iops', 'mbps', 'read_mbps', 'write_mbps', 'read_pct', 'avg_kib'], np.float64)
+    g.results['arrays'] = arrays
+    with open(g.json_file, "w") as fo:
+        json.dump(g.results, fo, indent=1)
+    logger.info("Wrote results to " + g.json_file)
+# write_results (DONE)
 
 ### Cleanup temp files
 def cleanup_files(g):
@@ -1339,6 +3788,35 @@ def printf(format, *args):
     sys.stdout.write(format % args)
 # printf (DONE)
 
+### Parse a size such as 4096, 4K, 64KiB, 1M or 2GiB into bytes.  Returns None if invalid
+def parse_size(g, text):
+    match = re.match("^\s*(\d+(?:\.\d+)?)\s*([kKmMgGtTpP]?)(?:i?[bB])?\s*$", str(text))
+    if match is None:
+        return None
+    scale = {'': 1, 'k': g.KiB, 'm': g.MiB, 'g': g.GiB, 't': g.TiB, 'p': g.TiB * 1024}
+    return int(float(match.group(1)) * scale[match.group(2).lower()])
+# parse_size (DONE)
+
+### Format a byte count (e.g. 4.0 KiB, 1.5 GiB)
+def size_str(g, size):
+    for (unit, scale) in (("TiB", g.TiB), ("GiB", g.GiB), ("MiB", g.MiB), ("KiB", g.KiB)):
+        if size >= scale:
+            return "%0.1f %s" % (size / float(scale), unit)
+    return "%d B" % size
+# size_str (DONE)
+
+### NaN as None, for JSON
+def none_if_nan(value):
+    return None if value != value else float(value)
+# none_if_nan (DONE)
+
+### Format a fraction as a percentage, NA if undefined
+def percent_str(fraction):
+    if fraction != fraction: # NaN
+        return "NA"
+    return "%0.1f%%" % (fraction * 100.0)
+# percent_str (DONE)
+
 def setup_logger(logger):
     # Create and configure logger
     logging.basicConfig(
@@ -1355,6 +3833,1249 @@ def setup_logger(logger):
     logger.setLevel(logging.INFO)
     return logger
 
+### Unpack a trace tarball and parse it
+def parse_tarball(g):
+    with profile_stage(g, "untar"):
+        input_tar_files(g)
+    parse_trace_files(g)
+# parse_tarball (DONE)
+
+### Parse the unpacked trace files.  Parsing is done at the finest saved granularity and the
+### counts are saved to <dev>.ioprof.npz, so g.bucket_size is the saved bucket size afterwards
+def parse_trace_files(g):
+    # Parse at the finest saved granularity.  The caller re-buckets once the counts are saved.  Hotness
+    # is not saved, so it is kept at the report bucket size
+    g.timeline = io_timeline(g.interval)
+    parse_chunk_starts(g, "timeline." + g.device_str)
+    g.cleanup.append("timeline." + g.device_str)
+    g.hot_bucket_size = g.bucket_size
+    g.bucket_size = parse_bucket_size(g, g.bucket_size)
+    g.num_buckets = max(1, g.total_lbas * g.sector_size // g.bucket_size)
+    if g.memmap_dir is not None:
+        memmap_counters(g)
+    else:
+        sparse_counters(g)
+    g.analyzers = start_analyzers(g)
+
+    # Make the PDF plot a square matrix to keep gnuplot happy
+    g.y_height = g.x_width = int(math.sqrt(g.num_buckets))
+    logger.debug( "x=" + str(g.x_width) + " y=" + str(g.y_height))
+
+    #g.debug=True
+    logger.debug( "num_buckets=" + str(g.num_buckets) + " sector_size=" + str(g.sector_size) + " total_lbas=" + str(g.total_lbas) + " bucket_size=" + str(g.bucket_size))
+    #g.debug=False
+    rc = os.system("rm -f filetrace." + g.device_str + ".*.txt")
+    rc = os.system("rm -f blk.out." + g.device_str + ".*.blkparse")
+    logger.info("Time to parse.  Please wait...\n")
+
+    size = len(g.file_list)
+    file_count = 0
+
+    plist = []
+    if not g.single_threaded:
+        share_state(g)
+    blk_files = [filename for filename in g.file_list if is_event_file(filename)]
+    parsed = parse_in_workers(g, blk_files)
+    for filename in g.file_list:
+        logger.debug(filename)
+        logger.debug("----------------------")
+        file_count += 1
+        #perc = file_count * 100 / size
+        printf("\rInput Percent: %d %% (File %d of %d) threads=%d", (file_count*100 / size), file_count, size, len(plist))
+        sys.stdout.flush()
+        if is_event_file(filename) and not parsed:
+            #if g.single_threaded:
+            if True:
+                thread_parse(g, filename, file_count)
+                logger.debug( "blk.out hit = " + filename + "\n")
+            else:
+                p = Process(target=thread_parse, args=(g, filename, file_count))
+                plist.append(p)
+                p.start()
+        result = regex_find(g, "(filetrace.\S+.\S+.txt).gz", filename)
+        if result != False:
+            new_file = result[0]
+            g.trace_files=True
+            logger.debug( "filetrace hit = " + filename+ "\n")
+            if g.single_threaded:
+                with profile_stage(g, "file mapping"):
+                    parse_filetrace(g, new_file, file_count)
+                logger.debug( "blk.out hit = " + filename + "\n")
+            else:
+                p = Process(target=parse_filetrace, args=(g, new_file, file_count))
+                plist.append(p)
+                p.start()
+        while len(plist) > g.thread_max:
+            for p in plist:
+                try:
+                    p.join(0)
+                except:
+                    pass
+                else:
+                    if not p.is_alive():
+                        plist.remove(p)
+            time.sleep(0.10)
+
+    if g.single_threaded == False:
+        x=1
+        while len(plist) > 0:
+            dots=""
+            for i in range(x):
+                dots = dots + "."
+            x+=1
+            if x>3:
+                x=1
+            printf("\rWaiting on %3d threads to complete processing%-3s", len(plist), dots)
+            printf("    ")
+            sys.stdout.flush()
+            for p in plist:
+                try:
+                    p.join(0)
+                except:
+                    pass
+                else:
+                    if not p.is_alive():
+                        plist.remove(p)
+            time.sleep(0.10)
+
+    logger.info("\rFinished parsing files.  Now to analyze         \n")
+    with profile_stage(g, "merge"):
+        save_aggregates(g, aggregates_file(g))
+# parse_trace_files (DONE)
+
+### A fresh profile with the same settings as g and no counts, for modes that load several inputs
+def fresh_profile(g):
+    p = copy.copy(g)
+    p.io_total = local_value(0)
+    p.read_total = local_value(0)
+    p.write_total = local_value(0)
+    p.bucket_hits_total = local_value(0)
+    p.total_blocks = local_value(0)
+    p.max_bucket_hits = local_value(0)
+    sparse_counters(p)
+    p.r_totals = {}
+    p.w_totals = {}
+    p.analyzer_names = list(g.analyzer_names)
+    p.analyzers = []
+    p.sims = []
+    p.files_to_lbas = {}
+    p.bucket_to_files = {}
+    p.file_hit_count = {}
+    p.cleanup = []
+    p.results = {}
+    p.timeline = None
+    p.hotness = None
+    p.mrc = None
+    p.trace_files = False
+    return p
+# fresh_profile (DONE)
+
+### Load a trace tarball or a saved aggregates file into a fresh profile, re-bucketed to bucket_size
+def load_profile(g, path, bucket_size):
+    p = fresh_profile(g)
+    p.input = path
+    if path.endswith(".npz"):
+        load_aggregates(p, path)
+    else:
+        match = re.search("(\S+).tar", os.path.basename(path))
+        if match is None:
+            logger.info("ERROR: invalid input " + path + ".  Use a .tar file from 'trace' mode or a .ioprof.npz file from 'post' mode")
+            sys.exit(9)
+        p.tarfile = path
+        p.device_str = match.group(1)
+        p.fdisk_file = "fdisk." + p.device_str
+        p.cleanup.append(p.fdisk_file)
+        parse_tarball(p)
+        cleanup_files(p)
+    rebucket(p, bucket_size)
+    return p
+# load_profile (DONE)
+
+### A column of an event batch as a 1-D array: NumPy arrays and sequences as they are, bytes-like buffers
+### read as raw values of dtype
+def event_column(values, dtype):
+    if isinstance(values, (bytes, bytearray, memoryview)):
+        return np.frombuffer(values, dtype=dtype)
+    return np.asarray(values).astype(dtype, copy=False).reshape(-1)
+# event_column (DONE)
+
+### Write flags of a batch from rw: booleans or nonzero bytes (True/1 is a write), or blktrace RWBS
+### strings, where anything starting with W is a write
+def event_writes(rw):
+    if isinstance(rw, (bytes, bytearray, memoryview)):
+        return np.frombuffer(rw, dtype=np.uint8) != 0
+    rw = np.asarray(rw).reshape(-1)
+    if rw.dtype.kind in ('U', 'S', 'O'):
+        return np.char.startswith(rw.astype(str), 'W')
+    return rw.astype(bool)
+# event_writes (DONE)
+
+### Library interface to the profiler.  A profile of one device that other collectors feed in bulk:
+###     p = ioprof.io_profile(sector_size=512, total_lbas=2 ** 31, bucket_size=1 << 20)
+###     p.add_events(rw, sector, nsectors, times)
+###     p.merge(other)
+###     p.histogram(), p.stats(), p.theta()
+### Events go through parse_events(), the same batch parser as 'post' mode, and the accessors return
+### what 'post' prints.  analyzers adds optional ones (see event_analyzers), e.g. ('timeline', 'mrc').
+### The profile's state is a global_variables (p.g), so every routine here applies
+class io_profile:
+    def __init__(self, sector_size, total_lbas, bucket_size=1 << 20, device="", interval=1.0, analyzers=('timeline',), g=None):
+        global logger
+        if logger is None:
+            logger = logging.getLogger("ioprof")
+        if not import_numpy():
+            raise ImportError("io_profile needs numpy")
+        if bucket_size < sector_size or bucket_size % sector_size != 0:
+            raise ValueError("bucket size %d is not a multiple of the %d byte sector size" % (bucket_size, sector_size))
+        self.g = g = global_variables() if g is None else g
+        (g.sector_size, g.total_lbas, g.bucket_size) = (int(sector_size), int(total_lbas), int(bucket_size))
+        g.device = device
+        g.device_str = os.path.basename(device)
+        g.total_capacity_gib = g.total_lbas * g.sector_size / g.GiB
+        g.num_buckets = max(1, g.total_lbas * g.sector_size // g.bucket_size)
+        g.interval = interval
+        g.timeline = io_timeline(interval)
+        if g.reads is None:
+            sparse_counters(g)
+        g.analyzer_names = ['counts'] + [name for name in analyzers if name != 'counts']
+        g.analyzers = start_analyzers(g)
+
+    ### A profile over the counts of a trace tarball or saved .ioprof.npz file, re-bucketed to bucket_size
+    @classmethod
+    def load(cls, path, bucket_size=1 << 20, g=None):
+        global logger
+        if logger is None:
+            logger = logging.getLogger("ioprof")
+        if not import_numpy():
+            raise ImportError("io_profile needs numpy")
+        p = cls.__new__(cls)
+        p.g = load_profile(global_variables() if g is None else g, path, bucket_size)
+        return p
+
+    ### Add a batch of I/O's.  rw, sector and nsectors (and times, in seconds since the start of the trace)
+    ### are equal-length arrays, sequences or buffers.  Returns the number of I/O's added
+    def add_events(self, rw, sector, nsectors, times=None):
+        writes = event_writes(rw)
+        sectors = event_column(sector, np.int64)
+        nsectors = event_column(nsectors, np.int64)
+        times = np.full(len(writes), np.nan) if times is None else event_column(times, np.float64)
+        if not (len(writes) == len(sectors) == len(nsectors) == len(times)):
+            raise ValueError("event columns differ in length: rw=%d sector=%d nsectors=%d times=%d" % (len(writes), len(sectors), len(nsectors), len(times)))
+        if len(writes) > 0:
+            parse_events(self.g, writes, sectors, nsectors, times)
+        return len(writes)
+
+    ### Fold the results of the batches added so far into the profile
+    def flush(self):
+        finalize_analyzers(self.g)
+        return self
+
+    ### Add the counts of a partial profile of the same device geometry and bucket size
+    def merge(self, other):
+        (g, o) = (self.flush().g, other.flush().g)
+        if (g.sector_size, g.total_lbas, g.bucket_size) != (o.sector_size, o.total_lbas, o.bucket_size):
+            raise ValueError("profiles do not match: %d x %d sectors, %d byte buckets vs %d x %d sectors, %d byte buckets" %
+                (g.total_lbas, g.sector_size, g.bucket_size, o.total_lbas, o.sector_size, o.bucket_size))
+        for name in ('reads', 'writes', 'read_crossings', 'write_crossings'):
+            getattr(g, name).merge(getattr(o, name))
+        for name in ('io_total', 'read_total', 'write_total', 'total_blocks'):
+            getattr(g, name).value += getattr(o, name).value
+        for (totals, other_totals) in ((g.r_totals, o.r_totals), (g.w_totals, o.w_totals)):
+            for (size, count) in dict(other_totals).items():
+                totals[size] = totals.get(size, 0) + count
+        g.files_to_lbas.update(dict(o.files_to_lbas))
+        g.trace_files = g.trace_files or o.trace_files
+        if g.timeline is None:
+            g.timeline = o.timeline
+        elif o.timeline is not None:
+            g.timeline.merge(o.timeline)
+        g.bucket_hits_total.value = g.reads.total() + g.writes.total()
+        g.max_bucket_hits.value = max(g.reads.max(), g.writes.max())
+        return self
+
+    ### Touched buckets: bucket IDs (ascending), read hits and write hits
+    def buckets(self):
+        return bucket_arrays(self.flush().g)
+
+    ### Histogram rows, as in the --json 'histogram' section
+    def histogram(self):
+        (ids, reads, writes) = self.buckets()
+        return histogram_table(self.g, *count_totals(reads + writes))
+
+    ### Zipfian theta of the bucket totals: (theta, ci_low, ci_high), or None with too few hit buckets
+    def theta(self, mle=False):
+        (ids, reads, writes) = self.buckets()
+        (values, counts) = count_totals(reads + writes)
+        return zipf_theta_mle(self.g, values, counts) if mle else zipf_theta_lsq(self.g, values, counts)
+
+    ### I/O totals, the read/write I/O size histograms (bytes, ascending) and the size percentiles
+    def stats(self):
+        g = self.flush().g
+        stats = {'ios': g.io_total.value, 'reads': g.read_total.value, 'writes': g.write_total.value,
+            'bytes': g.total_blocks.value * g.sector_size, 'bucket_hits': g.bucket_hits_total.value, 'percentiles': {}}
+        for (op, totals) in (('read', g.r_totals), ('write', g.w_totals)):
+            (sizes, counts) = size_histogram(totals)
+            stats[op + '_sizes'] = sizes * g.sector_size
+            stats[op + '_counts'] = counts
+            p = size_percentiles(sizes, counts, g.stats_percentiles)
+            stats['percentiles'][op] = None if p is None else dict(zip(["p%g" % q for q in g.stats_percentiles], (p * g.sector_size).tolist()))
+        return stats
+
+    ### Per-interval series (see io_timeline.series), empty for events without timestamps
+    def timeline(self):
+        g = self.flush().g
+        return g.timeline.series() if g.timeline is not None else np.zeros((0, 9))
+
+    ### Save the counts as a .ioprof.npz file for 'report', 'compare' and 'merge' modes
+    def save(self, filename):
+        self.flush()
+        np.savez_compressed(filename, **aggregate_arrays(self.g))
+        return filename
+# io_profile (DONE)
+
+### I/O hits of each mapped file: the hits of every bucket its LBA ranges touch
+def file_hits(g, ids, totals):
+    cum = np.concatenate(([0], np.cumsum(totals)))
+    hits = {}
+    for (file, ranges) in dict(g.files_to_lbas).items():
+        count = 0
+        for extent in ranges.split():
+            try:
+                (start, finish) = extent.split(':')
+                first = lba_to_bucket(g, start)
+                last = lba_to_bucket(g, finish)
+            except ValueError:
+                continue
+            count += int(cum[np.searchsorted(ids, last, side='right')] - cum[np.searchsorted(ids, first)])
+        hits[file] = count
+    return hits
+# file_hits (DONE)
+
+### Indices of the n largest values, largest first.  argpartition keeps this linear in the bucket count
+def top_indices(values, n):
+    if len(values) <= n:
+        return np.argsort(-values, kind='stable')
+    top = np.argpartition(-values, n)[:n]
+    return top[np.argsort(-values[top], kind='stable')]
+# top_indices (DONE)
+
+### Compare two profiles of the same device
+### Bucket totals are lined up over the union of touched buckets and compared as shares of each
+### trace's bucket hits, so traces of different lengths compare by where the I/O went
+def print_compare(g, a, b):
+    (a_ids, a_r, a_w) = bucket_arrays(a)
+    (b_ids, b_r, b_w) = bucket_arrays(b)
+    ids = np.union1d(a_ids, b_ids)
+    a_tot = np.zeros(len(ids), dtype=np.int64)
+    b_tot = np.zeros(len(ids), dtype=np.int64)
+    a_tot[np.searchsorted(ids, a_ids)] = a_r + a_w
+    b_tot[np.searchsorted(ids, b_ids)] = b_r + b_w
+    a_sum = max(int(a_tot.sum()), 1)
+    b_sum = max(int(b_tot.sum()), 1)
+    a_share = a_tot * 100.0 / a_sum
+    b_share = b_tot * 100.0 / b_sum
+    delta = b_share - a_share
+    # Smoothed so buckets that appear or vanish get a finite ratio
+    ratio = ((b_tot + 1.0) / b_sum) / ((a_tot + 1.0) / a_sum)
+    results = g.results['compare'] = {'inputs': [a.input, b.input]}
+
+    logger.info("--------------------------------------------")
+    g.bulk_arrays['buckets'] = ((ids, a_tot, b_tot), ['bucket', 'a', 'b'], np.int64)
+    logger.info("Compare: A=%s B=%s (%s buckets)" % (a.input, b.input, size_str(g, g.bucket_size)))
+    logger.info("%-24s %14s %14s" % ("", "A", "B"))
+    rows = [("I/O's", a.io_total.value, b.io_total.value),
+        ("Read %", a.read_total.value * 100.0 / max(a.io_total.value, 1), b.read_total.value * 100.0 / max(b.io_total.value, 1)),
+        ("Bucket hits", a_sum, b_sum),
+        ("Buckets touched", len(a_ids), len(b_ids))]
+    for (label, x, y) in rows:
+        logger.info(("%-24s %14d %14d" if isinstance(x, int) else "%-24s %14.2f %14.2f") % (label, x, y))
+    results['totals'] = [{'name': label, 'a': x, 'b': y} for (label, x, y) in rows]
+    logger.info("Buckets touched by both: %d, only A: %d, only B: %d" % (int(np.count_nonzero((a_tot > 0) & (b_tot > 0))),
+        int(np.count_nonzero(b_tot == 0)), int(np.count_nonzero(a_tot == 0))))
+
+    # Histogram shift: cumulative share of the hits held by the hottest n buckets of each trace
+    logger.info("Histogram (cumulative % of I/O in the hottest capacity):")
+    (a_values, a_counts) = count_totals(a_tot)
+    (b_values, b_counts) = count_totals(b_tot)
+    positions = np.union1d(histogram_rows(g, a_values, a_counts)[0], histogram_rows(g, b_values, b_counts)[0])
+    a_cum = hottest_hits(a_values, a_counts, positions) * 100.0 / a_sum
+    b_cum = hottest_hits(b_values, b_counts, positions) * 100.0 / b_sum
+    results['histogram'] = []
+    for (position, x, y) in zip(positions.tolist(), a_cum.tolist(), b_cum.tolist()):
+        logger.info("%0.1f GB %6.1f%% -> %6.1f%% (%+0.1f)" % ((position * g.bucket_size) / g.GiB, x, y, y - x))
+        results['histogram'].append({'capacity_bytes': position * g.bucket_size, 'a_percent': x, 'b_percent': y})
+
+    results['zipf'] = {}
+    thetas = [zipf_theta_lsq(g, a_values, a_counts), zipf_theta_lsq(g, b_values, b_counts)]
+    logger.info("Zipfian Theta (least squares): %s -> %s" % tuple("NA" if t is None else "%0.4f (%0.4f-%0.4f)" % t for t in thetas))
+    results['zipf']['least_squares'] = [None if t is None else dict(zip(('theta', 'ci_low', 'ci_high'), t)) for t in thetas]
+
+    # I/O size mix
+    logger.info("I/O size mix:")
+    mixes = []
+    for p in (a, b):
+        (r_sizes, r_counts) = size_histogram(p.r_totals)
+        (w_sizes, w_counts) = size_histogram(p.w_totals)
+        sizes = np.concatenate((r_sizes, w_sizes))
+        counts = np.concatenate((r_counts, w_counts))
+        order = np.argsort(sizes, kind='stable')
+        mixes.append((sizes[order] * g.sector_size, counts[order]))
+    for (label, (sizes, counts)) in zip(("A", "B"), mixes):
+        pct = size_percentiles(sizes, counts, g.stats_percentiles)
+        if pct is not None:
+            logger.info("  %s: " % label + "  ".join("p%g %s" % (q, size_str(g, int(x))) for (q, x) in zip(g.stats_percentiles, pct.tolist())))
+            results.setdefault('size_percentiles', {})[label.lower()] = dict(zip(["p%g" % q for q in g.stats_percentiles], pct.tolist()))
+    bins = [np.bincount(np.log2(np.maximum(sizes, 1)).astype(np.int64), weights=counts, minlength=64) for (sizes, counts) in mixes]
+    shares = [x * 100.0 / max(x.sum(), 1) for x in bins]
+    for i in np.flatnonzero(bins[0] + bins[1]).tolist():
+        logger.info("  %-22s %6.2f%% -> %6.2f%% (%+0.2f)" % ("%s - %s" % (size_str(g, 1 << i), size_str(g, 1 << (i + 1))), shares[0][i], shares[1][i], shares[1][i] - shares[0][i]))
+
+    # Regions whose share of the I/O changed the most
+    limit = g.top_count_limit
+    results['regions'] = {}
+    for (title, order) in (("hotter", top_indices(delta, limit)), ("colder", top_indices(-delta, limit))):
+        order = order[(delta[order] > 0) if title == "hotter" else (delta[order] < 0)]
+        logger.info("Top regions that got %s:" % title)
+        results['regions'][title] = []
+        for i in order.tolist():
+            start = int(ids[i]) * g.bucket_size
+            logger.info("  %0.3f-%0.3f GB  %6.2f%% -> %6.2f%% (%+0.2f, x%0.2f)" % (start / g.GiB, (start + g.bucket_size) / g.GiB, a_share[i], b_share[i], delta[i], ratio[i]))
+            results['regions'][title].append({'bucket': int(ids[i]), 'offset_bytes': start, 'a_percent': float(a_share[i]), 'b_percent': float(b_share[i]), 'ratio': float(ratio[i])})
+
+    # Files, when both traces were mapped to files
+    if len(a.files_to_lbas) > 0 and len(b.files_to_lbas) > 0:
+        a_files = file_hits(a, ids, a_tot)
+        b_files = file_hits(b, ids, b_tot)
+        names = sorted(set(a_files) | set(b_files))
+        file_delta = np.array([b_files.get(n, 0) * 100.0 / b_sum - a_files.get(n, 0) * 100.0 / a_sum for n in names])
+        results['files'] = {}
+        for (title, order) in (("hotter", top_indices(file_delta, limit)), ("colder", top_indices(-file_delta, limit))):
+            logger.info("Top files that got %s:" % title)
+            results['files'][title] = []
+            for i in order.tolist():
+                if (file_delta[i] > 0) != (title == "hotter") or file_delta[i] == 0:
+                    continue
+                x = a_files.get(names[i], 0) * 100.0 / a_sum
+                y = b_files.get(names[i], 0) * 100.0 / b_sum
+                logger.info("  %6.2f%% -> %6.2f%% (%+0.2f) %s" % (x, y, y - x, names[i]))
+                results['files'][title].append({'file': names[i], 'a_percent': x, 'b_percent': y})
+    logger.info("--------------------------------------------")
+    return
+# print_compare (DONE)
+
+### State inherited by the 'merge' worker processes
+merge_state = {}
+
+### Load one 'merge' input in a worker and return its aggregate arrays at the merge bucket size
+### Each worker unpacks in its own directory, since tarballs of the same device share member names
+def merge_worker(path):
+    g = merge_state['g']
+    cwd = os.getcwd()
+    work = tempfile.mkdtemp(prefix="ioprof.")
+    os.chdir(work)
+    try:
+        p = load_profile(g, os.path.join(cwd, path), merge_state['bucket_size'])
+        data = aggregate_arrays(p)
+        data['inputs'] = np.array([path], dtype=str)
+        profile_worker(g)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+    return data
+# merge_worker (DONE)
+
+### Reduce many inputs into one dict of aggregate arrays
+### Inputs are loaded in parallel and tree-summed as they finish: two partial sums of the same
+### depth are merged at once, so at most log2(inputs) partial sums are held at any time
+def merge_inputs(g, inputs, bucket_size):
+    merge_state['g'] = g
+    merge_state['bucket_size'] = bucket_size
+    stack = []
+    done = 0
+    workers = max(1, min(len(inputs), g.merge_workers if g.merge_workers > 0 else multiprocessing.cpu_count()))
+    pool = Pool(workers) if workers > 1 else None
+    for data in (pool.imap_unordered(merge_worker, inputs) if pool is not None else map(merge_worker, inputs)):
+        done += 1
+        logger.info("\rMerged %d of %d inputs (%s)" % (done, len(inputs), data['inputs'][0]))
+        depth = 0
+        while len(stack) > 0 and stack[-1][0] == depth:
+            data = merge_aggregates(g, stack.pop()[1], data)
+            depth += 1
+        stack.append((depth, data))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    data = stack.pop()[1]
+    while len(stack) > 0:
+        data = merge_aggregates(g, stack.pop()[1], data)
+    return data
+# merge_inputs (DONE)
+
+### Synthetic traces for 'generate' mode
+### Region popularity is Zipfian: ranks come from the exact CDF over the hottest gen_zipf_head ranks and from
+### the inverted integral of r^-theta over the rest, so the sampler needs no per-region table.  Ranks are
+### scattered over the device by an affine map modulo the region count, which is a bijection
+class zipf_regions:
+    def __init__(self, num_regions, theta, head, rng):
+        self.n = num_regions
+        self.theta = theta
+        self.k = min(num_regions, head)
+        weights = np.arange(1, self.k + 1, dtype=np.float64) ** -theta
+        self.head_cdf = np.cumsum(weights)
+        (self.lo, self.hi) = (self.k + 0.5, num_regions + 0.5)
+        tail = self.integral(self.hi) - self.integral(self.lo) if num_regions > self.k else 0.0
+        self.head_mass = self.head_cdf[-1] / (self.head_cdf[-1] + tail)
+        self.head_cdf /= self.head_cdf[-1]
+        self.scale = int(rng.integers(1, max(2, num_regions)))
+        while math.gcd(self.scale, num_regions) != 1:
+            self.scale += 1
+        self.shift = int(rng.integers(0, num_regions))
+
+    def integral(self, x):
+        return math.log(x) if self.theta == 1.0 else x ** (1.0 - self.theta) / (1.0 - self.theta)
+
+    ### Zero-based ranks for uniforms u
+    def ranks(self, u):
+        ranks = np.searchsorted(self.head_cdf, u / self.head_mass, side='right').astype(np.int64)
+        tail = u >= self.head_mass
+        if tail.any():
+            v = (u[tail] - self.head_mass) / (1.0 - self.head_mass)
+            (a, b) = (self.integral(self.lo), self.integral(self.hi))
+            y = a + v * (b - a)
+            x = np.exp(y) if self.theta == 1.0 else (y * (1.0 - self.theta)) ** (1.0 / (1.0 - self.theta))
+            ranks[tail] = np.clip(np.rint(x).astype(np.int64), self.k + 1, self.n) - 1
+        return np.minimum(ranks, self.n - 1)
+
+    def regions(self, u):
+        return (self.ranks(u) * self.scale + self.shift) % self.n
+# zipf_regions (DONE)
+
+### Right-aligned decimal columns as ASCII bytes, one row per value.  pad is b' ' or b'0'
+def ascii_column(values, width, pad):
+    powers = 10 ** np.arange(width - 1, -1, -1, dtype=np.int64)
+    digits = ((values[:, None] // powers) % 10 + 48).astype(np.uint8)
+    if pad == b' ':
+        lead = values[:, None] < powers
+        lead[:, -1] = False
+        digits[lead] = 32
+    return digits
+# ascii_column (DONE)
+
+### blkparse text for a batch of queued I/O's in the g.blkparse_format layout (" %d %a %S %n %T.%09t"),
+### built as one byte matrix so there is no per-line Python work
+def blkparse_text(g, writes, sectors, nsectors, times):
+    rows = len(writes)
+    nanos = np.rint(times * 1e9).astype(np.int64)
+    columns = [np.full((rows, 1), 32, dtype=np.uint8), np.where(writes, ord('W'), ord('R')).astype(np.uint8)[:, None],
+        np.frombuffer(b" Q ", dtype=np.uint8)[None, :].repeat(rows, axis=0),
+        ascii_column(sectors, len(str(g.total_lbas)), b' '), np.full((rows, 1), 32, dtype=np.uint8),
+        ascii_column(nsectors, len(str(int(nsectors.max()))) if rows else 1, b' '), np.full((rows, 1), 32, dtype=np.uint8),
+        ascii_column(nanos // 1000000000, len(str(int(g.timeout))), b' '), np.full((rows, 1), ord('.'), dtype=np.uint8),
+        ascii_column(nanos % 1000000000, 9, b'0'), np.full((rows, 1), ord('\n'), dtype=np.uint8)]
+    return np.hstack(columns).tobytes()
+# blkparse_text (DONE)
+
+### One chunk of I/O's: Poisson arrivals over length seconds, Zipfian regions, sequential streams
+### An I/O flagged sequential starts where the previous one ended, so a run of them is a stream and is
+### placed with a cumulative sum rather than a loop.  Yields (writes, sectors, nsectors, times) batches
+def generate_events(g, rng, zipf, length):
+    region_sectors = g.gen_region // g.sector_size
+    align = max(1, 4096 // g.sector_size)
+    sizes = np.array([s // g.sector_size for (s, p) in g.gen_sizes], dtype=np.int64)
+    weights = np.array([p for (s, p) in g.gen_sizes], dtype=np.float64)
+    start = 0.0
+    (last_sector, last_size) = (0, 0)
+    while True:
+        times = start + np.cumsum(rng.exponential(1.0 / g.gen_iops, g.gen_batch))
+        times = times[times < length]
+        if len(times) == 0:
+            return
+        start = times[-1]
+        n = len(times)
+        nsectors = sizes[rng.choice(len(sizes), n, p=weights / weights.sum())]
+        writes = rng.random(n) * 100.0 >= g.gen_read_percent
+        offsets = rng.integers(0, max(1, region_sectors // align), n) * align
+        sectors = zipf.regions(rng.random(n)) * region_sectors + offsets
+        # The last I/O of the previous batch leads, so a stream carries over from one batch to the next
+        seq = np.concatenate(([False], rng.random(n) < g.gen_seq))
+        seq[1] = seq[1] and last_size > 0
+        sectors = np.concatenate(([last_sector], sectors))
+        before = np.cumsum(np.concatenate(([last_size], nsectors))) - np.concatenate(([last_size], nsectors))
+        heads = np.flatnonzero(~seq)[np.cumsum(~seq) - 1]
+        sectors = (sectors[heads] + before - before[heads])[1:] % max(1, g.total_lbas - int(sizes.max()))
+        (last_sector, last_size) = (int(sectors[-1]), int(nsectors[-1]))
+        yield (writes, sectors, nsectors, times)
+        if len(times) < g.gen_batch:
+            return
+# generate_events (DONE)
+
+### State inherited by the 'generate' worker processes
+generate_state = {}
+
+### Write one chunk in the g.codec format the way 'trace' mode leaves it.  Each chunk has its own
+### random stream, so the chunk files are the same whatever the number of workers
+def generate_worker(chunk):
+    g = generate_state['g']
+    rng = np.random.default_rng([g.gen_seed, chunk])
+    length = generate_state['segments'][chunk]
+    count = 0
+    if g.codec != 'gzip':
+        count = encode_events(g, event_file(g, chunk), generate_events(g, rng, generate_state['zipf'], length))
+        profile_worker(g)
+        return (chunk, count)
+    with gzip.GzipFile(event_file(g, chunk), "wb", compresslevel=1, mtime=0) as fo:
+        for (writes, sectors, nsectors, times) in generate_events(g, rng, generate_state['zipf'], length):
+            fo.write(blkparse_text(g, writes, sectors, nsectors, times))
+            count += len(writes)
+    profile_worker(g)
+    return (chunk, count)
+# generate_worker (DONE)
+
+### fdisk capture of the synthetic device, in the format parse_fdisk reads
+def generate_fdisk(g, filename):
+    size = g.total_lbas * g.sector_size
+    (unit, scale) = ("TiB", g.TiB) if size >= g.TiB else ("GiB", g.GiB)
+    with open(filename, "w") as fo:
+        fo.write("Disk %s: %0.1f %s, %d bytes, %d sectors\n" % (g.device, size / float(scale), unit, size, g.total_lbas))
+        fo.write("Units: sectors of 1 * %d = %d bytes\n" % (g.sector_size, g.sector_size))
+        fo.write("Sector size (logical/physical): %d bytes / %d bytes\n" % (g.sector_size, g.sector_size))
+        fo.write("I/O size (minimum/optimal): %d bytes / %d bytes\n" % (g.sector_size, g.sector_size))
+# generate_fdisk (DONE)
+
+### File map of the synthetic device: the device is cut into gen_files * gen_file_extents equal pieces
+### and every file gets gen_file_extents of them at random
+def generate_filetrace(g, rng, filename):
+    pieces = g.gen_files * g.gen_file_extents
+    bounds = np.linspace(0, g.total_lbas, pieces + 1).astype(np.int64)
+    owned = np.argsort(rng.permutation(pieces) % g.gen_files, kind='stable').reshape(g.gen_files, g.gen_file_extents)
+    owned.sort(axis=1)
+    with gzip.open(filename, "wt") as fo:
+        for (f, mine) in enumerate(owned.tolist()):
+            fo.write("/gen/file%d :: %s\n" % (f, " ".join("%d:%d" % (bounds[i], bounds[i + 1] - 1) for i in mine)))
+# generate_filetrace (DONE)
+
+### Write a synthetic trace tarball for 'post' mode: the fdisk capture, the blkparse chunks 'trace' mode
+### would record (trace_segments, so they add up to the runtime), the chunk start times, an optional file
+### map and generate.<dev>.json with the parameters (the ground truth for checking the estimators).
+### 'post' finds the members by the tarball's name, so with -t they are named after it rather than the
+### device.  Chunks are written in parallel
+def generate_trace(g):
+    tarball_name = g.tarfile if g.tarfile else g.device_str + ".tar"
+    g.device_str = re.sub("\.tar$", "", os.path.basename(tarball_name))
+    rng = np.random.default_rng(g.gen_seed)
+    num_regions = max(1, g.total_lbas * g.sector_size // g.gen_region)
+    generate_state['g'] = g
+    generate_state['zipf'] = zipf_regions(num_regions, g.gen_theta, g.gen_zipf_head, rng)
+    generate_state['segments'] = trace_segments(g.runtime, g.timeout)
+    chunks = len(generate_state['segments'])
+    runtime = sum(generate_state['segments'])
+    members = ["fdisk." + g.device_str, "timeline." + g.device_str, "generate." + g.device_str + ".json"]
+    generate_fdisk(g, members[0])
+    start = time.time()
+    with open(members[1], "w") as fo:
+        for chunk in range(chunks):
+            fo.write("%d %0.6f\n" % (chunk, start + sum(generate_state['segments'][:chunk])))
+    if g.gen_files > 0:
+        members.append("filetrace." + g.device_str + ".0.txt.gz")
+        generate_filetrace(g, rng, members[-1])
+
+    logger.info("Generating %d seconds at %d IOPS on %s (%0.2f GiB, Zipf theta %g over %d regions of %s)" % (runtime, g.gen_iops,
+        g.device, g.total_lbas * g.sector_size / float(g.GiB), g.gen_theta, num_regions, size_str(g, g.gen_region)))
+    events = 0
+    done = 0
+    workers = max(1, min(chunks, g.gen_workers if g.gen_workers > 0 else multiprocessing.cpu_count()))
+    pool = Pool(workers) if workers > 1 else None
+    for (chunk, count) in (pool.imap_unordered(generate_worker, range(chunks)) if pool is not None else map(generate_worker, range(chunks))):
+        events += count
+        done += 1
+        printf("\rGenerated %d of %d chunks (%d I/O's)", done, chunks, events)
+        sys.stdout.flush()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    printf("\n")
+    members += [event_file(g, chunk) for chunk in range(chunks)]
+    with open(members[2], "w") as fo:
+        json.dump({'device': g.device, 'sector_size': g.sector_size, 'total_lbas': g.total_lbas, 'runtime': runtime,
+            'events': events, 'iops': g.gen_iops, 'read_percent': g.gen_read_percent, 'sizes': [[s, p] for (s, p) in g.gen_sizes],
+            'zipf_theta': g.gen_theta, 'region_size': g.gen_region, 'regions': num_regions, 'sequential': g.gen_seq,
+            'files': g.gen_files, 'seed': g.gen_seed}, fo, indent=1)
+
+    (rc, out) = run_cmd(g, "tar -cf " + tarball_name + " " + " ".join(members))
+    if rc != 0:
+        logger.info("ERROR: failed to tarball " + tarball_name)
+        sys.exit(8)
+    for member in members:
+        os.remove(member)
+    logger.info("FINISHED generating: %s (%d I/O's)" % (tarball_name, events))
+    logger.info("Please use this file with python3 " + os.path.basename(__file__) + " -m post -t " + tarball_name + " to create a report")
+# generate_trace (DONE)
+
+### Reset the peak RSS of this process (Linux clear_refs).  Returns False where that is not possible
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as fo:
+            fo.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+# reset_peak_rss (DONE)
+
+### Peak RSS in bytes since the last reset_peak_rss(), or since the process started
+def peak_rss():
+    try:
+        with open("/proc/self/status", "r") as fo:
+            for line in fo:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+# peak_rss (DONE)
+
+### Run one stage and measure it: wall and CPU seconds, events per second and peak RSS
+def measure_stage(events, func, *args):
+    reset_peak_rss()
+    (wall, cpu) = (time.perf_counter(), time.process_time())
+    func(*args)
+    (wall, cpu) = (time.perf_counter() - wall, time.process_time() - cpu)
+    return {'wall_s': wall, 'cpu_s': cpu, 'events_per_s': events / wall if wall > 0 else None, 'peak_rss_bytes': peak_rss()}
+# measure_stage (DONE)
+
+### Generate a benchmark trace into bench_dir, or reuse the one already there.  Returns (tarball, events)
+def bench_trace(g, trace):
+    events = max(1, int(trace['events'] * g.bench_scale))
+    tarball = os.path.join(os.path.abspath(g.bench_dir), "%s-%d.tar" % (trace['name'], events))
+    stem = os.path.basename(tarball)[:-len(".tar")]
+    if os.path.isfile(tarball):
+        with tarfile.open(tarball) as tar:
+            stale = "generate.%s.json" % stem not in tar.getnames() # Members named after the device by older versions
+        if stale:
+            os.remove(tarball)
+    if not os.path.isfile(tarball):
+        p = fresh_profile(g)
+        (p.device, p.device_str, p.tarfile) = ("/dev/" + trace['name'], trace['name'], tarball)
+        (p.sector_size, p.total_lbas, p.runtime) = (512, trace['size'] // 512, g.bench_seconds)
+        (p.gen_iops, p.gen_theta, p.gen_region, p.gen_files, p.gen_seq) = (max(1, events // g.bench_seconds), trace['theta'], trace['region'], trace['files'], g.bench_seq)
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(tarball))
+        try:
+            generate_trace(p)
+        finally:
+            os.chdir(cwd)
+    with tarfile.open(tarball) as tar:
+        events = json.load(tar.extractfile("generate.%s.json" % stem))['events']
+    return (tarball, events)
+# bench_trace (DONE)
+
+### State inherited by the benchmark worker processes
+bench_state = {}
+
+### Run 'post' over one benchmark trace a stage at a time, in a fresh process and its own directory, so
+### the peak RSS of each stage is its own.  The report output is thrown away
+def bench_worker(name):
+    (tarball, events) = bench_state['traces'][name]
+    p = fresh_profile(bench_state['g'])
+    stem = os.path.basename(tarball)[:-len(".tar")]
+    (p.tarfile, p.device_str, p.fdisk_file) = (tarball, stem, "fdisk." + stem)
+    report_bucket_size = p.bucket_size
+    def parse():
+        parse_trace_files(p)
+        rebucket(p, report_bucket_size)
+    work = tempfile.mkdtemp(prefix="ioprof.")
+    (cwd, stdout, level) = (os.getcwd(), sys.stdout, logger.level)
+    os.chdir(work)
+    sys.stdout = open(os.devnull, "w")
+    logger.setLevel(logging.ERROR)
+    try:
+        stages = collections.OrderedDict()
+        stages['ingest'] = measure_stage(events, input_tar_files, p)
+        stages['parse'] = measure_stage(events, parse)
+        stages['file_to_buckets'] = measure_stage(events, file_to_buckets, p)
+        stages['print_results'] = measure_stage(events, print_results, p)
+        stages['stats'] = measure_stage(events, print_stats, p)
+    finally:
+        logger.setLevel(level)
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+    wall = sum(s['wall_s'] for s in stages.values())
+    stages['post'] = {'wall_s': wall, 'cpu_s': sum(s['cpu_s'] for s in stages.values()), 'events_per_s': events / wall if wall > 0 else None,
+        'peak_rss_bytes': max(s['peak_rss_bytes'] for s in stages.values())}
+    return {'events': events, 'stages': stages}
+# bench_worker (DONE)
+
+### Compare benchmark results with a baseline.  A stage regressed if its events/sec dropped or its peak RSS
+### grew by more than bench_tolerance.  Stages faster than bench_min_wall seconds are too noisy to judge on time
+def bench_compare(g, results, baseline):
+    regressions = []
+    for (name, trace) in results['traces'].items():
+        base = baseline.get('traces', {}).get(name)
+        if base is None or base['events'] != trace['events']:
+            logger.info("%s: not in the baseline at this scale" % name)
+            continue
+        for (stage, now) in trace['stages'].items():
+            before = base['stages'].get(stage)
+            if before is None:
+                continue
+            speed = now['events_per_s'] / before['events_per_s'] if now['events_per_s'] and before['events_per_s'] else None
+            rss = now['peak_rss_bytes'] / float(before['peak_rss_bytes']) if before['peak_rss_bytes'] else None
+            slower = speed is not None and speed < 1.0 - g.bench_tolerance and max(now['wall_s'], before['wall_s']) >= g.bench_min_wall
+            bigger = rss is not None and rss > 1.0 + g.bench_tolerance
+            now['baseline'] = {'speed_ratio': speed, 'rss_ratio': rss, 'regression': slower or bigger}
+            if slower or bigger:
+                regressions.append("%s %s: %s" % (name, stage, ", ".join(
+                    ([("%0.2fx events/sec" % speed)] if slower else []) + ([("%0.2fx peak RSS" % rss)] if bigger else []))))
+    return regressions
+# bench_compare (DONE)
+
+### 'benchmark' mode: 'post' end to end and stage by stage over a fixed set of generated traces
+### Results go to bench_output as JSON and are compared with --baseline if given.  Exits 1 on a regression
+def run_benchmarks(g):
+    if not os.path.isdir(g.bench_dir):
+        os.makedirs(g.bench_dir)
+    bench_state['g'] = g
+    bench_state['traces'] = {}
+    for trace in [t for t in g.bench_traces if g.bench_names is None or t['name'] in g.bench_names]:
+        logger.info("Preparing benchmark trace %s" % trace['name'])
+        bench_state['traces'][trace['name']] = bench_trace(g, trace)
+    results = {'version': g.version, 'scale': g.bench_scale, 'python': sys.version.split()[0], 'numpy': np.__version__,
+        'cpus': multiprocessing.cpu_count(), 'traces': collections.OrderedDict()}
+    for name in bench_state['traces']:
+        logger.info("Benchmarking %s (%d I/O's)" % (name, bench_state['traces'][name][1]))
+        pool = Pool(1)
+        results['traces'][name] = pool.apply(bench_worker, (name,))
+        pool.close()
+        pool.join()
+
+    regressions = []
+    if g.baseline is not None:
+        with open(g.baseline, "r") as fo:
+            regressions = bench_compare(g, results, json.load(fo))
+    logger.info("--------------------------------------------")
+    logger.info("%-12s %-16s %10s %10s %14s %12s %s" % ("Trace", "Stage", "Wall (s)", "CPU (s)", "Events/sec", "Peak RSS", "vs Baseline"))
+    for (name, trace) in results['traces'].items():
+        for (stage, m) in trace['stages'].items():
+            versus = ""
+            if 'baseline' in m:
+                versus = "%s speed, %s RSS%s" % ("NA" if m['baseline']['speed_ratio'] is None else "%0.2fx" % m['baseline']['speed_ratio'],
+                    "NA" if m['baseline']['rss_ratio'] is None else "%0.2fx" % m['baseline']['rss_ratio'], "  REGRESSION" if m['baseline']['regression'] else "")
+            logger.info("%-12s %-16s %10.3f %10.3f %14s %12s %s" % (name, stage, m['wall_s'], m['cpu_s'],
+                "NA" if m['events_per_s'] is None else "%d" % m['events_per_s'], size_str(g, m['peak_rss_bytes']), versus))
+    logger.info("--------------------------------------------")
+    results['regressions'] = regressions
+    with open(g.bench_output, "w") as fo:
+        json.dump(results, fo, indent=1)
+    logger.info("Wrote benchmark results to " + g.bench_output)
+    for regression in regressions:
+        logger.info("REGRESSION: " + regression)
+    if len(regressions) > 0:
+        sys.exit(1)
+# run_benchmarks (DONE)
+
+### blktrace segment lengths for a runtime: timeout seconds each and the remainder last, so the segments
+### add up to exactly the runtime
+def trace_segments(runtime, timeout):
+    segments = [timeout] * (runtime // timeout)
+    if runtime % timeout > 0:
+        segments.append(runtime % timeout)
+    return segments
+# trace_segments (DONE)
+
+### Explain why blktrace could not run
+def blktrace_failed():
+    logger.info("Unable to run the 'blktrace' tool required to trace all of your I/O")
+    logger.info("If you are using SLES 11 SP1, then it is likely that your default kernel is missing CONFIG_BLK_DEV_IO_TRACE")
+    logger.info("which is required to run blktrace.  This is only available in the kernel-trace version of the kernel.")
+    logger.info("kernel-trace is available on the SLES11 SP1 DVD and you simply need to install this and boot to this")
+    logger.info("kernel version in order to get this working.")
+    logger.info("If you are using a differnt distro or custom kernel, you may need to rebuild your kernel with the 'CONFIG_BLK 1f40 _DEV_IO_TRACE'")
+    logger.info("option enabled.  This should allow blktrace to function\n")
+    logger.info("ERROR: Could not run blktrace")
+# blktrace_failed (DONE)
+
+### Send sig to a child started in its own session and everything it started (sudo passes it on)
+def signal_group(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+# signal_group (DONE)
+
+### Wire format between 'trace' mode --collector and 'collect' mode: frames of a header, a name and data,
+### each one acknowledged.  A hello frame opens (or resumes) a session named by the sender, file frames
+### carry one tarball member each and an end frame closes the trace
+collect_magic  = b"IOPC"
+collect_hello  = 1
+collect_file   = 2
+collect_end    = 3
+collect_frame  = struct.Struct("<4sBHQ")               # magic, kind, name length, data length
+collect_ack    = struct.Struct("<4sB")                 # magic, 0 if accepted
+
+### Parse a [host]:port collector address.  Returns (host, port) or None
+def parse_collector(text):
+    (host, colon, port) = text.rpartition(":")
+    if colon == "" or not port.isdigit() or not 0 < int(port) < 65536:
+        return None
+    return (host.strip("[]"), int(port))
+# parse_collector (DONE)
+
+### Read one frame.  Returns (kind, name, data)
+async def read_frame(reader):
+    (magic, kind, name_length, data_length) = collect_frame.unpack(await reader.readexactly(collect_frame.size))
+    if magic != collect_magic:
+        raise ConnectionError("not an ioprof trace stream")
+    name = (await reader.readexactly(name_length)).decode("utf-8", "replace")
+    return (kind, name, await reader.readexactly(data_length))
+# read_frame (DONE)
+
+### 'trace' mode end of the link to a 'collect' mode ioprof.  Files are sent one frame at a time and a
+### file only counts as sent once the collector acknowledges it.  A dropped link is reopened under the
+### same session, up to collect_retries times collect_retry_wait seconds apart, and the file in flight is
+### sent again.  The collector keeps the first copy, so nothing is lost or written twice
+class collector_link:
+    def __init__(self, g):
+        self.g       = g
+        self.address = "%s:%d" % g.collector
+        self.session = os.urandom(8).hex()
+        self.reader  = None
+        self.writer  = None
+        self.sent    = 0                               # Bytes acknowledged
+
+    ### Send one frame and wait for its acknowledgement, reconnecting as needed
+    async def frame(self, kind, name, data):
+        g = self.g
+        error = None                                   # Why the last attempt failed
+        for attempt in range(g.collect_retries + 1):
+            if attempt > 0:
+                logger.info("\rLost the collector at %s (%s).  Retrying in %d seconds (%d of %d)" % (self.address, error, g.collect_retry_wait, attempt, g.collect_retries))
+                await asyncio.sleep(g.collect_retry_wait)
+            try:
+                if self.writer is None:
+                    (self.reader, self.writer) = await asyncio.wait_for(asyncio.open_connection(*g.collector), g.collect_timeout)
+                    hello = json.dumps({'device': g.device_str, 'version': g.version}).encode("utf-8")
+                    await self.exchange(collect_hello, self.session, hello)
+                await self.exchange(kind, name, data)
+                self.sent += len(data)
+                return
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+                self.close()
+        raise IOError("collector " + self.address + " unreachable: " + error)
+
+    async def exchange(self, kind, name, data):
+        name = name.encode("utf-8")
+        self.writer.write(collect_frame.pack(collect_magic, kind, len(name), len(data)) + name)
+        self.writer.write(data)
+        await self.writer.drain()
+        (magic, status) = collect_ack.unpack(await asyncio.wait_for(self.reader.readexactly(collect_ack.size), self.g.collect_timeout))
+        if magic != collect_magic or status != 0:
+            raise ConnectionRefusedError("the collector refused the trace (busy with another one?)")
+
+    async def send(self, filename):
+        loop = asyncio.get_event_loop()
+        with open(filename, "rb") as fo:
+            data = await loop.run_in_executor(None, fo.read)
+        await self.frame(collect_file, os.path.basename(filename), data)
+
+    ### Send the last files and close the trace
+    async def finish(self, filenames):
+        for filename in filenames:
+            await self.send(filename)
+        await self.frame(collect_end, "", b"")
+        self.close()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        (self.reader, self.writer) = (None, None)
+# collector_link (DONE)
+
+### 'collect' mode.  Receives one trace streamed by 'trace' mode --collector and writes it as the usual
+### <dev>.tar (or -t).  Each member is acknowledged once it is in the tarball.  A sender that reconnects
+### resumes its session, and members it sends again are acknowledged without being written twice.
+### Connections from any other session are refused until the trace is in
+class trace_collector:
+    def __init__(self, g):
+        import_asyncio()
+        self.g        = g
+        self.session  = None                           # Session of the trace being received
+        self.tarball  = None
+        self.tar      = None
+        self.names    = set()                          # Members in the tarball
+        self.received = 0                              # Bytes in the tarball
+        self.lock     = None                           # Held while the tarball is written (main() makes it)
+
+    async def reply(self, writer, status):
+        writer.write(collect_ack.pack(collect_magic, status))
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        peer = writer.get_extra_info("peername")
+        try:
+            (kind, session, data) = await read_frame(reader)
+            if kind != collect_hello or self.done.is_set() or self.session not in (None, session):
+                logger.info("\rRefused a second trace from %s" % (peer,))
+                await self.reply(writer, 1)
+                return
+            if self.session is None:
+                device = re.sub("[^\w.-]", "_", json.loads(data.decode("utf-8")).get('device', "ioprof")) or "ioprof"
+                self.tarball = self.g.tarfile if self.g.tarfile else device + ".tar"
+                self.tar = tarfile.open(self.tarball, "w")
+                self.session = session
+                logger.info("Receiving a trace of %s from %s into %s" % (device, peer[0], self.tarball))
+            else:
+                logger.info("\rSender connected again from %s, %d files received so far" % (peer[0], len(self.names)))
+            await self.reply(writer, 0)
+            while True:
+                (kind, name, data) = await read_frame(reader)
+                name = os.path.basename(name)
+                if kind == collect_end:
+                    async with self.lock:
+                        self.tar.close()
+                    self.done.set()
+                    await self.reply(writer, 0)
+                    return
+                if kind != collect_file or name in ("", ".", ".."):
+                    raise ConnectionError("unexpected frame")
+                # One writer at a time: a member resent while its first copy is still being written
+                # waits here and is then only acknowledged
+                async with self.lock:
+                    if name not in self.names:
+                        info = tarfile.TarInfo(name)
+                        (info.size, info.mtime, info.mode) = (len(data), int(time.time()), 0o644)
+                        await loop.run_in_executor(None, self.tar.addfile, info, io.BytesIO(data))
+                        self.names.add(name)
+                        self.received += len(data)
+                        printf("\rReceived %d files, %s", len(self.names), size_str(self.g, self.received))
+                        sys.stdout.flush()
+                await self.reply(writer, 0)
+        except asyncio.IncompleteReadError as e:
+            if e.partial != b"":
+                logger.info("\rLost the sender at %s (%s).  Waiting for it to reconnect" % (peer[0], str(e)))
+        except (OSError, ValueError) as e:
+            logger.info("\rLost the sender at %s (%s).  Waiting for it to reconnect" % (peer[0], str(e) or type(e).__name__))
+        finally:
+            writer.close()
+
+    async def main(self):
+        self.done = asyncio.Event()
+        self.lock = asyncio.Lock()
+        (host, port) = self.g.collector
+        server = await asyncio.start_server(self.handle, host or None, port)
+        logger.info("Listening for a trace on %s:%d" % (host or "*", port))
+        async with server:
+            await self.done.wait()
+
+    ### Receive the trace.  Returns the tarball, None if interrupted first
+    def start(self):
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            if self.tar is not None:
+                self.tar.close()
+                logger.info("\rInterrupted.  %s has the %d files received so far" % (self.tarball, len(self.names)))
+            return None
+        logger.info("\rReceived %s: %d files, %s          " % (self.tarball, len(self.names), size_str(self.g, self.received)))
+        return self.tarball
+# trace_collector (DONE)
+
+### 'trace' mode controller.  blktrace records the segments back to back while converters run blkparse
+### and gzip on the segments already recorded and a writer appends them to the tarball, all as asyncio
+### subprocess tasks.  The queue of recorded segments is bounded (trace_queue), so if the converters
+### fall behind the capture waits rather than filling the disk with raw blktrace output.  Every child
+### has a timeout.  Ctrl-C stops the capture and the segments recorded so far are converted and
+### archived.  A second Ctrl-C aborts.  With --collector the segments are streamed to the collector
+### instead of the tarball and deleted once it has them
+class trace_controller:
+    def __init__(self, g, tarball):
+        import_asyncio()
+        self.g          = g
+        self.link       = collector_link(g) if g.collector is not None else None
+        self.tarball    = tarball if self.link is None else self.link.address
+        self.segments   = trace_segments(g.runtime, g.timeout)
+        self.recorded   = 0                            # Segments blktrace finished
+        self.seconds    = 0.0                          # Seconds recorded
+        self.converted  = 0                            # Segments converted
+        self.archived   = []                           # Converted segment files in the tarball
+        self.error      = 0                            # Exit code of a failure, 0 if none
+        self.procs      = set()                        # Running children
+        self.tasks      = []
+        self.segment_start = None                      # When the running segment started
+
+    ### Run a shell command in its own session.  Returns its exit code, or None if it ran past timeout
+    async def run(self, cmd, timeout):
+        logger.debug(cmd)
+        proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.DEVNULL, start_new_session=True)
+        self.procs.add(proc)
+        try:
+            await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            signal_group(proc, signal.SIGKILL)
+            await proc.wait()
+            return None
+        except asyncio.CancelledError:
+            signal_group(proc, signal.SIGKILL)
+            raise
+        finally:
+            self.procs.discard(proc)
+        return proc.returncode
+
+    ### First Ctrl-C: stop recording and keep what was recorded.  Second: abort
+    def interrupt(self):
+        if not self.stopping.is_set():
+            logger.info("\rStopping the trace after %0.1f seconds.  Converting what was recorded (Ctrl-C again to abort)" % self.elapsed())
+            self.stopping.set()
+            return
+        self.error = 130
+        for task in self.tasks:
+            task.cancel()
+
+    def elapsed(self):
+        return self.seconds + (time.time() - self.segment_start if self.segment_start is not None else 0.0)
+
+    ### Record the segments back to back and queue each one for a converter
+    async def capture(self, starts):
+        g = self.g
+        for (chunk, seconds) in enumerate(self.segments):
+            if self.stopping.is_set():
+                break
+            cmd = "sudo blktrace -b " + str(g.buffer_size) + " -n " + str(g.buffer_count) + " -a queue -d " + str(g.device) + " -o blk.out." + str(g.device_str) + "." + str(chunk) + " -w " + str(seconds) + " 1> /dev/null"
+            logger.debug(cmd)
+            proc = await asyncio.create_subprocess_shell(cmd, start_new_session=True)
+            self.segment_start = time.time()
+            starts.write("%d %0.6f\n" % (chunk, self.segment_start))
+            starts.flush()
+            self.procs.add(proc)
+            done = asyncio.ensure_future(proc.wait())
+            stop = asyncio.ensure_future(self.stopping.wait())
+            await asyncio.wait((done, stop), timeout=seconds + g.trace_grace, return_when=asyncio.FIRST_COMPLETED)
+            stop.cancel()
+            if not done.done():
+                # Stopped early or hung.  SIGINT makes blktrace flush what it has and exit
+                hung = not self.stopping.is_set()
+                signal_group(proc, signal.SIGINT)
+                try:
+                    await asyncio.wait_for(asyncio.shield(done), g.trace_grace)
+                except asyncio.TimeoutError:
+                    signal_group(proc, signal.SIGKILL)
+                    await done
+                if hung:
+                    logger.info("\rERROR: blktrace segment %d ran %d seconds past its %d second window" % (chunk, g.trace_grace, seconds))
+                    self.error = 7
+                    self.stopping.set()
+            self.procs.discard(proc)
+            self.seconds += min(time.time() - self.segment_start, seconds)
+            self.segment_start = None
+            if proc.returncode != 0 and not self.stopping.is_set():
+                blktrace_failed()
+                self.error = 7
+                self.stopping.set()
+                break
+            self.recorded += 1
+            await self.queue.put(chunk)
+        for i in range(g.trace_converters):
+            await self.queue.put(None)
+
+    ### blkparse each recorded segment into g.codec, then drop its raw blktrace files.  The binary codecs
+    ### are encoded from the blkparse text in a thread
+    async def convert(self):
+        g = self.g
+        loop = asyncio.get_event_loop()
+        while True:
+            chunk = await self.queue.get()
+            if chunk is None:
+                break
+            name = "blk.out." + g.device_str + "." + str(chunk)
+            cmd = "sudo blkparse -i " + name + " -q -f " + '"' + g.blkparse_format + '" | grep -v cfq'
+            cmd += " | gzip --fast > " + name + ".blkparse.gz" if g.codec == 'gzip' else " > " + name + ".blkparse"
+            rc = await self.run(cmd, g.convert_timeout)
+            if rc is None:
+                logger.error("blkparse of segment %d ran past %d seconds and was stopped" % (chunk, g.convert_timeout))
+            elif rc != 0:
+                logger.error(f"blkparse returned non-zero return code rc={rc}")
+            await self.run("sudo rm -f " + name + ".blktrace.*", g.convert_timeout)
+            if rc is not None and g.codec != 'gzip':
+                await loop.run_in_executor(None, encode_events, g, event_file(g, chunk), blkparse_batches(g, name + ".blkparse"))
+                os.remove(name + ".blkparse")
+            if rc is not None:
+                self.converted += 1
+                await self.written.put(event_file(g, chunk))
+        await self.written.put(None)
+
+    ### Append the converted segments to the tarball, or send them to the collector, as they come in
+    async def archive(self):
+        loop = asyncio.get_event_loop()
+        tar = tarfile.open(self.tarball, "w") if self.link is None else None
+        try:
+            left = self.g.trace_converters
+            while left > 0:
+                name = await self.written.get()
+                if name is None:
+                    left -= 1
+                    continue
+                if tar is not None:
+                    await loop.run_in_executor(None, tar.add, name)
+                else:
+                    await self.link.send(name)
+                    if not self.g.trace_files:
+                        os.remove(name)                # -f maps the files from the local segments
+                self.archived.append(name)
+        finally:
+            if tar is not None:
+                tar.close()
+
+    async def progress(self):
+        total = sum(self.segments)
+        while True:
+            elapsed = min(self.elapsed(), total)
+            printf("\r%d %% done (%d seconds left), %d of %d segments converted   ", elapsed * 100 / total, total - elapsed, self.converted, len(self.segments))
+            sys.stdout.flush()
+            await asyncio.sleep(1)
+
+    async def main(self, starts):
+        loop = asyncio.get_event_loop()
+        self.stopping = asyncio.Event()
+        self.queue = asyncio.Queue(self.g.trace_queue)
+        self.written = asyncio.Queue(self.g.trace_queue)
+        loop.add_signal_handler(signal.SIGINT, self.interrupt)
+        reporter = asyncio.ensure_future(self.progress())
+        self.tasks = [asyncio.ensure_future(self.capture(starts)), asyncio.ensure_future(self.archive())]
+        self.tasks += [asyncio.ensure_future(self.convert()) for i in range(self.g.trace_converters)]
+        try:
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            self.error = self.error or 130
+        except (IOError, tarfile.TarError) as e:
+            logger.info("\rERROR: failed to tarball " + self.tarball + ": " + str(e))
+            self.error = 8
+        finally:
+            reporter.cancel()
+            loop.remove_signal_handler(signal.SIGINT)
+            for proc in list(self.procs):
+                signal_group(proc, signal.SIGKILL)
+            if self.link is not None:
+                self.link.close()
+
+    ### Run the trace.  Returns 0, or the exit code of what failed
+    def start(self, starts):
+        asyncio.run(self.main(starts))
+        logger.info("\rRecorded %0.1f of %d seconds in %d segments, %d converted          " % (self.seconds, sum(self.segments), self.recorded, self.converted))
+        return self.error
+
+    ### Add the files written after the capture (fdisk, timeline, file map) and close the trace
+    def finish(self, names):
+        if self.link is None:
+            with tarfile.open(self.tarball, "a") as tar:
+                for name in names:
+                    tar.add(name)
+            return
+        asyncio.run(self.link.finish(names))
+        logger.info("\rSent %s to the collector at %s" % (size_str(self.g, self.link.sent), self.link.address))
+# trace_controller (DONE)
+
 ### MAIN
 def main(argv):
     global logger
@@ -1371,6 +5092,21 @@ def main(argv):
     if g.mode == 'live' or g.mode == 'trace':
         mount_debugfs(g)
 
+    if g.mode == 'collect':
+        # Receive a trace streamed by 'trace' mode --collector
+        with profile_stage(g, "collect"):
+            g.tarfile = trace_collector(g).start()
+        if g.tarfile is None:
+            sys.exit(130)
+        if not g.collect_post:
+            print_profile(g)
+            sys.exit()
+        # Then report on it as 'post' mode would
+        g.mode = 'post'
+        g.device_str = re.sub("\.tar$", "", os.path.basename(g.tarfile))
+        g.fdisk_file = "fdisk." + g.device_str
+        g.cleanup.append(g.fdisk_file)
+
     if g.mode == 'trace':
         # Trace
 
@@ -1397,154 +5133,151 @@ def main(argv):
             sys.exit(1)
 
         os.system("rm -f blk.out.* &>/dev/null") # Cleanup previous mess
-        runcount = g.runtime / g.timeout
-        while runcount > 0:
-            time_left = runcount * g.timeout
-            percent_prog = (g.runtime - time_left) * 100  / g.runtime
-            printf( "\r%d %% done (%d seconds left)", percent_prog, time_left)
-            #sys.stdout.flush() # BEN
-            cmd = "sudo blktrace -b " + str(g.buffer_size) + " -n " + str(g.buffer_count) + " -a queue -d " + str(g.device) + " -o blk.out." + str(g.device_str) + ".0 -w " + str(g.timeout) + " 1> /dev/null"
-            logger.debug( cmd)
-
-            rc = os.system(cmd)
-
-            if rc != 0:
-                logger.info("Unable to run the 'blktrace' tool required to trace all of your I/O")
-                logger.info("If you are using SLES 11 SP1, then it is likely that your default kernel is missing CONFIG_BLK_DEV_IO_TRACE")
-                logger.info("which is required to run blktrace.  This is only available in the kernel-trace version of the kernel.")
-                logger.info("kernel-trace is available on the SLES11 SP1 DVD and you simply need to install this and boot to this")
-                logger.info("kernel version in order to get this working.")
-                logger.info("If you are using a differnt distro or custom kernel, you may need to rebuild your kernel with the 'CONFIG_BLK 1f40 _DEV_IO_TRACE'")
-                logger.info("option enabled.  This should allow blktrace to function\n")
-                logger.info("ERROR: Could not run blktrace")
-                sys.exit(7)
-            cmd = "sudo blkparse -i blk.out." + g.device_str + ".0 -q -f " + '" %d %a %S %n\n" | grep -v cfq | gzip --fast > blk.out.' + g.device_str + ".0.blkparse.gz;"
-            logger.debug( cmd)
-            rc = os.system(cmd)
-            if rc != 0:
-                logger.error(f"blkparse returned non-zero return code rc={rc}")
-            runcount -= 1
-        logger.info("\rMapping files to block locations                ")
-
-        if g.trace_files:
-            find_all_files(g)
         tarball_name = g.device_str + ".tar"
-        logger.info("\rCreating tarball " + tarball_name)
-        filetrace = ""
-        if g.trace_files:
-            filetrace = "filetrace." + g.device_str + ".*.txt.gz"
-        cmd = "tar -cf " + tarball_name + " blk.out." + g.device_str + ".*.gz fdisk." + g.device_str + " " + filetrace + " 1> /dev/null"
-        logger.info(cmd)
-        rc = os.system(cmd)
+        controller = trace_controller(g, tarball_name)
+        starts = open("timeline." + g.device_str, "w")
+        # blktrace, blkparse and the tarball writer overlap, so this stage covers all three
+        with profile_stage(g, "capture"):
+            rc = controller.start(starts)
+        starts.close()
         if rc != 0:
-            logger.info("ERROR: failed to tarball " + tarball_name)
-            sys.exit(8)
-        cmd = "rm -f blk.out." + g.device_str + ".*.gz; rm -f fdisk." + g.device_str + "; rm -f filetrace." + g.device_str + ".*.gz"
+            os.system("rm -f " + tarball_name + " blk.out." + g.device_str + ".* timeline." + g.device_str)
+            sys.exit(rc)
+        if g.trace_files:
+            logger.info("\rMapping hot regions to files                    ")
+            with profile_stage(g, "file mapping"):
+                find_hot_files(g)
+        logger.info("\rFinishing tarball " + controller.tarball)
+        with profile_stage(g, "tar"):
+            try:
+                controller.finish(["fdisk." + g.device_str, "timeline." + g.device_str] + sorted(glob.glob("filetrace." + g.device_str + ".*.txt.gz")))
+            except (IOError, tarfile.TarError) as e:
+                logger.info("ERROR: failed to tarball " + controller.tarball + ": " + str(e))
+                sys.exit(8)
+        cmd = "rm -f blk.out." + g.device_str + ".*.gz blk.out." + g.device_str + ".*.ioev; rm -f fdisk." + g.device_str + " timeline." + g.device_str + "; rm -f filetrace." + g.device_str + ".*.gz"
         rc = os.system(cmd)
-        logger.info("\rFINISHED tracing: " + tarball_name)
         name = os.path.basename(__file__)
-        logger.info("Please use this file with python3 " + name + " -m post -t " + tarball_name + " to create a report")
+        if g.collector is not None:
+            logger.info("\rFINISHED tracing: sent to the collector at " + controller.tarball)
+            logger.info("Please use the tarball it wrote with python3 " + name + " -m post -t <tarball> to create a report")
+        else:
+            logger.info("\rFINISHED tracing: " + tarball_name)
+            logger.info("Please use this file with python3 " + name + " -m post -t " + tarball_name + " to create a report")
+        print_profile(g)
 
     elif g.mode == 'post':
         # Post 
         #g.THREAD_MAX = multiprocessing.cpu_count() * 4
 
-        # CPU Count
-        cpu_count = multiprocessing.cpu_count()
-        proc_pool = Pool(cpu_count)
-
-        input_tar_files(g)
-
-        # Make the PDF plot a square matrix to keep gnuplot happy
+        report_bucket_size = g.bucket_size
+        parse_tarball(g)
+        with profile_stage(g, "merge"):
+            rebucket(g, report_bucket_size)
         g.y_height = g.x_width = int(math.sqrt(g.num_buckets))
-        logger.debug( "x=" + str(g.x_width) + " y=" + str(g.y_height))
-
-        #g.debug=True
-        logger.debug( "num_buckets=" + str(g.num_buckets) + " sector_size=" + str(g.sector_size) + " total_lbas=" + str(g.total_lbas) + " bucket_size=" + str(g.bucket_size))
-        #g.debug=False
-        rc = os.system("rm -f filetrace." + g.device_str + ".*.txt")
-        rc = os.system("rm -f blk.out." + g.device_str + ".*.blkparse")
-        logger.info("Time to parse.  Please wait...\n")
-
-        size = len(g.file_list)
-        file_count = 0
-
-        plist = []
-        for filename in g.file_list:
-            logger.debug(filename)
-            logger.debug("----------------------")
-            file_count += 1
-            #perc = file_count * 100 / size
-            printf("\rInput Percent: %d %% (File %d of %d) threads=%d", (file_count*100 / size), file_count, size, len(plist))
-            sys.stdout.flush()
-            result = regex_find(g, "(blk.out.\S+).gz", filename)
-            if result != False:
-                new_file = result[0]
-                #if g.single_threaded:
-                if True:
-                    thread_parse(g, new_file, file_count)
-                    logger.debug( "blk.out hit = " + filename + "\n")
-                else:
-                    p = Process(target=thread_parse, args=(g, new_file, file_count))
-                    plist.append(p)
-                    p.start()
-            result = regex_find(g, "(filetrace.\S+.\S+.txt).gz", filename)
-            if result != False:
-                new_file = result[0]
-                g.trace_files=True
-                logger.debug( "filetrace hit = " + filename+ "\n")
-                if g.single_threaded:
-                    parse_filetrace(g, new_file, file_count)
-                    logger.debug( "blk.out hit = " + filename + "\n")
-                else:
-                    p = Process(target=parse_filetrace, args=(g, new_file, file_count))
-                    plist.append(p)
-                    p.start()
-            while len(plist) > g.thread_max:
-                for p in plist:
-                    try:
-                        p.join(0)
-                    except:
-                        pass
-                    else:
-                        if not p.is_alive():
-                            plist.remove(p)
-                time.sleep(0.10)
-
-        if g.single_threaded == False:
-            x=1
-            while len(plist) > 0:
-                dots=""
-                for i in range(x):
-                    dots = dots + "."
-                x+=1
-                if x>3:
-                    x=1
-                printf("\rWaiting on %3d threads to complete processing%-3s", len(plist), dots)
-                printf("    ")
-                sys.stdout.flush()
-                for p in plist:
-                    try:
-                        p.join(0)
-                    except:
-                        pass
-                    else:
-                        if not p.is_alive():
-                            plist.remove(p)
-                time.sleep(0.10)
-
-        logger.info("\rFinished parsing files.  Now to analyze         \n")
-        file_to_buckets(g)
-        print_results(g)
-        print_stats(g)
-        draw_heatmap(g)
-        if g.pdf == True:
-            print_header_heatmap(g)
-            print_header_histogram_iops(g)
-            print_header_stats_iops(g)
-            create_report(g)
+        with profile_stage(g, "file mapping"):
+            file_to_buckets(g)
+        with profile_stage(g, "analysis"):
+            print_results(g)
+            print_stats(g)
+            print_timeline(g)
+            print_hotness(g)
+            print_mrc(g)
+            if len(g.sims) > 0:
+                print_simulation(g, g.sims)
+        with profile_stage(g, "report"):
+            draw_heatmap(g)
+            if g.pdf == True:
+                print_header_heatmap(g)
+                print_header_histogram_iops(g)
+                print_header_stats_iops(g)
+                create_report(g)
+            write_results(g)
         cleanup_files(g)
+        print_profile(g)
         
+    elif g.mode == 'report':
+        # Report from saved aggregates
+        load_aggregates(g, g.tarfile)
+        if g.report_bucket_size is not None:
+            rebucket(g, g.report_bucket_size)
+        elif g.bucket_size < g.MiB and g.MiB % g.bucket_size == 0:
+            rebucket(g, g.MiB) # Same default as 'post'
+        g.y_height = g.x_width = int(math.sqrt(g.num_buckets))
+        if g.timeline is not None and g.report_interval is None:
+            g.interval = g.timeline.interval                # Same as the saved timeline unless --interval is given
+        if g.timeline is not None and g.interval != g.timeline.interval:
+            factor = int(round(g.interval / g.timeline.interval))
+            if factor < 1 or abs(factor * g.timeline.interval - g.interval) > 1e-9:
+                logger.info("ERROR: --interval %g is not a multiple of the saved %g second timeline" % (g.interval, g.timeline.interval))
+                sys.exit(1)
+            g.timeline = g.timeline.rebin(factor)
+        if g.trace_files:
+            with profile_stage(g, "file mapping"):
+                file_to_buckets(g)
+        with profile_stage(g, "analysis"):
+            print_results(g)
+            print_stats(g)
+            print_timeline(g)
+        with profile_stage(g, "report"):
+            draw_heatmap(g)
+            write_results(g)
+        if g.memmap_dir is not None:
+            cleanup_files(g)
+        print_profile(g)
+
+    elif g.mode == 'compare':
+        # Compare two traces of the same device
+        bucket_size = g.report_bucket_size if g.report_bucket_size is not None else g.MiB
+        (a, b) = [load_profile(g, path, bucket_size) for path in g.inputs]
+        if (a.sector_size, a.total_lbas) != (b.sector_size, b.total_lbas):
+            logger.info("ERROR: %s and %s are not the same device geometry (%d x %d vs %d x %d sectors)" % (a.input, b.input, a.total_lbas, a.sector_size, b.total_lbas, b.sector_size))
+            sys.exit(1)
+        (g.device, g.sector_size, g.total_lbas, g.total_capacity_gib) = (b.device, b.sector_size, b.total_lbas, b.total_capacity_gib)
+        (g.bucket_size, g.num_buckets) = (b.bucket_size, b.num_buckets)
+        with profile_stage(g, "analysis"):
+            print_compare(g, a, b)
+        with profile_stage(g, "report"):
+            write_results(g)
+        print_profile(g)
+
+    elif g.mode == 'merge':
+        # Merge many traces of the same device geometry into one report
+        bucket_size = g.report_bucket_size if g.report_bucket_size is not None else g.MiB
+        with profile_stage(g, "merge"):
+            apply_aggregates(g, merge_inputs(g, g.inputs, bucket_size))
+        g.input = ",".join(g.inputs)
+        save_aggregates(g, g.merge_output)
+        g.y_height = g.x_width = int(math.sqrt(g.num_buckets))
+        if g.trace_files:
+            with profile_stage(g, "file mapping"):
+                file_to_buckets(g)
+        with profile_stage(g, "analysis"):
+            print_results(g)
+            print_stats(g)
+            print_timeline(g)
+        with profile_stage(g, "report"):
+            draw_heatmap(g)
+            write_results(g)
+        print_profile(g)
+
+    elif g.mode == 'simulate':
+        # Simulate
+        input_tar_files(g)
+        sims = simulate_caches(g)
+        print_simulation(g, sims)
+        write_results(g)
+        cleanup_files(g)
+
+    elif g.mode == 'generate':
+        # Synthetic trace
+        with profile_stage(g, "generate"):
+            generate_trace(g)
+        print_profile(g)
+
+    elif g.mode == 'benchmark':
+        # Benchmark suite
+        run_benchmarks(g)
+
     elif g.mode == 'live':
         # Live
         print ("Live Mode - Coming Soon ...")
@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+
+IOPROF = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ioprof.py")
+
+# Runs ioprof as a script with cpu_count() forced to 4, so 'merge' starts its worker pool on any host
+RUNNER = "import multiprocessing, runpy, sys; multiprocessing.cpu_count = lambda: 4; " \
+         "sys.argv = sys.argv[1:]; runpy.run_path(sys.argv[0], run_name='__main__')"
+
+
+def ioprof(cwd, *args):
+    return subprocess.run([sys.executable, "-c", RUNNER, IOPROF] + list(args), cwd=str(cwd),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, timeout=300)
+
+
+def test_merge_tarballs_with_parse_workers(tmp_path):
+    inputs = []
+    for seed in ("1", "2"):
+        work = tmp_path / ("seed" + seed)
+        work.mkdir()
+        run = ioprof(work, "-m", "generate", "-d", "/dev/sdy", "-r", "6", "--gen_size", "1G", "--gen_iops", "200", "--gen_seed", seed)
+        assert run.returncode == 0, run.stdout
+        inputs.append(str(work / "sdy.tar"))
+    run = ioprof(tmp_path, "-m", "merge", "-d", "/dev/sdy", "--parse_workers", "2", "--merge_output", "merged.ioprof.npz", *inputs)
+    assert run.returncode == 0, run.stdout
+    assert "daemonic" not in run.stdout
+    assert (tmp_path / "merged.ioprof.npz").is_file()